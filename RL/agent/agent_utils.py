@@ -12,20 +12,69 @@ def onehot(i, n, dtype=np.float32):
     return out
 
 
+class FrameStacker(object):
+    """
+    the last num_frames frames stacked on the first axis (channels of conv observations, features of flat ones),
+    optionally for num_envs envs (stacked on the axis after the env one).
+    every frame is written twice in a ring of 2 * num_frames slots, so the stack, oldest frame first,
+    is always a view of consecutive slots: get() copies nothing, the view is valid until the next push/reset
+    """
+    def __init__(self, num_frames, frame_shape, dtype, num_envs=None):
+        self.num_frames = num_frames
+        lead = () if num_envs is None else (num_envs,)
+        self.batched = num_envs is not None
+        self.buffer = np.zeros(lead + (2 * num_frames,) + tuple(frame_shape), dtype=dtype)
+        self.stack_shape = lead + (num_frames * frame_shape[0],) + tuple(frame_shape[1:])
+        self.next = 0
+
+    def reset(self, frame, env=None):
+        """
+        fill the stack with the first frame of an episode (of one env or of all the envs)
+        """
+        if not self.batched:
+            self.buffer[:] = frame
+        elif env is None:
+            self.buffer[:] = frame[:, None]
+        else:
+            self.buffer[env] = frame
+
+    def push(self, frame):
+        n = self.num_frames
+        if self.batched:
+            self.buffer[:, self.next] = frame
+            self.buffer[:, self.next + n] = frame
+        else:
+            self.buffer[self.next] = frame
+            self.buffer[self.next + n] = frame
+        self.next = (self.next + 1) % n
+
+    def get(self):
+        if self.batched:
+            view = self.buffer[:, self.next:self.next + self.num_frames]
+        else:
+            view = self.buffer[self.next:self.next + self.num_frames]
+        return view.reshape(self.stack_shape)
+
+
 def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True, discount=1,
-               learn=True, sleep=0.):
+               learn=True, sleep=0., store_memory=True, recorder=None):
     if num_steps == None:
         num_steps = env.spec.max_episode_steps
     total_rew = 0.
     total_rew_discount = 0.
     cost = 0.
-    if 'scaling' in agent.config:
-        scaling = agent.config['scaling']
-    else:
-        scaling = 'none'
     obs_cur = env.reset()
+    if recorder is not None and not recorder.start(episode):
+        recorder = None
+    # raw observation before the action, for the recorder
+    raw_cur = obs_cur
     if not ('baseline_env' in agent.config and agent.config['baseline_env']):
-        obs_cur = preprocess(obs_cur, agent.observation_space, agent.scaled_obs, type=scaling)
+        # two frame buffers: obs_cur is still needed for the memory when obs_next is written.
+        # obs_cur is a view of a reused buffer, memories that keep a reference have to copy it
+        frames = np.empty((2,) + agent.preprocessor.shape, dtype=agent.preprocessor.dtype)
+        obs_cur = agent.preprocessor(obs_cur, frames[0])
+        if agent.encoder is not None:
+            obs_cur = agent.encode(obs_cur)
 
         if agent.config['terminal_life']:
             last_lives = -1
@@ -35,9 +84,9 @@ def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True,
 
     if useConv == False:
         obs_cur = obs_cur.reshape(-1, )
-    obs_cur_stack = np.copy(obs_cur)
-    for _ in range(agent.config["past"]):
-        obs_cur_stack = np.concatenate((obs_cur_stack, obs_cur), 0)
+    stacker = FrameStacker(agent.config["past"] + 1, obs_cur.shape, obs_cur.dtype)
+    stacker.reset(obs_cur)
+    obs_cur_stack = stacker.get()
 
     if 'transition_net' in agent.config and agent.config['transition_net']: #fixme render and
         agent.state_list=[[],[]]
@@ -46,17 +95,19 @@ def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True,
         update_state = False
 
     max_qval = float("-inf")
+    timer = agent.timer
     for t in range(num_steps):
         if sleep > 0:
             time.sleep(sleep)
+        t0 = timer.tic()
         if agent.config['policy']:
             a = agent.actpolicy(obs_cur_stack, episode)
         else:
             a = agent.act(obs_cur_stack, episode,update_state=update_state)
+        t0 = timer.toc('act', t0)
 
-        start_time = time.time()
         (obs_next, rr, done, _info) = env.step(a)
-        start_time2 = time.time()
+        t0 = timer.toc('env_step', t0)
         if agent.config['terminal_life'] and not ('baseline_env' in agent.config and agent.config['baseline_env']):
             if _info['ale.lives'] < last_lives:
                 terminal_memory = True
@@ -68,9 +119,14 @@ def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True,
         if ('baseline_env' in agent.config and agent.config['baseline_env']):
             if hasattr(env,'was_real_done'): # when using EpisodicLifeEnv wrapper
                 done = env.was_real_done
+        if recorder is not None:
+            recorder.record(raw_cur, a, rr, done, terminal_memory)
+            raw_cur = obs_next
 
         if not ('baseline_env' in agent.config and agent.config['baseline_env']):
-            obs_next = preprocess(obs_next, agent.observation_space, agent.scaled_obs, type=scaling)
+            obs_next = agent.preprocessor(obs_next, frames[(t + 1) % 2])
+            if agent.encoder is not None:
+                obs_next = agent.encode(obs_next)
             reward = rr*agent.config['scalereward']
         else:
             # fixme rewards are clipped when baseline_env is enabled!!!!!!
@@ -84,22 +140,21 @@ def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True,
 
         if useConv == False:
             obs_next = obs_next.reshape(-1, )
-
-        if len(obs_cur.shape) == 3:
-            obs_next_stack = np.concatenate((obs_cur_stack[obs_next.shape[0]:, :, :], obs_next), 0)
-        else:
-            obs_next_stack = np.concatenate((obs_cur_stack[obs_cur.shape[0]:], obs_next))
+        t0 = timer.toc('preprocess', t0)
 
         #old
         #agent.memory.add([obs_cur_stack, a, limitreward, 1. - 1. * terminal_memory, t, None])
-        agent.memory.add(obs_cur, a, limitreward, 1. - 1. * terminal_memory, t)
-        start_time3 = time.time()
+        if store_memory:
+            agent.memory.add(obs_cur, a, limitreward, 1. - 1. * terminal_memory, t)
+        t0 = timer.toc('memory_add', t0)
         if learn and (not agent.config['policy']):
             cost += agent.learn()
+            timer.toc('learn', t0)
         elif ((t + 1) % agent.config['batch_size'] == 0 or done) and agent.config['policy']:
             # raise NotImplemented("startind not good for circular buffer")
             agent.learnpolicy()
             agent.memory.empty()
+            timer.toc('learn', t0)
 
         total_rew_discount += limitreward * (discount ** t) #using limited reward
         total_rew += reward
@@ -112,41 +167,217 @@ def do_rollout(agent, env, episode, num_steps=None, render=False, useConv=True,
                 max_qval = max(max_qval,np.max(q_val))
                 logger.debug("{} episode {} step {} done {} Q {} limitedrew {}".format(agent.config["path_exp"], episode, t, done, 'Q', q_val, limitreward))
 
-        obs_cur_stack = obs_next_stack
+        # obs_cur_stack is a view of the stacker, it is updated only after its last use
+        t0 = timer.tic()
+        stacker.push(obs_next)
+        obs_cur_stack = stacker.get()
+        timer.toc('stack', t0)
         obs_cur = obs_next
 
-        start_time4 = time.time()
         if render and t % 1 == 0:  # render every X steps (X=1)
             env.render()
 
         if done:
             break
-        if t % 5 == 0 and False:#fixme
-            print("time step",time.time()-start_time, start_time2 - start_time,start_time3 - start_time2,
-                  start_time4-start_time3,time.time() - start_time4)
+    if recorder is not None:
+        recorder.end()
+    timer.count('env_steps', t + 1)
 
     return total_rew, t + 1, total_rew_discount, max_qval
 
 
-def preprocess(observation, observation_space, scaled_obs, type='none'):
-    if type == 'crop':
-        resize_height = int(round(
-            float(observation.shape[0]) * scaled_obs[1] / observation.shape[1]))
-        observation = cv2.cvtColor(
-            cv2.resize(observation, (scaled_obs[1], resize_height), interpolation=cv2.INTER_LINEAR), cv2.COLOR_BGR2GRAY)
-        crop_y_cutoff = resize_height - 8 - scaled_obs[0]
-        cropped = observation[crop_y_cutoff:crop_y_cutoff + scaled_obs[0], :]
-        return cropped[None,...]#np.reshape(cropped, scaled_obs)
-    elif type == 'scale':
-        return cv2.cvtColor(cv2.resize(observation, (scaled_obs[1], scaled_obs[0]), interpolation=cv2.INTER_LINEAR),
-                            cv2.COLOR_BGR2GRAY)[None,...]
-    elif type == 'none' or np.isinf(observation_space.low).any() or np.isinf(observation_space.high).any():
-        return observation
-    elif type == 'flat':
-        o = (observation - observation_space.low) / (observation_space.high - observation_space.low) * 2. - 1.
-        return o.reshape(-1, )
+class VecRollout(object):
+    """
+    steps the num_envs environments of a VecEnv (the finished ones are reset by the VecEnv) in lockstep:
+    one batched forward and a vectorized epsilon greedy for the actions, num_envs transitions per memory write
+    and agent.learn() called num_envs times per step, so the updates per env step are the same as do_rollout.
+    the state of the envs is kept between calls, next_episode returns the next finished episode
+    """
+    def __init__(self, agent, venv, useConv=True, discount=1):
+        if agent.config['policy']:
+            raise NotImplementedError('vectorized rollout only for Q learning')
+        self.agent = agent
+        self.venv = venv
+        self.num_envs = venv.num_envs
+        self.useConv = useConv
+        self.discount = discount
+        self.baseline_env = 'baseline_env' in agent.config and agent.config['baseline_env']
+        # the frames are already preprocessed by the VecEnv workers
+        self.preprocessed = hasattr(venv, 'preprocessed') and venv.preprocessed
+        if not self.baseline_env and not self.preprocessed:
+            self.frames = np.empty((2, self.num_envs) + agent.preprocessor.shape, dtype=agent.preprocessor.dtype)
+        self.finished = []
+        self.total_rew = np.zeros(self.num_envs)
+        self.total_rew_discount = np.zeros(self.num_envs)
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.max_qval = np.full(self.num_envs, float("-inf"))
+        self.last_lives = np.full(self.num_envs, -1)
+        self.num_steps = 0
+        self.obs_cur = self.process(venv.reset(), 0)
+        self.stacker = FrameStacker(agent.config["past"] + 1, self.obs_cur.shape[1:], self.obs_cur.dtype,
+                                    num_envs=self.num_envs)
+        self.stacker.reset(self.obs_cur)
+        self.obs_cur_stack = self.stacker.get()
+
+    def process(self, obs, slot):
+        # slot: frame buffer of the preprocessed frames, the one of obs_cur is still needed for the memory
+        agent = self.agent
+        if self.baseline_env:
+            if obs.ndim == 4:
+                obs = np.moveaxis(obs, -1, 1)
+        else:
+            if not self.preprocessed:
+                obs = agent.preprocessor.batch(obs, self.frames[slot])
+            if agent.encoder is not None:
+                obs = agent.encode_batch(obs)
+        if self.useConv == False:
+            obs = obs.reshape(self.num_envs, -1)
+        return obs
+
+    def step(self, episode, learn=True):
+        agent = self.agent
+        timer = agent.timer
+        t0 = timer.tic()
+        actions = agent.act_batch(self.obs_cur_stack, episode)
+        t0 = timer.toc('act', t0)
+
+        obs_next, rr, done, infos = self.venv.step(actions)
+        t0 = timer.toc('env_step', t0)
+        done = np.asarray(done, dtype=bool)
+        terminal_memory = done.copy()
+        if agent.config['terminal_life'] and not self.baseline_env:
+            lives = np.array([info['ale.lives'] if 'ale.lives' in info else -1 for info in infos])
+            terminal_memory |= lives < self.last_lives
+            self.last_lives = np.where(done, -1, lives)
+
+        if not self.baseline_env:
+            reward = np.asarray(rr, dtype=np.float64) * agent.config['scalereward']
+        else:
+            reward = np.asarray(rr, dtype=np.float64)
+        if agent.config['limitreward'] is not None:
+            limitreward = np.clip(reward, agent.config['limitreward'][0], agent.config['limitreward'][1])
+        else:
+            limitreward = reward
+        obs_next = self.process(obs_next, (self.num_steps + 1) % 2)
+        t0 = timer.toc('preprocess', t0)
+
+        agent.memory.add_batch(self.obs_cur, actions, limitreward, 1. - 1. * terminal_memory, self.steps)
+        t0 = timer.toc('memory_add', t0)
+        if learn:
+            for _ in range(self.num_envs):
+                agent.learn()
+            t0 = timer.toc('learn', t0)
+
+        self.total_rew_discount += limitreward * self.discount ** self.steps
+        self.total_rew += reward
+        if self.num_steps % 200 == 0:
+            self.max_qval = np.maximum(self.max_qval, agent.evalQ(self.obs_cur_stack).max(1))
+        self.steps += 1
+        self.num_steps += 1
+
+        self.stacker.push(obs_next)
+        for e in np.nonzero(done)[0]:
+            # the VecEnv already returned the first observation of the next episode
+            self.finished.append((self.total_rew[e], int(self.steps[e]), self.total_rew_discount[e],
+                                  self.max_qval[e]))
+            self.total_rew[e] = 0.
+            self.total_rew_discount[e] = 0.
+            self.steps[e] = 0
+            self.max_qval[e] = float("-inf")
+            self.stacker.reset(obs_next[e], env=e)
+        self.obs_cur_stack = self.stacker.get()
+        self.obs_cur = obs_next
+        timer.toc('stack', t0)
+        timer.count('env_steps', self.num_envs)
+
+    def next_episode(self, episode, learn=True):
+        """
+        steps all the envs until one episode ends, returns its total_rew, steps, total_rew_discount, max_qval
+        """
+        while len(self.finished) == 0:
+            self.step(episode, learn)
+        return self.finished.pop(0)
+
 
+class Preprocessor(object):
+    """
+    preprocessing for one scaling mode, built once: the sizes, crop offset and scaling constants are
+    precomputed and the results are written in the out buffers given by the caller (allocated if None).
+    the color frames are converted to gray before resizing (3x less data to resize).
+    __call__ processes one observation, batch a batch of observations (vectorized envs)
+    """
+    def __init__(self, observation_space, scaled_obs, type='none'):
+        self.type = type
+        shape = observation_space.shape
+        if type in ('crop', 'scale', 'rgb'):
+            if type == 'crop':
+                resize_height = int(round(float(shape[0]) * scaled_obs[1] / shape[1]))
+                self.size = (scaled_obs[1], resize_height)
+                self.crop = resize_height - 8 - scaled_obs[0]
+                self.resized = np.empty((resize_height, scaled_obs[1]), dtype=np.uint8)
+            else:
+                self.size = (scaled_obs[1], scaled_obs[0])
+            if type == 'rgb':
+                self.resized = np.empty((scaled_obs[0], scaled_obs[1], 3), dtype=np.uint8)
+                self.shape = (3, scaled_obs[0], scaled_obs[1])
+            else:
+                self.gray = np.empty(shape[:2], dtype=np.uint8)
+                self.shape = (1, scaled_obs[0], scaled_obs[1])
+            self.dtype = np.dtype(np.uint8)
+        elif type == 'none' or np.isinf(observation_space.low).any() or np.isinf(observation_space.high).any():
+            self.type = 'none'
+            self.shape = shape
+            self.dtype = np.dtype(observation_space.dtype)
+        elif type == 'flat':
+            # (o - low) / (high - low) * 2 - 1 as o * mul + add
+            span = (observation_space.high - observation_space.low).astype(np.float32)
+            self.mul = (2. / span).reshape(-1)
+            self.add = (-observation_space.low * 2. / span - 1.).astype(np.float32).reshape(-1)
+            self.shape = (int(np.prod(shape)),)
+            self.dtype = np.dtype(np.float32)
+        else:
+            raise ValueError('unknown scaling ' + str(type))
+
+    def __call__(self, observation, out=None):
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        if self.type == 'scale':
+            cv2.cvtColor(observation, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            cv2.resize(self.gray, self.size, dst=out[0], interpolation=cv2.INTER_LINEAR)
+        elif self.type == 'crop':
+            cv2.cvtColor(observation, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            cv2.resize(self.gray, self.size, dst=self.resized, interpolation=cv2.INTER_LINEAR)
+            out[0] = self.resized[self.crop:self.crop + out.shape[1]]
+        elif self.type == 'rgb':
+            # color frame for a pretrained encoder, channel first
+            cv2.resize(observation, self.size, dst=self.resized, interpolation=cv2.INTER_LINEAR)
+            np.copyto(out, self.resized.transpose(2, 0, 1))
+        elif self.type == 'flat':
+            np.multiply(observation.reshape(-1), self.mul, out=out)
+            out += self.add
+        else:
+            np.copyto(out, observation)
+        return out
 
+    def batch(self, observations, out=None):
+        if out is None:
+            out = np.empty((len(observations),) + self.shape, dtype=self.dtype)
+        if self.type == 'flat':
+            np.multiply(observations.reshape(len(observations), -1), self.mul, out=out)
+            out += self.add
+        elif self.type == 'none':
+            np.copyto(out, observations)
+        else:
+            for i in range(len(observations)):
+                self(observations[i], out[i])
+        return out
+
+
+def preprocess(observation, observation_space, scaled_obs, type='none'):
+    """
+    one observation with a new Preprocessor, in a loop build the Preprocessor once
+    """
+    return Preprocessor(observation_space, scaled_obs, type)(observation)
 
 
 def vis(pl, w, image, images1, images2):
@@ -0,0 +1,243 @@
+'''
+Ape-X style training on one machine: actor processes, each with its own epsilon, act on the weights
+that the learner publishes in shared memory tensors (refreshed every few steps, nothing is pickled).
+the actors send their transitions through a queue to the learner (the main process), which owns the
+replay memory (one stream per actor) and the optimizer and does gradient steps without waiting for the envs.
+with --inference_server the actors hold no model, their forwards are batched by a thread of the learner
+(see inference.py) that uses the current weights, so nothing is published.
+
+example:
+python run_agent.py --target BreakoutDeterministic-v4 --actors 6 --no_cuda
+'''
+import queue
+import logging
+import threading
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from . import evaluation
+from . import inference
+from . import resources
+
+logger = logging.getLogger(__name__)
+
+# steps an actor collects before sending them and checking for new weights
+ACTOR_CHUNK = 50
+
+
+def actor_epsilon(actor, num_actors, eps=0.4, alpha=7.):
+    """
+    epsilon of the actor: eps ** (1 + alpha * actor / (num_actors - 1)) as in Ape-X
+    """
+    if num_actors == 1:
+        return eps
+    return eps ** (1. + alpha * actor / (num_actors - 1.))
+
+
+class SharedWeights(object):
+    """
+    cpu copy of the weights in shared memory with a version counter,
+    the learner writes it with publish, the actors copy it with pull when the version changed
+    """
+    def __init__(self, models, lock):
+        self.tensors = {m: {k: v.detach().cpu().clone().share_memory_() for k, v in models[m].state_dict().items()}
+                        for m in models}
+        self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.lock = lock
+
+    def publish(self, models):
+        with self.lock:
+            for m in self.tensors:
+                for k, v in models[m].state_dict().items():
+                    self.tensors[m][k].copy_(v)
+            self.version += 1
+
+    def pull(self, models, version):
+        """
+        returns the version loaded in models
+        """
+        current = int(self.version.item())
+        if current != version:
+            with self.lock:
+                current = int(self.version.item())
+                for m in self.tensors:
+                    models[m].load_state_dict(self.tensors[m])
+        return current
+
+
+class ActorMemory(object):
+    """
+    memory of an actor: the transitions are sent to the learner every `chunk` steps and at the end of
+    an episode, then on_flush is called (to refresh the weights)
+    """
+    def __init__(self, actor, transitions, chunk, on_flush):
+        self.actor = actor
+        self.transitions = transitions
+        self.chunk = chunk
+        self.on_flush = on_flush
+        self.buffer = [[], [], [], [], []]
+
+    def add(self, obs, action, reward, notdone, step, extra_info=[]):
+        # do_rollout reuses the buffer of obs for the next frames
+        obs = np.array(obs, copy=True)
+        for b, v in zip(self.buffer, (obs, action, reward, notdone, step)):
+            b.append(v)
+        if len(self.buffer[0]) >= self.chunk or notdone == 0:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer[0]) > 0:
+            obs, action, reward, notdone, step = self.buffer
+            self.transitions.put(('transitions', self.actor, np.stack(obs), np.array(action),
+                                  np.array(reward, dtype=np.float32), np.array(notdone, dtype=np.float32),
+                                  np.array(step, dtype=np.int64)))
+            self.buffer = [[], [], [], [], []]
+        self.on_flush()
+
+    def empty(self):
+        pass
+
+    def sizemem(self):
+        return 0
+
+
+def _actor(actor, env_fn, params, observation_space, action_space, reward_range, weights, server_handle,
+           transitions, stop, seed):
+    resources.ResourcePlan(params).apply('actor', actor)
+    from . import torchagent
+    from . import agent_utils
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    config = evaluation.eval_config(params)
+    eps = actor_epsilon(actor, params['actors'])
+    config.pop('exp_decay', None)
+    config.update({'eps': eps, 'mineps': eps, 'linear_decay': 0.})
+    env = env_fn(params, seed)
+    if server_handle is not None:
+        agent = inference.InferenceClient(config, observation_space, action_space, server_handle, eps)
+
+        def sync():
+            pass
+    else:
+        agent = torchagent.deepQconv(observation_space, action_space, reward_range, config)
+        version = [weights.pull(agent.models, -1)]
+
+        def sync():
+            version[0] = weights.pull(agent.models, version[0])
+
+    agent.memory = ActorMemory(actor, transitions, ACTOR_CHUNK, sync)
+    logger.info('actor {} epsilon {:.4f}'.format(actor, eps))
+    episode = 0
+    while not stop.is_set():
+        total_rew, steps, total_rew_discount, _ = agent_utils.do_rollout(
+            agent, env, episode, num_steps=env.spec.max_episode_steps, useConv=agent.useConv,
+            discount=agent.config['discount'], learn=False)
+        transitions.put(('episode', actor, total_rew, steps, total_rew_discount))
+        episode += 1
+    env.close()
+
+
+def train(params, observation_space, action_space, reward_range, numavg=100, episode_callback=None):
+    """
+    params['actors'] actor processes and the learner in this process, stops after params['episodes']
+    actor episodes. returns the average reward of the last numavg episodes, the config, the rewards of all
+    the episodes and the (empty) test statistics like run.main
+    """
+    from . import torchagent
+    from . import run
+    num_actors = params['actors']
+    agent = torchagent.deepQconv(observation_space, action_space, reward_range, params)
+    if agent.config['policy']:
+        raise NotImplementedError('actors only for Q learning')
+    publish_every = params['publish_every'] if 'publish_every' in params else 50
+    base_seed = 0 if params['seed'] is None else params['seed']
+
+    ctx = mp.get_context('spawn')
+    if 'inference_server' in params and params['inference_server']:
+        server = inference.InferenceServer(agent, num_actors, ctx, max_latency=params['max_latency'],
+                                           dump_every=params['profile_every'])
+        weights = None
+        lock = server.lock
+        server.start()
+        logger.info('{} actors, batched inference in the learner (max latency {:.1f} ms)'.format(
+            num_actors, params['max_latency'] * 1000))
+    else:
+        server = None
+        weights = SharedWeights(agent.models, ctx.Lock())
+        lock = threading.Lock()
+        logger.info('{} actors, weights published every {} updates'.format(num_actors, publish_every))
+    transitions = ctx.Queue(maxsize=8 * num_actors)
+    stop = ctx.Event()
+    actors = [ctx.Process(target=_actor, args=(i, run.make_env, params, observation_space, action_space, reward_range,
+                                                weights, None if server is None else server.handle(i), transitions,
+                                                stop, (base_seed * 1000003 + i) % 2 ** 31),
+                          daemon=True)
+              for i in range(num_actors)]
+    for a in actors:
+        a.start()
+
+    timer = agent.timer
+    totrewlist = []
+    episode = 0
+    total_steps = 0
+    published = agent.config['num_updates']
+    stopped = False
+    try:
+        while episode < params['episodes'] and not stopped:
+            t0 = timer.tic()
+            for _ in range(num_actors):
+                # wait for data only when there is not enough to learn
+                wait = agent.memory.sizemem() <= agent.config['randstart']
+                try:
+                    msg = transitions.get(block=wait, timeout=1. if wait else None)
+                except queue.Empty:
+                    if not any(a.is_alive() for a in actors):
+                        raise Exception('all the actors died')
+                    break
+                if msg[0] == 'transitions':
+                    agent.memory.add_batch(*msg[1:])
+                    total_steps += len(msg[2])
+                    timer.count('env_steps', len(msg[2]))
+                    continue
+                _, actor, total_rew, steps, total_rew_discount = msg
+                episode += 1
+                totrewlist.append(total_rew / agent.config['scalereward'])
+                logger.info("episode {} actor {} steps {:6} reward {:.2f} disc_rew {:.2f} avg100 {:.2f} "
+                            "updates {:8} tot-steps {:8} lr {:.5f}".format(
+                                episode, actor, steps, total_rew / agent.config['scalereward'],
+                                total_rew_discount / agent.config['scalereward'], np.mean(totrewlist[-100:]),
+                                agent.config['num_updates'], total_steps, agent.getlearnrate()))
+                if agent.config["path_exp"] is not None and episode % 250 == 0:
+                    agent.config['final_episode'] = episode
+                    agent.save()
+                if episode_callback is not None and episode_callback(episode, totrewlist, [[], []]) is False:
+                    logger.info('training stopped by episode_callback at episode {}'.format(episode))
+                    stopped = True
+                    break
+            t0 = timer.toc('ingest', t0)
+            if agent.memory.sizemem() > agent.config['randstart']:
+                with lock:
+                    agent.learn(force=True)
+                if weights is not None and agent.config['num_updates'] - published >= publish_every:
+                    weights.publish(agent.models)
+                    published = agent.config['num_updates']
+                    timer.toc('publish', t0)
+            timer.maybe_dump()
+        timer.dump()
+    finally:
+        stop.set()
+        # the actors may be blocked on a full queue
+        try:
+            while True:
+                transitions.get(block=False)
+        except queue.Empty:
+            pass
+        for a in actors:
+            a.join(timeout=1)
+            if a.is_alive():
+                a.terminate()
+        if server is not None:
+            server.close()
+        agent.close()
+    return np.mean(totrewlist[-numavg:]), agent.config, totrewlist, [], [[], []]
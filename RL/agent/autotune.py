@@ -0,0 +1,225 @@
+'''
+throughput calibration of the dqn training loop: short measured bursts (warmup, then a fixed number of
+env steps with learning) over a grid of batch_size, probupdate, learner threads and num_envs, each in a
+new process. it reports env steps/s and updates/s of every setting, the pareto front of the two, and
+writes the recommended setting as an overlay of params for run.py --overlay.
+
+the bursts run against the env of the config (--target ...) or a synthetic stand-in with the same
+config (--synthetic SyntheticAtari-v0 --step_cost 0.001, see synthetic_envs.py), the arguments after --
+go to run.getparams. the grid defaults to the current value of every setting, except num_envs (1 2 4)
+and threads (1 and the cpus of the run).
+
+python -m agent.autotune --synthetic SyntheticAtari-v0 --step_cost 0.001 --batch_size 32 64 \\
+    --probupdate 0.25 1 --out breakout_tune.json -- --target BreakoutDeterministic-v4
+python run_agent.py --target BreakoutDeterministic-v4 --overlay breakout_tune.json
+'''
+import sys
+import time
+import json
+import tempfile
+import itertools
+import subprocess
+import argparse
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# tuned params and the name of their option
+SETTINGS = ['batch_size', 'probupdate', 'learner_threads', 'num_envs']
+OPTIONS = {'batch_size': 'batch_size', 'probupdate': 'probupdate', 'learner_threads': 'threads',
+           'num_envs': 'num_envs'}
+
+
+def burst_params(run_args, setting, synthetic=None, step_cost=0., warmup=500, memsize=50000):
+    """
+    params of a burst: the config of run_args with the setting, no outputs, and learning from the end of the warmup
+    """
+    from . import run
+    params = run.getparams(run_args)
+    params.update({'path_exp': None, 'name_exp': '', 'plot': False, 'render': False, 'monitor': False,
+                   'save_mem': False, 'record_every': 0, 'eval_workers': 0, 'actors': 0, 'learner_procs': 1})
+    params.update(setting)
+    params['memsize'] = min(params['memsize'], memsize)
+    params['randstart'] = min(params['randstart'], warmup // 2)
+    if synthetic is not None:
+        params.update({'target': synthetic, 'env_module': __package__ + '.synthetic_envs',
+                       'env_kwargs': {'step_cost': step_cost}, 'baseline_env': False})
+    return params
+
+
+def burst(params, steps, warmup=500, seed=0):
+    """
+    warmup env steps then steps env steps with learning, returns the throughput of the second part
+    """
+    import torch
+    from . import run
+    from . import agent_utils
+    from . import resources
+    from . import torchagent
+    from . import benchmark
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    threads = resources.ResourcePlan(params).apply('learner')
+    env = run.make_env(params, seed)
+    agent = torchagent.deepQconv(env.observation_space, env.action_space, env.reward_range, params)
+    if params['num_envs'] > 1:
+        rollout = agent_utils.VecRollout(agent, run.make_env(params, seed, num_envs=params['num_envs']),
+                                         useConv=agent.useConv, discount=agent.config['discount'])
+    max_steps = env.spec.max_episode_steps if env.spec is not None and env.spec.max_episode_steps else 10000
+    episode = [1]
+
+    def run_steps(n):
+        done_steps = 0
+        while done_steps < n:
+            if params['num_envs'] > 1:
+                rollout.step(episode[0])
+                done_steps += params['num_envs']
+            else:
+                _, t, _, _ = agent_utils.do_rollout(agent, env, episode[0], num_steps=min(max_steps, n - done_steps),
+                                                    useConv=agent.useConv, discount=agent.config['discount'])
+                done_steps += t
+                episode[0] += 1
+        return done_steps
+
+    try:
+        run_steps(warmup)
+        first_update = agent.config['num_updates']
+        start = time.perf_counter()
+        done_steps = run_steps(steps)
+        elapsed = time.perf_counter() - start
+    finally:
+        if params['num_envs'] > 1:
+            rollout.venv.close()
+        env.close()
+        agent.close()
+    updates = agent.config['num_updates'] - first_update
+    return {'steps': done_steps, 'updates': updates, 'seconds': elapsed, 'threads': threads,
+            'steps_per_s': done_steps / elapsed, 'updates_per_s': updates / elapsed,
+            'peak_rss_mb': benchmark.peak_rss_mb()}
+
+
+def pareto_front(results):
+    """
+    results not dominated in (steps_per_s, updates_per_s), by decreasing steps_per_s
+    """
+    front = []
+    for r in sorted(results, key=lambda r: (-r['steps_per_s'], -r['updates_per_s'])):
+        if not front or r['updates_per_s'] > front[-1]['updates_per_s']:
+            front.append(r)
+    return front
+
+
+def recommend(front, baseline, objective='balanced'):
+    """
+    env: the most env steps/s, updates: the most updates/s, balanced: the best worst-case speedup
+    over the baseline setting in the two rates
+    """
+    if objective == 'env':
+        return max(front, key=lambda r: (r['steps_per_s'], r['updates_per_s']))
+    if objective == 'updates':
+        return max(front, key=lambda r: (r['updates_per_s'], r['steps_per_s']))
+
+    def speedup(r):
+        rates = [r['steps_per_s'] / max(baseline['steps_per_s'], 1e-9)]
+        if baseline['updates_per_s'] > 0:
+            rates.append(r['updates_per_s'] / baseline['updates_per_s'])
+        return min(rates)
+    return max(front, key=speedup)
+
+
+def candidates(grid):
+    return [dict(zip(SETTINGS, values)) for values in itertools.product(*[grid[k] for k in SETTINGS])]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='throughput autotuner, the arguments after -- go to run.getparams')
+    parser.add_argument('--batch_size', type=int, nargs='*', default=None)
+    parser.add_argument('--probupdate', type=float, nargs='*', default=None)
+    parser.add_argument('--threads', type=int, nargs='*', default=None, help='torch threads of the learner')
+    parser.add_argument('--num_envs', type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument('--steps', type=int, default=2000, help='measured env steps per burst')
+    parser.add_argument('--warmup', type=int, default=500, help='env steps before the measure (learning starts)')
+    parser.add_argument('--synthetic', default=None, help='synthetic env with the config of the target')
+    parser.add_argument('--step_cost', type=float, default=0., help='seconds per step of the synthetic env')
+    parser.add_argument('--objective', default='balanced', choices=['balanced', 'env', 'updates'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='json overlay of the recommended setting for run.py --overlay')
+    parser.add_argument('--report', default=None, help='json of all the results')
+    parser.add_argument('--burst', default=None, help=argparse.SUPPRESS)
+    args = sys.argv[1:] if args is None else args
+    run_args = args[args.index('--') + 1:] if '--' in args else []
+    options = parser.parse_args(args[:args.index('--')] if '--' in args else args)
+    logging.basicConfig(level=logging.INFO)
+
+    if options.burst is not None:
+        # one burst in this process, the result goes to --out
+        params = burst_params(run_args, json.loads(options.burst), options.synthetic, options.step_cost,
+                              options.warmup)
+        with open(options.out, 'w') as f:
+            json.dump(burst(params, options.steps, options.warmup, options.seed), f)
+        return
+
+    from . import resources
+    params = burst_params(run_args, {}, options.synthetic, options.step_cost, options.warmup)
+    baseline = {k: params[k] for k in SETTINGS}
+    baseline['learner_threads'] = resources.ResourcePlan(params).threads('learner')
+    grid = {'batch_size': options.batch_size, 'probupdate': options.probupdate,
+            'learner_threads': options.threads, 'num_envs': options.num_envs}
+    grid['learner_threads'] = grid['learner_threads'] or sorted({1, baseline['learner_threads']})
+    for k in SETTINGS:
+        grid[k] = grid[k] or [baseline[k]]
+    if params['policy']:
+        # the vectorized rollout is only for Q learning
+        grid['num_envs'] = [1]
+    settings = candidates(grid)
+    if baseline not in settings:
+        settings.insert(0, dict(baseline))
+    logger.info('autotune of {} on {}: {} settings, {} env steps each'.format(
+        run_args, params['target'], len(settings), options.steps))
+
+    results = []
+    for setting in settings:
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            cmd = [sys.executable, '-m', __spec__.name, '--burst', json.dumps(setting), '--steps', str(options.steps),
+                   '--warmup', str(options.warmup), '--step_cost', str(options.step_cost), '--seed', str(options.seed),
+                   '--out', f.name]
+            if options.synthetic:
+                cmd += ['--synthetic', options.synthetic]
+            try:
+                subprocess.check_call(cmd + ['--'] + run_args, stdout=subprocess.DEVNULL)
+            except subprocess.CalledProcessError:
+                logger.warning('burst {} failed'.format(setting))
+                continue
+            result = dict(setting, **json.load(open(f.name)))
+        results.append(result)
+        logger.info('{}: {:.1f} env steps/s, {:.1f} updates/s'.format(setting, result['steps_per_s'],
+                                                                       result['updates_per_s']))
+    if len(results) == 0:
+        raise RuntimeError('all the bursts failed')
+
+    front = pareto_front(results)
+    measured_baseline = [r for r in results if all(r[k] == baseline[k] for k in SETTINGS)]
+    best = recommend(front, measured_baseline[0] if measured_baseline else results[0], options.objective)
+    overlay = {k: best[k] for k in SETTINGS}
+    print('{:>10} {:>10} {:>8} {:>8} {:>12} {:>12}'.format(*[OPTIONS[k] for k in SETTINGS] +
+                                                          ['steps/s', 'updates/s']))
+    for r in results:
+        print('{:>10} {:>10} {:>8} {:>8} {:>12.1f} {:>12.1f}{}'.format(
+            *[r[k] for k in SETTINGS] + [r['steps_per_s'], r['updates_per_s'],
+                                         ' *' if r is best else (' pareto' if r in front else '')]))
+    print('recommended overlay: ' + json.dumps(overlay))
+    if options.out:
+        with open(options.out, 'w') as f:
+            json.dump(overlay, f, indent=2)
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump({'target': params['target'], 'run_args': run_args, 'baseline': baseline,
+                       'objective': options.objective, 'results': results, 'pareto': front,
+                       'recommended': overlay}, f, indent=2)
+    return overlay
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+'''
+benchmarks of the hot path, the results are printed and written as json.
+
+python -m agent.benchmark preprocess --out preprocess.json
+python -m agent.benchmark rollout --steps 5000 --out rollout.json
+python -m agent.benchmark imports --check
+'''
+import os
+import sys
+import time
+import json
+import resource
+import platform
+import tempfile
+import subprocess
+import argparse
+import logging
+import numpy as np
+import gym
+import gym.spaces
+import cv2
+
+from . import agent_utils
+
+logger = logging.getLogger(__name__)
+
+
+def best_time(fn, repeat=3):
+    """
+    best wall time of repeat calls of fn
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def legacy_preprocess(observation, observation_space, scaled_obs, type):
+    # preprocessing before agent_utils.Preprocessor (resize before gray, new arrays), for comparison
+    if type == 'scale':
+        return cv2.cvtColor(cv2.resize(observation, (scaled_obs[1], scaled_obs[0]), interpolation=cv2.INTER_LINEAR),
+                            cv2.COLOR_BGR2GRAY)[None, ...]
+    elif type == 'crop':
+        resize_height = int(round(float(observation.shape[0]) * scaled_obs[1] / observation.shape[1]))
+        observation = cv2.cvtColor(cv2.resize(observation, (scaled_obs[1], resize_height),
+                                              interpolation=cv2.INTER_LINEAR), cv2.COLOR_BGR2GRAY)
+        crop_y_cutoff = resize_height - 8 - scaled_obs[0]
+        return observation[crop_y_cutoff:crop_y_cutoff + scaled_obs[0], :][None, ...]
+    elif type == 'rgb':
+        return np.moveaxis(cv2.resize(observation, (scaled_obs[1], scaled_obs[0]), interpolation=cv2.INTER_LINEAR),
+                           -1, 0)
+    elif type == 'flat':
+        o = (observation - observation_space.low) / (observation_space.high - observation_space.low) * 2. - 1.
+        return o.reshape(-1, )
+
+
+def bench_preprocess(frames=512, batch=8, repeat=3):
+    """
+    microseconds per frame of the scaling modes: legacy implementation, Preprocessor one frame at a time
+    and in batches of `batch` frames (vectorized envs)
+    """
+    rng = np.random.RandomState(0)
+    atari = gym.spaces.Box(0, 255, (210, 160, 3), dtype=np.uint8)
+    vector = gym.spaces.Box(-1., 1., (8,), dtype=np.float32)
+    cases = [('scale', atari, (84, 84, 1)), ('crop', atari, (84, 84, 1)), ('rgb', atari, (96, 96, 3)),
+             ('flat', vector, (8,))]
+    results = {}
+    for mode, space, scaled_obs in cases:
+        if space.dtype == np.uint8:
+            obs = rng.randint(0, 256, (frames,) + space.shape).astype(np.uint8)
+        else:
+            obs = rng.uniform(-1, 1, (frames,) + space.shape).astype(np.float32)
+        pre = agent_utils.Preprocessor(space, scaled_obs, type=mode)
+        out = np.empty((frames,) + pre.shape, dtype=pre.dtype)
+
+        def legacy():
+            for i in range(frames):
+                legacy_preprocess(obs[i], space, scaled_obs, mode)
+
+        def single():
+            for i in range(frames):
+                pre(obs[i], out[i])
+
+        def batched():
+            for i in range(0, frames, batch):
+                pre.batch(obs[i:i + batch], out[i:i + batch])
+
+        results[mode] = {name: best_time(fn, repeat) / frames * 1e6
+                         for name, fn in [('legacy', legacy), ('single', single), ('batch', batched)]}
+        logger.info('preprocess {} us/frame '.format(mode) + ' '.join(
+            '{} {:.2f}'.format(k, v) for k, v in results[mode].items()))
+    return {'benchmark': 'preprocess', 'unit': 'us_per_frame', 'frames': frames, 'batch': batch,
+            'results': results}
+
+
+# (config of default_params, synthetic env) pairs of the rollout benchmark
+ROLLOUT_CASES = [('BreakoutDeterministic-v4', 'SyntheticAtari-v0'),
+                 ('LunarLander-v2', 'SyntheticCartPole-v0'),
+                 ('CartPole-v0', 'SyntheticCartPole-v0')]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, in bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def bench_rollout(target, env_id, steps, step_cost=0., memsize=100000, seed=0, overrides=None):
+    """
+    do_rollout with learning for `steps` env steps of the synthetic env env_id under the config
+    of default_params for target (with memsize capped), on cpu
+    """
+    import torch
+    from . import default_params
+    from . import torchagent
+    from . import profiling
+    from . import synthetic_envs
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    params = default_params.get_default(target)
+    params.update({'path_exp': None, 'use_cuda': False, 'save_mem': False, 'plot': False, 'render': False,
+                   'monitor': False, 'logging': 'INFO', 'target': env_id, 'memsize': min(params['memsize'], memsize)})
+    if overrides:
+        params.update(overrides)
+    env = gym.make(env_id).unwrapped
+    env.step_cost = step_cost
+    env.seed(seed)
+    agent = torchagent.deepQconv(env.observation_space, env.action_space, env.reward_range, params)
+    agent.timer = profiling.PhaseTimer(window=steps)
+    max_steps = gym.envs.registry.spec(env_id).max_episode_steps
+    done_steps = 0
+    episodes = 0
+    start = time.perf_counter()
+    while done_steps < steps:
+        _, t, _, _ = agent_utils.do_rollout(agent, env, episodes + 1, num_steps=min(max_steps, steps - done_steps),
+                                            useConv=agent.useConv, discount=agent.config['discount'])
+        done_steps += t
+        episodes += 1
+    elapsed = time.perf_counter() - start
+    act = agent.timer.summary()['act']
+    agent.close()
+    return {'target': target, 'env': env_id, 'steps': done_steps, 'episodes': episodes, 'step_cost': step_cost,
+            'seconds': elapsed, 'steps_per_s': done_steps / elapsed,
+            'updates': agent.config['num_updates'], 'updates_per_s': agent.config['num_updates'] / elapsed,
+            'act_latency_ms': {k: act[k] * 1000. for k in ('mean', 'p50', 'p90', 'p99')},
+            'peak_rss_mb': peak_rss_mb()}
+
+
+# (seconds, MB of rss) budget of `import agent.<module>` in a fresh interpreter: torch, numpy and opencv
+# are loaded by the agent modules, tensorflow, baselines, gym envs and matplotlib are not
+IMPORT_BUDGETS = {'buffers': (0.5, 60),
+                  'agent_utils': (1., 120),
+                  'env_utils': (0.5, 60),
+                  'policy_runtime': (3., 600),
+                  'torchagent': (3., 600),
+                  'run': (5., 650)}
+# modules that none of the agent modules may load at import
+DEFERRED_MODULES = ['tensorflow', 'baselines', 'vel', 'matplotlib', 'mpi4py', 'numba', 'pybullet_envs',
+                    'roboschool', 'IPython']
+
+IMPORT_PROBE = '''
+import os, sys, time, json
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+base = rss()
+t0 = time.perf_counter()
+import importlib
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - t0
+print(json.dumps({'seconds': seconds, 'rss_mb': (rss() - base) / 1024. ** 2,
+                  'loaded': sorted(m for m in sys.argv[2].split(',') if m in sys.modules)}))
+'''
+
+
+def bench_imports(modules=None, repeat=3):
+    """
+    import time (best of repeat fresh interpreters) and rss added by `import agent.<module>`, against IMPORT_BUDGETS
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = package_root + os.pathsep + env.get('PYTHONPATH', '')
+    results = []
+    for module in modules or sorted(IMPORT_BUDGETS):
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE, __package__ + '.' + module,
+                                           ','.join(DEFERRED_MODULES)], env=env)
+            runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r['seconds'])
+        max_seconds, max_rss = IMPORT_BUDGETS.get(module, (None, None))
+        within = (max_seconds is None or best['seconds'] <= max_seconds) and \
+            (max_rss is None or best['rss_mb'] <= max_rss) and len(best['loaded']) == 0
+        results.append({'module': module, 'seconds': best['seconds'], 'rss_mb': best['rss_mb'],
+                        'deferred_loaded': best['loaded'], 'budget_seconds': max_seconds, 'budget_rss_mb': max_rss,
+                        'within_budget': within})
+    return {'benchmark': 'imports', 'results': results}
+
+
+def environment_info():
+    import torch
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        rev = None
+    return {'time': time.time(), 'git': rev, 'python': platform.python_version(), 'torch': torch.__version__,
+            'numpy': np.__version__, 'cpus': os.cpu_count(), 'threads': torch.get_num_threads()}
+
+
+def write_result(result, path):
+    print(json.dumps(result, indent=2))
+    if path:
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='benchmark')
+    p = sub.add_parser('preprocess', help='per-frame cost of the observation preprocessing')
+    p.add_argument('--frames', type=int, default=512)
+    p.add_argument('--batch', type=int, default=8)
+    p.add_argument('--out', default=None, help='json file for the results')
+    p = sub.add_parser('rollout', help='end-to-end do_rollout + learn throughput on the synthetic envs')
+    p.add_argument('--steps', type=int, default=5000)
+    p.add_argument('--step_cost', type=float, default=0., help='seconds of busy wait per env step')
+    p.add_argument('--memsize', type=int, default=100000, help='cap of the replay memory size')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--case', default=None, help='only the cases with this config target')
+    p.add_argument('--out', default=None, help='json file for the results')
+    p = sub.add_parser('imports', help='import time and rss of the agent modules against their budget')
+    p.add_argument('--modules', nargs='*', default=None, help='default: the modules of IMPORT_BUDGETS')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--check', action='store_true', help='exit code 1 if a module is over its budget')
+    p.add_argument('--out', default=None, help='json file for the results')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark == 'preprocess':
+        write_result(bench_preprocess(args.frames, args.batch), args.out)
+    elif args.benchmark == 'rollout':
+        # every case in a new process, so that the peak rss is its own
+        cases = [c for c in ROLLOUT_CASES if args.case is None or c[0] == args.case]
+        if len(cases) == 1:
+            results = [bench_rollout(cases[0][0], cases[0][1], args.steps, args.step_cost, args.memsize, args.seed)]
+        else:
+            results = []
+            for target, _ in cases:
+                with tempfile.NamedTemporaryFile(suffix='.json') as f:
+                    subprocess.check_call([sys.executable, '-m', __spec__.name, 'rollout', '--case', target,
+                                           '--steps', str(args.steps), '--step_cost', str(args.step_cost),
+                                           '--memsize', str(args.memsize), '--seed', str(args.seed), '--out', f.name],
+                                          stdout=subprocess.DEVNULL)
+                    results += json.load(open(f.name))['results']
+        write_result({'benchmark': 'rollout', 'info': environment_info(), 'results': results}, args.out)
+    elif args.benchmark == 'imports':
+        result = bench_imports(args.modules, args.repeat)
+        result['info'] = environment_info()
+        write_result(result, args.out)
+        over = [r['module'] for r in result['results'] if not r['within_budget']]
+        if over:
+            logger.warning('over the import budget: ' + ', '.join(over))
+            if args.check:
+                sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,13 +1,13 @@
-import gym
 import numpy as np
 import random
 import pickle
 import os
+import multiprocessing
 
 
 class ReplayMemory(object):
     def __init__(self, max_size, observation_dims, observation_dtype,
-                 action_space: gym.Space, history: int, discount, use_priority=False):
+                 action_space: 'gym.Space', history: int, discount, use_priority=False):
         assert len(list(observation_dims)) == 3 or len(list(observation_dims)) == 1
         if len(list(observation_dims)) == 3:
             assert observation_dims[2] == 1  # assuming 1 channel
@@ -43,6 +43,16 @@ class ReplayMemory(object):
             self.max_priority = 0.0000001
             self.priority = np.zeros(max_size) + self.max_priority
 
+    def share_memory(self):
+        """
+        move the arrays to shared memory, so that processes forked afterwards see the same data
+        """
+        for name in ['obs_mem', 'action_mem', 'reward_mem', 'notdone_mem', 'step_mem', 'step2end_mem', 'totalr_mem']:
+            arr = getattr(self, name)
+            shared = shared_zeros(arr.shape, arr.dtype)
+            shared[...] = arr
+            setattr(self, name, shared)
+
     def empty(self):
         self.last_ind = -1
         self.start_ind = -1
@@ -68,11 +78,17 @@ class ReplayMemory(object):
             # if min(item) < self.history:
             #    assert len(self.info_mem) <= self.last_ind + 1  # to check fixme (maybe used only in policy learning
             idx = (self.start_ind + idx_list + self.max_size) % self.max_size
+        else:
+            idx = (self.start_ind + item + self.max_size) % self.max_size
+        return self.gather(idx)
+
+    def gather(self, idx):
+        # idx: physical rows, with history the last column is the current step
+        if self.history > 0:
             val = [self.obs_mem[idx], self.action_mem[idx[:, -1]], self.reward_mem[idx[:, -1]],
                    self.notdone_mem[idx[:, -1]], self.step_mem[idx[:, -1]], self.totalr_mem[idx[:, -1]],
                    self.step2end_mem[idx[:, -1]]]
         else:
-            idx = (self.start_ind + item + self.max_size) % self.max_size
             val = [self.obs_mem[idx], self.action_mem[idx], self.reward_mem[idx],
                    self.notdone_mem[idx], self.step_mem[idx], self.totalr_mem[idx], self.step2end_mem[idx]]
         if self.reshape:
@@ -124,6 +140,9 @@ class ReplayMemory(object):
         self.reward_mem[self.last_ind] = reward
         self.notdone_mem[self.last_ind] = notdone
         self.step_mem[self.last_ind] = step
+        # the row may hold an overwritten transition
+        self.step2end_mem[self.last_ind] = 0
+        self.totalr_mem[self.last_ind] = 0.
         if len(self.info_mem) <= self.last_ind:
             self.info_mem.append(extra_info)
             # assert self.sizemem() == len(self.info_mem)
@@ -147,10 +166,235 @@ class ReplayMemory(object):
         assert len(self.curr_episode_idx) <= self.sizemem(), "{} {} {}".format(len(self.curr_episode_idx),
                                                                                self.last_ind, notdone)
 
+    def add_batch(self, obs, action, reward, notdone, step):
+        """
+        consecutive transitions (episodes can end and start inside the batch), as add for each of them but
+        with one write per array, the discounted returns and steps to the end are updated once per episode
+        """
+        n = len(reward)
+        if n > self.max_size:
+            for i in range(0, n, self.max_size):
+                self.add_batch(obs[i:i + self.max_size], action[i:i + self.max_size], reward[i:i + self.max_size],
+                               notdone[i:i + self.max_size], step[i:i + self.max_size])
+            return
+        reward = np.asarray(reward, dtype=np.float64).reshape(-1)
+        notdone = np.asarray(notdone).reshape(-1)
+        rows = (self.last_ind + 1 + np.arange(n)) % self.max_size
+        self.last_ind = int(rows[-1])
+        self.current_size = min(self.current_size + n, self.max_size)
+        if len(self.info_mem) < self.current_size:
+            self.info_mem.extend([[] for _ in range(self.current_size - len(self.info_mem))])
+        self.start_ind = 0 if self.current_size < self.max_size else (self.last_ind + 1) % self.max_size
+        self.obs_mem[rows] = obs.reshape((n,) + self.obs_mem.shape[1:])
+        self.action_mem[rows] = np.asarray(action).reshape((n,) + self.action_mem.shape[1:])
+        self.reward_mem[rows, 0] = reward
+        self.notdone_mem[rows, 0] = notdone
+        self.step_mem[rows, 0] = np.asarray(step).reshape(-1)
+        # one segment per episode, the first one continues the current episode
+        ends = np.nonzero(notdone == 0)[0] + 1
+        for i, (start, end) in enumerate(zip(np.concatenate([[0], ends]), np.concatenate([ends, [n]]))):
+            if start == end:
+                continue
+            seg = rows[start:end]
+            returns = discounted_sums(reward[start:end], self.discount)
+            self.totalr_mem[seg, 0] = returns
+            self.step2end_mem[seg, 0] = np.arange(end - start - 1, -1, -1)
+            if start == 0 and len(self.curr_episode_idx) > 0:
+                prev = self.curr_episode_idx
+                self.totalr_mem[prev, 0] += returns[0] * self.discount ** np.arange(len(prev), 0, -1)
+                self.step2end_mem[prev, 0] += end - start
+                seg = np.append(prev, seg)
+            self.curr_episode_idx = seg if notdone[end - 1] != 0 else np.array([], dtype=np.int64)
+        assert len(self.curr_episode_idx) <= self.sizemem(), "episode longer than memory"
+
     def sizemem(self):
         return self.current_size
 
 
+def discounted_sums(reward, discount, block=128):
+    """
+    sum over k >= j of discount ** (k - j) * reward[k] for every j, in blocks so that the powers stay representable
+    """
+    reward = np.asarray(reward, dtype=np.float64)
+    if discount == 0:
+        return reward.copy()
+    out = np.empty_like(reward)
+    carry = 0.
+    for end in range(len(reward), 0, -block):
+        start = max(0, end - block)
+        powers = discount ** np.arange(end - start)
+        out[start:end] = np.cumsum((reward[start:end] * powers)[::-1])[::-1] / powers + \
+            carry * discount ** np.arange(end - start, 0, -1)
+        carry = out[start]
+    return out
+
+
+class NullMemory(object):
+    """
+    memory that stores nothing, for agents that only act (e.g. evaluation workers)
+    """
+    def add(self, obs, action, reward, notdone, step, extra_info=[]):
+        pass
+
+    def empty(self):
+        pass
+
+    def sizemem(self):
+        return 0
+
+
+def shared_zeros(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = multiprocessing.RawArray('b', max(1, size * dtype.itemsize))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+class VecReplayMemory(ReplayMemory):
+    """
+    replay memory for num_envs environments stepped in lockstep: one ring buffer of max_size per env
+    (stored contiguously, so the history and the next state of a sample come from the same env).
+    indices are env * max_size + step, sizemem() is the total number of transitions
+    """
+    def __init__(self, num_envs, max_size, observation_dims, observation_dtype,
+                 action_space: 'gym.Space', history: int, discount):
+        super(VecReplayMemory, self).__init__(num_envs * max_size, observation_dims, observation_dtype,
+                                              action_space, history, discount)
+        self.num_envs = num_envs
+        self.max_size = max_size
+        self.env_offset = np.arange(num_envs) * max_size
+        self.curr_episode_idx = [np.array([], dtype=np.int64) for _ in range(num_envs)]
+
+    def empty(self):
+        super(VecReplayMemory, self).empty()
+        self.curr_episode_idx = [np.array([], dtype=np.int64) for _ in range(self.num_envs)]
+
+    def __getitem__(self, item):
+        if isinstance(item, int) or isinstance(item, np.int64):
+            item = np.array([item])
+        env, step = item // self.max_size, item % self.max_size
+        assert (step < self.current_size).all()
+        if self.history > 0:
+            step = np.maximum(0, step[:, None] + np.arange(-self.history, 1)[None, :])
+            env = env[:, None]
+        idx = env * self.max_size + (self.start_ind + step) % self.max_size
+        return self.gather(idx)
+
+    def sample(self, batch_size):
+        step = np.random.randint(0, self.current_size - 1, batch_size)
+        env = np.random.randint(0, self.num_envs, batch_size)
+        return env * self.max_size + step
+
+    def add(self, obs, action, reward, notdone, step, extra_info=[]):
+        raise NotImplementedError('use add_batch')
+
+    def add_batch(self, obs, action, reward, notdone, step):
+        """
+        one transition per env, all the arrays have num_envs as first dimension
+        """
+        self.last_ind = (self.last_ind + 1) % self.max_size
+        self.current_size = min(self.current_size + 1, self.max_size)
+        if self.current_size < self.max_size:
+            self.start_ind = 0
+        else:
+            self.start_ind = (self.last_ind + 1) % self.max_size
+        rows = self.env_offset + self.last_ind
+        self.obs_mem[rows] = obs.reshape((self.num_envs,) + self.obs_mem.shape[1:])
+        self.action_mem[rows] = np.asarray(action).reshape((self.num_envs,) + self.action_mem.shape[1:])
+        self.reward_mem[rows, 0] = reward
+        self.notdone_mem[rows, 0] = notdone
+        self.step_mem[rows, 0] = step
+        self.step2end_mem[rows, 0] = 0
+        self.totalr_mem[rows, 0] = 0.
+        # discounted return and steps to the end of the current episode of every env
+        for e in range(self.num_envs):
+            self.step2end_mem[self.curr_episode_idx[e]] += 1
+            idx = np.append(self.curr_episode_idx[e], rows[e])
+            self.totalr_mem[idx, 0] += reward[e] * self.discount ** np.arange(len(idx) - 1, -1, -1)
+            if notdone[e] == 0:
+                idx = np.array([], dtype=np.int64)
+            assert len(idx) <= self.current_size, "episode longer than memory"
+            self.curr_episode_idx[e] = idx
+
+    def sizemem(self):
+        return self.current_size * self.num_envs
+
+
+class StreamReplayMemory(object):
+    """
+    one ReplayMemory of max_size per stream (e.g. per actor process), the streams are filled independently.
+    indices are stream * max_size + step, the streams are sampled in proportion to their size
+    """
+    def __init__(self, num_streams, max_size, observation_dims, observation_dtype,
+                 action_space: 'gym.Space', history: int, discount):
+        self.max_size = max_size
+        self.streams = [ReplayMemory(max_size, observation_dims, observation_dtype, action_space, history, discount)
+                        for _ in range(num_streams)]
+
+    def share_memory(self):
+        for m in self.streams:
+            m.share_memory()
+
+    def empty(self):
+        for m in self.streams:
+            m.empty()
+
+    def add_batch(self, stream, obs, action, reward, notdone, step):
+        """
+        consecutive transitions of one stream
+        """
+        self.streams[stream].add_batch(obs, action, reward, notdone, step)
+
+    def sample(self, batch_size):
+        sizes = np.array([max(0, m.sizemem() - 1) for m in self.streams])
+        stream = np.random.choice(len(sizes), batch_size, p=sizes / float(sizes.sum()))
+        step = (np.random.random(batch_size) * sizes[stream]).astype(np.int64)
+        return stream * self.max_size + step
+
+    def __getitem__(self, item):
+        if isinstance(item, int) or isinstance(item, np.int64):
+            item = np.array([item])
+        stream, step = item // self.max_size, item % self.max_size
+        val = None
+        for s in np.unique(stream):
+            sel = np.nonzero(stream == s)[0]
+            part = self.streams[s][step[sel]]
+            if val is None:
+                val = [np.empty((len(item),) + p.shape[1:], dtype=p.dtype) for p in part]
+            for v, p in zip(val, part):
+                v[sel] = p
+        return val
+
+    def sizemem(self):
+        return sum(m.sizemem() for m in self.streams)
+
+
+class TaskReplayMemory(StreamReplayMemory):
+    """
+    one ReplayMemory of max_size per task: add writes into the selected task (self.task), a batch has the
+    same number of transitions of every task with data (the remainder from random tasks)
+    """
+    def __init__(self, num_tasks, max_size, observation_dims, observation_dtype,
+                 action_space: 'gym.Space', history: int, discount):
+        super(TaskReplayMemory, self).__init__(num_tasks, max_size, observation_dims, observation_dtype,
+                                               action_space, history, discount)
+        self.task = 0
+
+    def add(self, obs, action, reward, notdone, step, extra_info=[]):
+        self.streams[self.task].add(obs, action, reward, notdone, step)
+
+    def sample(self, batch_size):
+        sizes = np.array([max(0, m.sizemem() - 1) for m in self.streams])
+        tasks = np.nonzero(sizes)[0]
+        task = np.concatenate([np.repeat(tasks, batch_size // len(tasks)),
+                               np.random.choice(tasks, batch_size % len(tasks), replace=False)])
+        step = (np.random.random(batch_size) * sizes[task]).astype(np.int64)
+        return task * self.max_size + step
+
+    def task_of(self, item):
+        return item // self.max_size
+
+
 def save_zipped_pickle(obj, filename, zip=False, protocol=-1):
     with open(filename, 'wb') as f:
         pickle.dump(obj, f, protocol)
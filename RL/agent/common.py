@@ -41,6 +41,15 @@ def checkparams(params):
             return False,"policy with copyQ/doubleQ not allowed"
     return True,""
 
+def limit_threads(num_threads):
+    """
+    limit the threads used by torch, opencv and the BLAS/OpenMP libraries of this process,
+    see resources.ResourcePlan for the threads of the processes of a run
+    """
+    from . import resources
+    resources.set_threads(num_threads)
+
+
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
@@ -4,47 +4,18 @@ import sys
 import re
 import multiprocessing
 import os.path as osp
-import gym
 from collections import defaultdict
-import tensorflow as tf
 import numpy as np
 
-from baselines.common.vec_env import VecFrameStack, VecNormalize, VecEnv
-from baselines.common.vec_env.vec_video_recorder import VecVideoRecorder
-from baselines.common.cmd_util import common_arg_parser, parse_unknown_args, make_vec_env, make_env
-from baselines.common.tf_util import get_session
-from baselines import logger
-from importlib import import_module
-
-from vel.rl.vecenv.subproc import SubprocVecEnvWrapper
-from vel.rl.vecenv.dummy import DummyVecEnvWrapper
-from vel.rl.env.classic_atari import ClassicAtariEnv
-
-try:
-    from mpi4py import MPI
-except ImportError:
-    MPI = None
-
-try:
-    import pybullet_envs
-except ImportError:
-    pybullet_envs = None
-
-try:
-    import roboschool
-except ImportError:
-    roboschool = None
-
-_game_envs = defaultdict(set)
-for env in gym.envs.registry.all():
-    # TODO: solve this with regexes
-    env_type = env.entry_point.split(':')[0].split('.')[-1]
-    _game_envs[env_type].add(env.id)
+# baselines, tensorflow, the optional env packages (pybullet, roboschool) and the registry scan are loaded
+# at the first build_env / get_env_type: importing this module (e.g. for ShmVecEnv) stays cheap
+
+_game_envs = None
 
 # reading benchmark names directly from retro requires
 # importing retro here, and for some reason that crashes tensorflow
 # in ubuntu
-_game_envs['retro'] = {
+_retro_envs = {
     'BubbleBobble-Nes',
     'SuperMarioBros-Nes',
     'TwinBee3PokoPokoDaimaou-Nes',
@@ -56,10 +27,37 @@ _game_envs['retro'] = {
 }
 
 
+def import_optional_envs():
+    # these packages register their envs in gym when imported
+    for name in ['pybullet_envs', 'roboschool']:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def game_envs():
+    """
+    env ids by env type (the module of the entry point), from the gym registry
+    """
+    global _game_envs
+    import gym
+    if _game_envs is None:
+        import_optional_envs()
+        _game_envs = defaultdict(set)
+        _game_envs['retro'] = set(_retro_envs)
+    for env in gym.envs.registry.all():
+        # TODO: solve this with regexes
+        env_type = env.entry_point.split(':')[0].split('.')[-1]
+        _game_envs[env_type].add(env.id)  # This is a set so add is idempotent
+    return _game_envs
+
 
 def build_env(env_id, env_type=None, num_env=1, batch=False, seed=None, reward_scale=1.0,
               gamestate=None, frame_stack=False,logger_dir=None):
     #ncpu = multiprocessing.cpu_count()
+    from baselines.common.vec_env import VecFrameStack, VecNormalize
+    from baselines.common.cmd_util import make_vec_env, make_env
 
     env_type, env_id = get_env_type(env_id, env_type)
 
@@ -78,14 +76,175 @@ def build_env(env_id, env_type=None, num_env=1, batch=False, seed=None, reward_s
         env = VecNormalize(env, use_tf=False)
     return env
 
+class SerialVecEnv(object):
+    """
+    VecEnv api (batched observations, finished envs are reset in step) over gym envs stepped
+    one after the other in the current process
+    """
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.reward_range = self.envs[0].reward_range
+        self.spec = self.envs[0].spec
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        obs, rewards, dones, infos = [], [], [], []
+        for env, a in zip(self.envs, actions):
+            o, r, d, info = env.step(a)
+            if d:
+                o = env.reset()
+            obs.append(o)
+            rewards.append(r)
+            dones.append(d)
+            infos.append(info)
+        return np.stack(obs), np.array(rewards), np.array(dones), infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def _shm_view(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _shm_worker(env_fn, index, conn, arrays, obs_shape, obs_dtype, preprocess, frame_skip, resources):
+    from . import agent_utils
+    if resources is not None:
+        resources.apply('env_worker', index)
+    env = env_fn()
+    obs = _shm_view(arrays[0], obs_shape, obs_dtype)
+    rewards = _shm_view(arrays[1], obs_shape[:1], np.float64)
+    dones = _shm_view(arrays[2], obs_shape[:1], np.bool_)
+    actions = _shm_view(arrays[3], obs_shape[:1], np.int64)
+    if preprocess is not None:
+        scaled_obs, scaling = preprocess
+        if scaled_obs is None:
+            scaled_obs = env.observation_space.shape
+        preprocessor = agent_utils.Preprocessor(env.observation_space, scaled_obs, type=scaling)
+
+    def write(o):
+        if preprocess is not None:
+            # straight into the shared array
+            preprocessor(o, obs[index])
+        else:
+            obs[index] = o
+
+    try:
+        while True:
+            cmd = conn.recv()
+            if cmd == 'step':
+                total_r = 0.
+                for _ in range(frame_skip):
+                    o, r, d, info = env.step(actions[index])
+                    total_r += r
+                    if d:
+                        break
+                if d:
+                    o = env.reset()
+                write(o)
+                rewards[index] = total_r
+                dones[index] = d
+                conn.send(info)
+            elif cmd == 'reset':
+                write(env.reset())
+                conn.send(None)
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+
+
+class ShmVecEnv(object):
+    """
+    VecEnv api over worker processes (one env each) that write observations, rewards and done flags
+    into shared memory arrays, the pipes only carry the command and the info dict.
+    preprocess=(scaled_obs, scaling) runs agent_utils.preprocess in the workers (scaled_obs None: the
+    observation shape), so the main process sees only the preprocessed frames,
+    frame_skip repeats every action and sums the rewards,
+    resources (a resources.ResourcePlan) sets the threads and cpus of the workers.
+    env_fns have to be picklable (e.g. functools.partial) with the spawn context
+    """
+    def __init__(self, env_fns, preprocess=None, frame_skip=1, context='spawn', resources=None):
+        from . import agent_utils
+        ctx = multiprocessing.get_context(context)
+        self.num_envs = len(env_fns)
+        # spaces and the shape of a (preprocessed) observation from a probe env
+        env = env_fns[0]()
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        self.reward_range = env.reward_range
+        self.spec = env.spec
+        sample = np.zeros(env.observation_space.shape, dtype=env.observation_space.dtype)
+        if preprocess is not None:
+            scaled_obs = env.observation_space.shape if preprocess[0] is None else preprocess[0]
+            preprocessor = agent_utils.Preprocessor(env.observation_space, scaled_obs, type=preprocess[1])
+            sample = np.zeros(preprocessor.shape, dtype=preprocessor.dtype)
+        env.close()
+        self.preprocessed = preprocess is not None
+
+        obs_shape = (self.num_envs,) + sample.shape
+        self.arrays = [ctx.RawArray('b', int(np.prod(obs_shape)) * sample.dtype.itemsize)] + \
+                      [ctx.RawArray('b', self.num_envs * np.dtype(t).itemsize) for t in (np.float64, np.bool_, np.int64)]
+        self.obs = _shm_view(self.arrays[0], obs_shape, sample.dtype)
+        self.rewards = _shm_view(self.arrays[1], obs_shape[:1], np.float64)
+        self.dones = _shm_view(self.arrays[2], obs_shape[:1], np.bool_)
+        self.actions = _shm_view(self.arrays[3], obs_shape[:1], np.int64)
+        self.conns = []
+        self.workers = []
+        for i, env_fn in enumerate(env_fns):
+            conn, worker_conn = ctx.Pipe()
+            w = ctx.Process(target=_shm_worker, args=(env_fn, i, worker_conn, self.arrays, obs_shape, sample.dtype,
+                                                      preprocess, frame_skip, resources), daemon=True)
+            w.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.workers.append(w)
+        self.closed = False
+
+    def reset(self):
+        for conn in self.conns:
+            conn.send('reset')
+        for conn in self.conns:
+            conn.recv()
+        return self.obs.copy()
+
+    def step_async(self, actions):
+        self.actions[:] = actions
+        for conn in self.conns:
+            conn.send('step')
+
+    def step_wait(self):
+        infos = [conn.recv() for conn in self.conns]
+        return self.obs.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.conns:
+            conn.send('close')
+        for w in self.workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+
+
 def get_env_type(env_id, env_type):
     if env_type is not None:
         return env_type, env_id
 
     # Re-parse the gym registry, since we could have new envs since last time.
-    for env in gym.envs.registry.all():
-        env_type = env.entry_point.split(':')[0].split('.')[-1]
-        _game_envs[env_type].add(env.id)  # This is a set so add is idempotent
+    _game_envs = game_envs()
 
     if env_id in _game_envs.keys():
         env_type = env_id
@@ -105,6 +264,9 @@ def get_env_type(env_id, env_type):
 
 if __name__ == '__main__':
     import cv2
+    import gym
+    from vel.rl.vecenv.subproc import SubprocVecEnvWrapper
+    from vel.rl.env.classic_atari import ClassicAtariEnv
     import matplotlib.pyplot as plt
     import matplotlib.image as mpimg
 
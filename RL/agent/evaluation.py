@@ -0,0 +1,141 @@
+'''
+greedy test episodes in a pool of worker processes.
+the training loop submits a snapshot of the weights and keeps training,
+the results are collected with poll() when they are ready.
+the snapshot goes once to every worker (its weights queue), the episodes are (tag, seed) tasks.
+'''
+import io
+import copy
+import queue
+import logging
+import multiprocessing
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(models):
+    """
+    serialized cpu copy of the weights (done once per evaluation, sent once to every worker)
+    """
+    buffer = io.BytesIO()
+    torch.save({m: {k: v.cpu() for k, v in models[m].state_dict().items()} for m in models}, buffer)
+    return buffer.getvalue()
+
+
+def eval_config(params):
+    config = copy.deepcopy(params)
+    config.update({'path_exp': None, 'use_cuda': False, 'save_mem': False, 'profile': False,
+                   'learner_procs': 1, 'num_envs': 1, 'actors': 0, 'memsize': max(2, config['past'] + 2)})
+    return config
+
+
+def _worker(index, env_fn, params, observation_space, action_space, reward_range, tasks, weights_queue, results):
+    from . import torchagent
+    from . import agent_utils
+    from . import buffers
+    from . import resources
+    resources.ResourcePlan(params).apply('eval_worker', index)
+    env = env_fn(params)
+    agent = torchagent.deepQconv(observation_space, action_space, reward_range, eval_config(params))
+    agent.memory = buffers.NullMemory()
+    num_steps = env.spec.max_episode_steps
+    weights_tag = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        tag, seed = task
+        try:
+            if tag != weights_tag:
+                # the snapshots come in the order of the submits, the ones of evaluations without episodes
+                # in this worker are skipped
+                weights_tag, weights = weights_queue.get()
+                while weights_tag != tag:
+                    weights_tag, weights = weights_queue.get()
+                state = torch.load(io.BytesIO(weights))
+                for m in state:
+                    agent.models[m].load_state_dict(state[m])
+            env.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            total_rew, steps, total_rew_discount, _ = agent_utils.do_rollout(
+                agent, env, -1, num_steps=num_steps, useConv=agent.useConv, discount=agent.config['discount'],
+                learn=False)
+            results.put((tag, seed, total_rew, steps, None))
+        except Exception as e:
+            results.put((tag, seed, None, 0, repr(e)))
+    env.close()
+
+
+class EvalPool(object):
+    def __init__(self, env_fn, params, observation_space, action_space, reward_range, num_workers,
+                 base_seed=None):
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.base_seed = 0 if base_seed is None else base_seed
+        self.weights = [ctx.Queue() for _ in range(num_workers)]
+        self.pending = {}
+        self.workers = [ctx.Process(target=_worker, args=(i, env_fn, params, observation_space, action_space,
+                                                          reward_range, self.tasks, self.weights[i], self.results),
+                                    daemon=True)
+                        for i in range(num_workers)]
+        for w in self.workers:
+            w.start()
+        logger.info('evaluation pool with {} workers'.format(num_workers))
+
+    def submit(self, tag, models, num_episodes):
+        """
+        evaluate the current weights on num_episodes seeded episodes, tag identifies the evaluation (episode)
+        """
+        weights = snapshot(models)
+        # before the tasks: a worker waits for the weights of the tag of its task
+        for weights_queue in self.weights:
+            weights_queue.put((tag, weights))
+        for i in range(num_episodes):
+            seed = (self.base_seed * 1000003 + tag * 1000 + i) % 2 ** 31
+            self.tasks.put((tag, seed))
+        self.pending[tag] = {'num': num_episodes, 'rewards': []}
+
+    def _collect(self, block):
+        done = []
+        while len(self.pending) > 0:
+            try:
+                tag, seed, total_rew, steps, error = self.results.get(block=block, timeout=1. if block else None)
+            except queue.Empty:
+                if block and any(w.is_alive() for w in self.workers):
+                    continue
+                break
+            if error is not None:
+                logger.error('evaluation {} seed {} failed: {}'.format(tag, seed, error))
+                self.pending[tag]['num'] -= 1
+            else:
+                self.pending[tag]['rewards'].append(total_rew)
+            if len(self.pending[tag]['rewards']) >= self.pending[tag]['num']:
+                done.append((tag, self.pending.pop(tag)['rewards']))
+        return done
+
+    def poll(self):
+        """
+        finished evaluations as a list of (tag, rewards), never blocks
+        """
+        return self._collect(block=False)
+
+    def wait(self):
+        """
+        wait for all the submitted evaluations
+        """
+        return self._collect(block=True)
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join(timeout=10)
+            if w.is_alive():
+                w.terminate()
+        # the snapshots not read by a worker are dropped instead of waiting for the pipe at exit
+        for weights_queue in self.weights:
+            weights_queue.cancel_join_thread()
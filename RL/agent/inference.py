@@ -0,0 +1,121 @@
+'''
+batched inference for the actors of the apex mode: the actors do not hold a model,
+they write their observation in a shared memory slot and send the slot number to the server,
+a thread of the learner process that runs one forward for all the pending observations
+(waiting at most max_latency after the first one) on the current weights of the learner,
+and sends the Q values back through a pipe.
+the queueing latency, forward time and batch size are logged (and written to <path_exp>_inference.jsonl).
+'''
+import time
+import queue
+import logging
+import threading
+import numpy as np
+
+from . import profiling
+from .agent_utils import Preprocessor
+
+logger = logging.getLogger(__name__)
+
+
+def shared_view(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class InferenceServer(object):
+    def __init__(self, agent, num_actors, ctx, max_batch=None, max_latency=0.002, dump_every=60.):
+        if agent.encoder is not None:
+            raise NotImplementedError('the inference server does not support the encoder')
+        self.agent = agent
+        # held by the server during a forward and by the learner during a gradient step
+        self.lock = threading.Lock()
+        self.max_batch = num_actors if max_batch is None else max_batch
+        self.max_latency = max_latency
+        self.shape = (num_actors,) + agent.input_shape
+        if agent.useConv and agent.memory_dtype == np.uint8:
+            self.dtype = np.dtype(np.uint8)
+        else:
+            self.dtype = np.dtype(np.float32)
+        self.raw = ctx.RawArray('b', int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.obs = shared_view(self.raw, self.shape, self.dtype)
+        self.requests = ctx.Queue()
+        pipes = [ctx.Pipe(duplex=False) for _ in range(num_actors)]
+        self.client_conns = [r for r, _ in pipes]
+        self.conns = [w for _, w in pipes]
+        path = agent.config['path_exp'] + '_inference.jsonl' if agent.config['path_exp'] else None
+        self.timer = profiling.PhaseTimer(path, dump_every=dump_every)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def handle(self, slot):
+        """
+        what an actor process needs to build its InferenceClient
+        """
+        return self.raw, self.shape, self.dtype, slot, self.requests, self.client_conns[slot]
+
+    def start(self):
+        self.thread.start()
+
+    def serve(self):
+        timer = self.timer
+        while not self.stopped:
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = batch[0][1] + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            t0 = timer.tic()
+            for _, sent in batch:
+                timer.toc('queue', sent)
+            slots = [slot for slot, _ in batch]
+            with self.lock:
+                qval = self.agent.qvalues(self.obs[slots])
+            timer.toc('forward', t0)
+            timer.observe('batch_size', len(batch))
+            for slot, q in zip(slots, qval):
+                self.conns[slot].send(q)
+            timer.maybe_dump()
+
+    def close(self):
+        self.stopped = True
+        self.thread.join(timeout=1)
+        self.timer.dump()
+
+
+class InferenceClient(object):
+    """
+    stands for the agent in agent_utils.do_rollout in an actor process: epsilon greedy actions
+    with the Q values from the server (the random actions do not go to the server)
+    """
+    def __init__(self, config, observation_space, action_space, handle, epsilon):
+        raw, shape, dtype, self.slot, self.requests, self.conn = handle
+        self.obs = shared_view(raw, shape, dtype)
+        self.config = config
+        self.observation_space = observation_space
+        self.action_space = action_space
+        self.scaled_obs = config['dimdobs'] if 'dimdobs' in config else observation_space.shape
+        self.preprocessor = Preprocessor(observation_space, self.scaled_obs,
+                                         type=config['scaling'] if 'scaling' in config else 'none')
+        self.useConv = config['conv']
+        self.encoder = None
+        self.eps = epsilon
+        self.timer = profiling.NullTimer()
+        self.memory = None
+
+    def evalQ(self, observation):
+        self.obs[self.slot] = observation.reshape(self.obs.shape[1:])
+        self.requests.put((self.slot, time.perf_counter()))
+        return self.conn.recv()[None, :]
+
+    def act(self, observation, episode=None, update_state=False):
+        if np.random.random() > self.eps:
+            return int(np.argmax(self.evalQ(observation)))
+        return self.action_space.sample()
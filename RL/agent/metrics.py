@@ -0,0 +1,151 @@
+'''
+append-only metrics of a run: the training loop logs one record per episode / test / checkpoint
+(a dict with 'kind' and 'time') into a buffer that is appended to <path_exp>_metrics.jsonl every
+flush_every seconds, nothing grows in memory and nothing is redrawn in the training process.
+
+the plots are made from the file, by a separate process while the run goes on (run.py --plot) or offline:
+python -m agent.metrics out_dir/breakout_metrics.jsonl --out breakout_reward.png
+python -m agent.metrics out_dir/breakout_metrics.jsonl --follow 10 --show
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+
+class MetricsSink(object):
+    """
+    buffered jsonl writer, with path None the records are dropped
+    """
+    def __init__(self, path, flush_every=10., max_buffer=1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def log(self, kind, **values):
+        if self.path is None:
+            return
+        record = {'kind': kind, 'time': round(time.time(), 3)}
+        record.update(values)
+        self.buffer.append(json.dumps(record))
+        if len(self.buffer) >= self.max_buffer or time.time() - self.last_flush > self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+
+def read_records(path, offset=0):
+    """
+    records appended after byte offset (a partial last line is left for the next call) and the new offset
+    """
+    if not os.path.exists(path):
+        return [], offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = [json.loads(line) for line in data[:end].decode().splitlines() if line]
+    return records, offset + end
+
+
+class RewardPlot(object):
+    """
+    training rewards, average of the last 100, test rewards and their smoothed average (as deepQconv.plot)
+    """
+    def __init__(self, reward_threshold=None):
+        self.reward_threshold = reward_threshold
+        self.episodes, self.rewards = [], []
+        self.test_episodes, self.test_rewards, self.test_smooth = [], [], []
+
+    def add(self, records):
+        for r in records:
+            if r['kind'] == 'episode':
+                self.episodes.append(r['episode'])
+                self.rewards.append(r['reward'])
+            elif r['kind'] == 'test':
+                self.test_episodes.append(r['episode'])
+                self.test_rewards.append(r['reward'])
+                self.test_smooth.append(r['smooth'])
+            elif r['kind'] == 'start' and self.reward_threshold is None:
+                self.reward_threshold = r.get('reward_threshold')
+
+    def draw(self, plt, title=None):
+        plt.clf()
+        if len(self.rewards) == 0:
+            return
+        plt.plot(self.episodes, self.rewards, color='red', linewidth=0.5)
+        if len(self.rewards) >= 100:
+            avg = np.convolve(self.rewards, np.ones(100) / 100., mode='valid')
+            plt.plot(self.episodes[99:], avg, color='black')
+        if self.reward_threshold is not None:
+            plt.axhline(self.reward_threshold, color='green')
+        if self.test_episodes:
+            plt.scatter(self.test_episodes, self.test_rewards, color='black', s=4)
+            plt.plot(self.test_episodes, self.test_smooth, color='cyan')
+        plt.xlabel('episode')
+        plt.ylabel('reward')
+        if title:
+            plt.title(title, fontsize=8)
+
+
+def start_plotter(path, out=None, show=False, every=10.):
+    """
+    plot process following the metrics file, it stops after the 'end' record
+    """
+    args = [sys.executable, '-m', __name__, path, '--follow', str(every)]
+    if out is not None:
+        args += ['--out', out]
+    if show:
+        args.append('--show')
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = package_root + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(args, env=env)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='plot of the metrics of a run')
+    parser.add_argument('path', help='<path_exp>_metrics.jsonl')
+    parser.add_argument('--out', default=None, help='png file')
+    parser.add_argument('--follow', type=float, default=0., help='seconds between updates while the run goes on')
+    parser.add_argument('--show', action='store_true', help='interactive window')
+    parser.add_argument('--threshold', type=float, default=None, help='reward threshold line')
+    args = parser.parse_args(args)
+    import matplotlib
+    if not args.show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if args.show:
+        plt.ion()
+    plot = RewardPlot(args.threshold)
+    offset = 0
+    while True:
+        records, offset = read_records(args.path, offset)
+        plot.add(records)
+        finished = any(r['kind'] == 'end' for r in records)
+        if records or finished:
+            plot.draw(plt, os.path.basename(args.path))
+            if args.out:
+                plt.savefig(args.out, dpi=100)
+            if args.show:
+                plt.pause(0.001)
+        if args.follow <= 0 or finished:
+            break
+        time.sleep(args.follow)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
@@ -64,7 +65,12 @@ class DenseNet(nn.Module):
 
 # TODO add batch_norm
 class ConvNet(nn.Module):
-    def __init__(self, convlayers, input_shape, scale=1.0, activation='relu', batch_norm=False,init_weight=True):
+    """
+    accepts uint8 frames: the cast to float and the scaling are done as first op.
+    with channels_last the conv stack runs in NHWC memory format
+    """
+    def __init__(self, convlayers, input_shape, scale=1.0, activation='relu', batch_norm=False,init_weight=True,
+                 channels_last=False):
         super(ConvNet, self).__init__()
         self.conv = []
         self.bn = []
@@ -83,16 +89,90 @@ class ConvNet(nn.Module):
             self.bn = nn.ModuleList(self.bn)
         if init_weight:
             reset_weights(self)
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
-        x = x * self.scale
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = x.float() * self.scale
         for i,c in enumerate(self.conv):
             x = c(x)
             if self.batch_norm:
                 x = self.bn[i](x)
             x = self.act(x)
-        x = x.view(x.shape[0], -1)
+        x = x.reshape(x.shape[0], -1)
         return x
 
+class MultiHead(nn.Module):
+    """
+    one head per task over the same features. forward(x) uses the head of the selected task (self.task),
+    forward(x, task) with a tensor of task ids returns (batch, max outputs) with -inf in the outputs
+    that the head of the sample does not have
+    """
+    def __init__(self, heads, num_outputs):
+        super(MultiHead, self).__init__()
+        self.heads = nn.ModuleList(heads)
+        self.num_outputs = list(num_outputs)
+        self.task = 0
+
+    def forward(self, x, task=None):
+        if task is None:
+            return self.heads[self.task](x)
+        out = x.new_full((x.shape[0], max(self.num_outputs)), float('-inf'))
+        for t, head in enumerate(self.heads):
+            sel = torch.nonzero(task == t)[:, 0]
+            if len(sel) > 0:
+                out[sel, :self.num_outputs[t]] = head(x[sel])
+        return out
+
+
+class FrozenEncoder(nn.Module):
+    """
+    wraps a pretrained encoder (e.g. autoencoders.cnn_autoencoders.Encoder) and returns its latent code.
+    if the module has encoding+conv_enc (as Encoder) only that path is used, otherwise module(x).
+    the input is normalized as ((x * scale) - mean) / std, the weights are never trained
+    """
+    def __init__(self, encoder, scale=1. / 255., mean=0.5, std=0.5):
+        super(FrozenEncoder, self).__init__()
+        self.encoder = encoder
+        self.scale = scale
+        self.mean = mean
+        self.std = std
+        for p in self.encoder.parameters():
+            p.requires_grad = False
+        self.eval()
+
+    def train(self, mode=True):
+        # always in eval mode (frozen batch/instance norm statistics)
+        return super(FrozenEncoder, self).train(False)
+
+    def forward(self, x):
+        x = (x.float() * self.scale - self.mean) / self.std
+        with torch.no_grad():
+            if hasattr(self.encoder, 'encoding') and hasattr(self.encoder, 'conv_enc'):
+                x = self.encoder.conv_enc(self.encoder.encoding(x))
+            else:
+                x = self.encoder(x)
+        return x.reshape(x.shape[0], -1)
+
+
+def load_encoder(path, device=None):
+    """
+    load a frozen encoder saved with torch.jit.save or torch.save(module)
+    (for the second, the module class has to be importable)
+    """
+    try:
+        return torch.jit.load(path, map_location=device)
+    except RuntimeError:
+        pass
+    try:
+        return torch.load(path, map_location=device, weights_only=False)
+    except TypeError:  # older torch without weights_only
+        return torch.load(path, map_location=device)
+
+
 # todo remove
 # from vel/vel/rl/models/backbone/nature_cnn.py
 def reset_weights(model):
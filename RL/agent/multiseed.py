@@ -0,0 +1,143 @@
+'''
+run the same experiment with several seeds in parallel processes.
+every process gets its own cpus (at most threads of them, see resources.py), the per-episode rewards are streamed
+to the parent that writes them to one table (csv) and reports mean and confidence interval
+of the final rewards. A failed seed is reported and excluded, the others go on.
+'''
+import os
+import time
+import queue
+import logging
+import multiprocessing
+import numpy as np
+
+from . import resources
+
+logger = logging.getLogger(__name__)
+
+# two-sided 95% student t quantiles for 1..30 degrees of freedom
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+       2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+       2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def confidence_interval(values):
+    """
+    mean and half width of the 95% confidence interval
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return float('nan'), float('nan')
+    if len(values) == 1:
+        return float(values[0]), float('inf')
+    dof = len(values) - 1
+    t = T95[dof - 1] if dof <= len(T95) else 1.96
+    return float(values.mean()), float(t * values.std(ddof=1) / np.sqrt(len(values)))
+
+
+def _seed_process(params, seed, threads, numavg, sleep, messages):
+    # before the libraries are loaded, run.main applies the resource plan of the seed
+    resources.set_threads(threads, resources.CV2_THREADS)
+    from . import run
+
+    def episode_callback(episode, totrewlist, test_rew_epis):
+        messages.put(('episode', seed, episode, totrewlist[-1]))
+        return True
+
+    try:
+        reward = run.main(params, numavg=numavg, sleep=sleep, episode_callback=episode_callback)[0]
+        messages.put(('done', seed, float(reward)))
+    except Exception as e:
+        messages.put(('failed', seed, repr(e)))
+
+
+def seed_params(params, seed):
+    params = list(params) + ['--seed', str(seed)]
+    if '--name_exp' in params:
+        i = params.index('--name_exp') + 1
+        params[i] = '{}_seed{}'.format(params[i], seed)
+    return params
+
+
+def write_table(path, table, seeds):
+    """
+    one row per episode: mean and confidence interval over the seeds that reached it, then every seed
+    """
+    with open(path, 'w') as f:
+        f.write(','.join(['episode', 'n', 'mean', 'ci95'] + ['seed_{}'.format(s) for s in seeds]) + '\n')
+        for episode in sorted(table):
+            row = table[episode]
+            mean, ci = confidence_interval(list(row.values()))
+            f.write(','.join([str(episode), str(len(row)), '{:.4f}'.format(mean), '{:.4f}'.format(ci)] +
+                             ['{:.4f}'.format(row[s]) if s in row else '' for s in seeds]) + '\n')
+
+
+def run_seeds(params, seeds, threads=1, numavg=100, sleep=0., table_path=None, write_every=60., cpus=None):
+    """
+    params: command line arguments of run.main (without --seed and --cpus)
+    cpus: the cpus shared by the seeds ('0-7', default all), split in disjoint groups when there are enough
+    returns a dict with the final reward of every seed, their mean and 95% confidence interval and the failed seeds
+    """
+    seeds = list(seeds)
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Queue()
+    processes = {}
+    shares = resources.split_cpus(resources.parse_cpus(cpus), len(seeds))
+    for seed, share in zip(seeds, shares):
+        share = share[:threads]
+        args = seed_params(params, seed) + ['--cpus', resources.format_cpus(share)]
+        p = ctx.Process(target=_seed_process, args=(args, seed, len(share), numavg, sleep, messages))
+        p.start()
+        processes[seed] = p
+    if table_path is not None:
+        if os.path.dirname(table_path) and not os.path.exists(os.path.dirname(table_path)):
+            os.makedirs(os.path.dirname(table_path))
+        stream = open(os.path.splitext(table_path)[0] + '_episodes.csv', 'w')
+        stream.write('seed,episode,reward\n')
+    else:
+        stream = None
+
+    table = {}
+    rewards = {}
+    failed = {}
+    last_write = time.time()
+    try:
+        while len(rewards) + len(failed) < len(seeds):
+            try:
+                msg = messages.get(timeout=1.)
+            except queue.Empty:
+                # a process that died without reporting (e.g. killed) counts as failed
+                for seed, p in processes.items():
+                    if not p.is_alive() and seed not in rewards and seed not in failed and messages.empty():
+                        failed[seed] = 'exit code {}'.format(p.exitcode)
+                        logger.error('seed {} failed: {}'.format(seed, failed[seed]))
+                continue
+            if msg[0] == 'episode':
+                _, seed, episode, reward = msg
+                table.setdefault(episode, {})[seed] = reward
+                if stream is not None:
+                    stream.write('{},{},{}\n'.format(seed, episode, reward))
+            elif msg[0] == 'done':
+                rewards[msg[1]] = msg[2]
+                logger.info('seed {} done: reward {:.2f}'.format(msg[1], msg[2]))
+            else:
+                failed[msg[1]] = msg[2]
+                logger.error('seed {} failed: {}'.format(msg[1], msg[2]))
+            if table_path is not None and time.time() - last_write > write_every:
+                stream.flush()
+                write_table(table_path, table, seeds)
+                last_write = time.time()
+    finally:
+        for p in processes.values():
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        if stream is not None:
+            stream.close()
+        if table_path is not None:
+            write_table(table_path, table, seeds)
+
+    mean, ci = confidence_interval([rewards[s] for s in seeds if s in rewards])
+    logger.info('final reward {:.2f} +- {:.2f} (95% ci) over {} seeds, {} failed'.format(mean, ci, len(rewards),
+                                                                                         len(failed)))
+    return {'rewards': rewards, 'mean': mean, 'ci95': ci, 'failed': failed}
@@ -0,0 +1,193 @@
+'''
+multi-task Q learning: one learner for several envs (e.g. atari games) with the same preprocessed observations.
+the backbone (shared net) is shared, every task has its Q head (models.MultiHead, with its number of actions)
+and its replay partition (buffers.TaskReplayMemory, memsize / tasks transitions each). a gradient step samples
+a mixed batch (the same number of transitions of every task) and does one forward of the backbone for all of it,
+so the cost is about the one of a single agent.
+
+the config is the one of the first task (run.getparams, the arguments after --), the episodes are played
+round-robin over the tasks, do_rollout works on the task selected with agent.select(task).
+
+python -m agent.multitask --tasks BreakoutDeterministic-v4 PongDeterministic-v4 -- --name_exp breakout_pong
+'''
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import torch
+import gym.spaces
+
+from . import models
+from . import buffers
+from .torchagent import deepQconv
+
+logger = logging.getLogger(__name__)
+
+
+class MultiTaskQ(deepQconv):
+    def __init__(self, observation_space, action_spaces, reward_range, userconfig):
+        if userconfig['policy']:
+            raise NotImplementedError('multi-task training only for Q learning')
+        for key in ['transition_net', 'priority_memory']:
+            if key in userconfig and userconfig[key]:
+                raise NotImplementedError(key + ' with multi-task training')
+        if ('learner_procs' in userconfig and userconfig['learner_procs'] > 1) or \
+                ('actors' in userconfig and userconfig['actors'] > 0) or \
+                ('num_envs' in userconfig and userconfig['num_envs'] > 1):
+            raise NotImplementedError('multi-task training runs one env at a time in the learner process')
+        self.action_spaces = list(action_spaces)
+        self.num_tasks = len(self.action_spaces)
+        self.num_actions = [a.n for a in self.action_spaces]
+        # the Q heads are padded to the largest action space
+        super(MultiTaskQ, self).__init__(observation_space, gym.spaces.Discrete(max(self.num_actions)), reward_range,
+                                         userconfig)
+        self.select(0)
+
+    def Qnet(self, input, state_dict=None):
+        layers = self.config['hiddenlayers']
+        Q = models.MultiHead([models.DenseNet(layers + [n], input_shape=input, scale=1, final_act=False,
+                                              activation=self.config['activation'],
+                                              batch_norm=self.config["batch_norm"],
+                                              init_weight=self.config["init_weight"]) for n in self.num_actions],
+                             self.num_actions)
+        if state_dict:
+            Q.load_state_dict(state_dict)
+            logger.info('Q heads loaded')
+        return Q
+
+    def make_memory(self):
+        return buffers.TaskReplayMemory(self.num_tasks, self.config['memsize'] // self.num_tasks, self.memory_obs,
+                                        self.memory_dtype, self.action_space, self.config['past'],
+                                        self.config['discount'])
+
+    def select(self, task):
+        """
+        task of act / evalQ / memory.add (as used by do_rollout)
+        """
+        self.task = task
+        self.action_space = self.action_spaces[task]
+        self.Q.task = task
+        if hasattr(self, 'copy_Q'):
+            self.copy_Q.task = task
+        self.memory.task = task
+
+    def gradient_step(self):
+        timer = self.timer
+        t0 = timer.tic()
+        self.config['num_updates'] += 1
+        ind = self.memory.sample(self.config['batch_size'])
+        allstate, actions, currew, notdonevec, _, _, _ = self.memory[ind]
+        nextstates = self.memory[ind + 1][0]
+        task = torch.from_numpy(self.memory.task_of(ind)).to(self.device, non_blocking=True)
+        actions = torch.from_numpy(actions.reshape((-1, 1)).astype(np.int64)).to(self.device, non_blocking=True)
+        allstate = self.to_input(allstate)
+        nextstates = self.to_input(nextstates)
+        currew = torch.from_numpy(currew.reshape((-1,))).to(self.device, non_blocking=True)
+        notdonevec = torch.from_numpy(notdonevec.reshape((-1,))).to(self.device, non_blocking=True)
+        t0 = timer.toc('learn_sample', t0)
+
+        self.optimizer.zero_grad()
+        # the mixed batch goes through the backbone once, every sample through the head of its task
+        singleQ = self.Q(self.shared(allstate), task).gather(1, actions)[:, 0]
+        with torch.no_grad():
+            if self.config['copyQ'] > 0:
+                maxQnext = self.copy_Q(self.copy_shared(nextstates), task).max(1)[0]
+            else:
+                maxQnext = self.Q(self.shared(nextstates), task).max(1)[0]
+        if self.config['episodic']:
+            target = currew + self.config["discount"] * maxQnext * notdonevec
+        else:
+            target = currew + self.config["discount"] * maxQnext
+        if self.config['normalize']:
+            scale_target = 1. * torch.abs(target).mean() + 0.001
+            if self.avg_target is None:
+                self.avg_target = scale_target
+            else:
+                self.avg_target = 0.99 * self.avg_target + 0.01 * scale_target
+            loss = self.criterion(singleQ / self.avg_target, target / self.avg_target).mean()
+        else:
+            loss = self.criterion(singleQ, target).mean()
+        t0 = timer.toc('learn_forward', t0)
+
+        loss.backward()
+        t0 = timer.toc('learn_backward', t0)
+        if 'norm_clip' in self.config and self.config['norm_clip']:
+            torch.nn.utils.clip_grad_norm_(self.learnable_parameters, 0.5)
+        if 'val_clip' in self.config and self.config['val_clip']:
+            torch.nn.utils.clip_grad_value_(self.learnable_parameters, 1)
+        self.optimizer.step()
+        timer.toc('learn_step', t0)
+
+
+def main(args=None, numavg=100):
+    parser = argparse.ArgumentParser(description='multi-task training, the arguments after -- go to run.getparams')
+    parser.add_argument('--tasks', nargs='+', required=True, help='env ids, the config is the one of the first')
+    parser.add_argument('--save_every', type=int, default=250, help='rounds (one episode per task) between saves')
+    args = sys.argv[1:] if args is None else args
+    run_args = args[args.index('--') + 1:] if '--' in args else []
+    options = parser.parse_args(args[:args.index('--')] if '--' in args else args)
+    from . import run
+    from . import common
+    from . import metrics
+    from . import resources
+    from . import agent_utils
+
+    params = run.getparams(['--target', options.tasks[0]] + run_args)
+    params['tasks'] = options.tasks
+    common.init_logger(params['path_exp'] + '.log' if params['path_exp'] else None, params['logging'])
+    resources.ResourcePlan(params).apply('learner')
+    if params['seed'] is not None:
+        np.random.seed(params['seed'])
+    envs = []
+    for i, task in enumerate(options.tasks):
+        envs.append(run.make_env(dict(params, target=task), None if params['seed'] is None else params['seed'] + i))
+        if envs[-1].observation_space.shape != envs[0].observation_space.shape:
+            raise ValueError('{} observations {} differ from {} of {}'.format(
+                task, envs[-1].observation_space.shape, envs[0].observation_space.shape, options.tasks[0]))
+    agent = MultiTaskQ(envs[0].observation_space, [env.action_space for env in envs], envs[0].reward_range, params)
+    sink = metrics.MetricsSink(params['path_exp'] + '_metrics.jsonl' if params['path_exp'] else None)
+    rewards = [[] for _ in options.tasks]
+    start_round = agent.config['final_episode'] + 1 if 'final_episode' in agent.config else 1
+    total_steps = 0
+    try:
+        sink.log('start', tasks=options.tasks, num_updates=agent.config['num_updates'])
+        for episode in range(start_round, params['episodes']):
+            for task, env in enumerate(envs):
+                agent.select(task)
+                startt = time.time()
+                total_rew, steps, total_rew_discount, _ = agent_utils.do_rollout(
+                    agent, env, episode, num_steps=env.spec.max_episode_steps, useConv=agent.useConv,
+                    discount=agent.config['discount'])
+                total_steps += steps
+                rewards[task].append(total_rew / agent.config['scalereward'])
+                run.trim(rewards[task], max(run.KEEP_EPISODES, numavg))
+                sink.log('episode', task=options.tasks[task], episode=episode, reward=float(rewards[task][-1]),
+                         steps=steps, seconds=round(time.time() - startt, 4), updates=agent.config['num_updates'],
+                         total_steps=total_steps, eps=float(agent.epsilon(episode)))
+                logger.info('{} episode {} steps {:6} reward {:.2f} avg100 {:.2f} eps {:.3f} updates {:8} '
+                            'tot-steps {:8}'.format(options.tasks[task], episode, steps, rewards[task][-1],
+                                                    np.mean(rewards[task][-100:]), agent.epsilon(episode),
+                                                    agent.config['num_updates'], total_steps))
+            agent.timer.maybe_dump()
+            if (episode + 1 - start_round) % options.save_every == 0 and agent.config['path_exp'] is not None:
+                agent.config['final_episode'] = episode
+                agent.config['results'] = {'num_updates': agent.config['num_updates'], 'episode': episode,
+                                           'train_reward': {t: float(np.mean(r[-100:])) if r else None
+                                                            for t, r in zip(options.tasks, rewards)}}
+                sink.log('checkpoint', episode=episode, updates=agent.config['num_updates'], total_steps=total_steps)
+                agent.save()
+        agent.timer.dump()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for env in envs:
+            env.close()
+        agent.close()
+        sink.log('end', updates=agent.config['num_updates'])
+        sink.close()
+    return [float(np.mean(r[-numavg:])) if r else None for r in rewards]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+'''
+offline training from recorded trajectories, without env: a background thread reads the shards
+(npz files written by recorder.py), preprocesses them as do_rollout does and cuts them in chunks,
+the learner writes every chunk into the replay memory with ReplayMemory.add_batch (episode boundaries
+and discounted returns as in the online memory) and does updates_per_transition gradient steps per
+transition, so it waits for the disk only if the reader is slower than the updates.
+
+shard arrays (T transitions, the episodes may continue in the next shard):
+obs (T, ...) the observation before the action, raw env observations unless preprocessed is True,
+action (T,), reward (T,) the env reward, done (T,) the episode ends after the step,
+optional: terminal (T,) life lost or done (for terminal_life), step (T,) step in the episode.
+
+example:
+python -m agent.offline --data 'out_dir/rec/*.npz' --updates 100000 -- --target BreakoutDeterministic-v4 --name_exp off
+'''
+import sys
+import glob
+import time
+import queue
+import argparse
+import logging
+import threading
+import numpy as np
+
+from .agent_utils import Preprocessor
+
+logger = logging.getLogger(__name__)
+
+
+def load_shard(path):
+    with np.load(path) as data:
+        shard = {k: data[k] for k in data.files}
+    shard['done'] = shard['done'].astype(np.bool_)
+    if 'terminal' not in shard:
+        shard['terminal'] = shard['done']
+    shard['preprocessed'] = bool(shard['preprocessed']) if 'preprocessed' in shard else False
+    return shard
+
+
+def episode_steps(done, first_step=0):
+    """
+    step in the episode of every transition, from the done flags (first_step: step of the first one)
+    """
+    starts = np.concatenate([[0], np.nonzero(done[:-1])[0] + 1])
+    lengths = np.diff(np.concatenate([starts, [len(done)]]))
+    steps = np.arange(len(done)) - np.repeat(starts, lengths)
+    steps[:lengths[0]] += first_step
+    return steps
+
+
+class Transitions(object):
+    """
+    shard arrays -> (obs, action, reward, notdone, step) as do_rollout stores them in the memory of the agent
+    """
+    def __init__(self, agent):
+        config = agent.config
+        self.config = config
+        self.baseline_env = 'baseline_env' in config and config['baseline_env']
+        self.preprocessor = None if self.baseline_env else Preprocessor(
+            agent.observation_space, agent.scaled_obs, type=config['scaling'] if 'scaling' in config else 'none')
+        self.encoder = agent.encode_batch if agent.encoder is not None else None
+        self.useConv = agent.useConv
+        self.next_step = 0
+
+    def __call__(self, shard):
+        obs = shard['obs']
+        if not shard['preprocessed']:
+            if self.preprocessor is not None:
+                obs = self.preprocessor.batch(obs)
+            elif obs.ndim == 4:
+                obs = np.moveaxis(obs, -1, 1)
+        if self.encoder is not None:
+            obs = self.encoder(obs)
+        if not self.useConv:
+            obs = obs.reshape(len(obs), -1)
+        config = self.config
+        if self.baseline_env:
+            reward = shard['reward'].astype(np.float64)
+        else:
+            reward = shard['reward'] * config['scalereward']
+        if config['limitreward'] is not None:
+            reward = np.clip(reward, config['limitreward'][0], config['limitreward'][1])
+        terminal = shard['terminal'] if config['terminal_life'] else shard['done']
+        if 'step' in shard:
+            step = shard['step']
+        else:
+            step = episode_steps(shard['done'], self.next_step)
+        done = shard['done']
+        self.next_step = 0 if done[-1] else int(step[-1]) + 1
+        return obs, shard['action'], reward, 1. - 1. * terminal, step
+
+
+class ShardReader(object):
+    """
+    reads the shards in a background thread, at most prefetch chunks of chunk_size transitions wait in the queue.
+    get() returns the next chunk (obs, action, reward, notdone, step) or None after the last one
+    """
+    def __init__(self, paths, transitions, chunk_size=10000, prefetch=2, epochs=1):
+        self.paths = list(paths)
+        self.transitions = transitions
+        self.chunk_size = chunk_size
+        self.epochs = epochs
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stopped = False
+        self.read_time = 0.
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        try:
+            for _ in range(self.epochs):
+                for path in self.paths:
+                    t0 = time.perf_counter()
+                    chunk = self.transitions(load_shard(path))
+                    self.read_time += time.perf_counter() - t0
+                    for i in range(0, len(chunk[0]), self.chunk_size):
+                        self.put([a[i:i + self.chunk_size] for a in chunk])
+                    if self.stopped:
+                        return
+        except Exception as e:
+            logger.exception('reading the shards failed')
+            self.put(e)
+            return
+        self.put(None)
+
+    def get(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped = True
+        self.thread.join(timeout=1)
+
+
+def train(agent, reader, num_updates, updates_per_transition=1., log_every=60.):
+    """
+    fills the memory of the agent from the reader and does gradient steps until num_updates updates
+    (or the end of the data), returns the number of transitions written
+    """
+    written = 0
+    owed = 0.
+    start = last_log = time.perf_counter()
+    first_update = agent.config['num_updates']
+    while agent.config['num_updates'] < num_updates:
+        if owed < 1 or agent.memory.sizemem() <= agent.config['randstart']:
+            t0 = agent.timer.tic()
+            chunk = reader.get()
+            agent.timer.toc('wait_data', t0)
+            if chunk is None:
+                break
+            t0 = agent.timer.tic()
+            agent.memory.add_batch(*chunk)
+            agent.timer.toc('memory_add', t0)
+            written += len(chunk[2])
+            owed += updates_per_transition * len(chunk[2])
+            continue
+        agent.learn(force=True)
+        owed -= 1
+        agent.timer.maybe_dump()
+        if time.perf_counter() - last_log > log_every:
+            last_log = time.perf_counter()
+            updates = agent.config['num_updates'] - first_update
+            logger.info('offline: {} transitions, {} updates, {:.1f} updates/s, reading {:.1f}s'.format(
+                written, agent.config['num_updates'], updates / (last_log - start), reader.read_time))
+    return written
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='offline training, the arguments after -- go to run.getparams')
+    parser.add_argument('--data', required=True, help='glob of the shards')
+    parser.add_argument('--updates', type=int, default=100000)
+    parser.add_argument('--updates_per_transition', type=float, default=1.)
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--epochs', type=int, default=1, help='passes over the shards')
+    args = sys.argv[1:] if args is None else args
+    run_args = args[args.index('--') + 1:] if '--' in args else []
+    options = parser.parse_args(args[:args.index('--')] if '--' in args else args)
+    from . import run
+    from . import common
+    from . import resources
+    from . import torchagent
+    params = run.getparams(run_args)
+    # one memory stream: the offline memory is filled with add_batch
+    params.update({'num_envs': 1, 'actors': 0})
+    common.init_logger(params['path_exp'] + '.log' if params['path_exp'] else None, params['logging'])
+    resources.ResourcePlan(params).apply('learner')
+    paths = sorted(glob.glob(options.data))
+    if len(paths) == 0:
+        raise IOError('no shards ' + options.data)
+    # the env only gives the spaces
+    env = run.make_env(params)
+    agent = torchagent.deepQconv(env.observation_space, env.action_space, env.reward_range, params)
+    env.close()
+    if agent.config['policy']:
+        raise NotImplementedError('offline training only for Q learning')
+    reader = ShardReader(paths, Transitions(agent), options.chunk_size, epochs=options.epochs)
+    try:
+        written = train(agent, reader, options.updates, options.updates_per_transition)
+    finally:
+        reader.close()
+        agent.timer.dump()
+    logger.info('offline: {} shards, {} transitions, {} updates'.format(len(paths), written,
+                                                                        agent.config['num_updates']))
+    if params['path_exp']:
+        agent.save()
+    agent.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+'''
+data parallel learner on cpu: the actor process is rank 0 and
+learner_procs-1 forked worker processes share the replay memory.
+at every update each rank samples its shard of the batch, the gradients are
+all-reduced (gloo) and every rank applies the same optimizer step,
+so the parameters stay identical to the ones used by the actor.
+with normalize, the running scale of the targets is the one of the full batch on every rank.
+'''
+import os
+import socket
+import logging
+import multiprocessing
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from . import profiling
+from . import resources
+
+logger = logging.getLogger(__name__)
+
+STOP, UPDATE = 0, 1
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def init_group(rank, world_size, port):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+
+
+def memory_parts(memory):
+    # the ReplayMemory objects whose sizes the workers follow (one per stream of a StreamReplayMemory)
+    return memory.streams if hasattr(memory, 'streams') else [memory]
+
+
+def _worker(agent, rank, world_size, port, plan):
+    plan.apply('learner', rank)
+    np.random.seed((os.getpid() * 1000 + rank) % 2 ** 32)
+    torch.manual_seed(np.random.randint(2 ** 31))
+    dp = agent.data_parallel
+    dp.rank = rank
+    agent.timer = profiling.NullTimer()
+    init_group(rank, world_size, port)
+    dp.broadcast_parameters()
+    parts = memory_parts(agent.memory)
+    ctrl = torch.zeros(2 + 2 * len(parts), dtype=torch.int64)
+    while True:
+        dist.broadcast(ctrl, 0)
+        if ctrl[0].item() == STOP:
+            break
+        agent.config['num_updates'] = ctrl[1].item()
+        for i, m in enumerate(parts):
+            m.current_size = ctrl[2 + 2 * i].item()
+            m.start_ind = ctrl[3 + 2 * i].item()
+        agent.update_learning_rate()
+        for m in agent.models:
+            agent.models[m].train()
+        agent.copy_target()
+        agent.gradient_step()
+    dist.destroy_process_group()
+
+
+class DataParallelLearner(object):
+    def __init__(self, agent, num_procs):
+        if agent.config['use_cuda']:
+            raise Exception('learner_procs > 1 is only supported on cpu (use --no_cuda)')
+        # the threads of rank 0 are set by run.main, the ones of the workers by the same plan
+        plan = resources.ResourcePlan(dict(agent.config, learner_procs=num_procs))
+        self.agent = agent
+        self.world_size = num_procs
+        self.rank = 0
+        agent.memory.share_memory()
+        port = free_port()
+        agent.data_parallel = self  # the workers get their copy from the fork
+        ctx = multiprocessing.get_context('fork')
+        self.workers = [ctx.Process(target=_worker, args=(agent, rank, num_procs, port, plan), daemon=True)
+                        for rank in range(1, num_procs)]
+        for w in self.workers:
+            w.start()
+        init_group(0, num_procs, port)
+        self.broadcast_parameters()
+        self.ctrl = torch.zeros(2 + 2 * len(memory_parts(agent.memory)), dtype=torch.int64)
+        logger.info('data parallel learner: {} processes, {} threads for rank 0'.format(
+            num_procs, plan.threads('learner')))
+
+    def parameters(self):
+        return [p for p in self.agent.learnable_parameters if p.requires_grad]
+
+    def broadcast_parameters(self):
+        for p in self.parameters():
+            dist.broadcast(p.data, 0)
+
+    def shard_size(self):
+        batch_size = self.agent.config['batch_size']
+        return batch_size // self.world_size + (1 if self.rank < batch_size % self.world_size else 0)
+
+    def start_update(self):
+        self.ctrl[0] = UPDATE
+        self.ctrl[1] = self.agent.config['num_updates']
+        for i, m in enumerate(memory_parts(self.agent.memory)):
+            self.ctrl[2 + 2 * i] = m.current_size
+            self.ctrl[3 + 2 * i] = m.start_ind
+        dist.broadcast(self.ctrl, 0)
+
+    def batch_mean(self, value):
+        # value: mean over the shard of this rank, returns the mean over the full batch (the same on every rank)
+        value = value.reshape(1) * (float(self.shard_size()) / self.agent.config['batch_size'])
+        dist.all_reduce(value, op=dist.ReduceOp.SUM)
+        return value[0]
+
+    def allreduce_gradients(self):
+        # weighted by the shard size, the sum is the gradient of the mean loss over the full batch
+        params = self.parameters()
+        grads = [p.grad.data if p.grad is not None else torch.zeros_like(p.data) for p in params]
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        flat *= float(self.shard_size()) / self.agent.config['batch_size']
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        offset = 0
+        for p, g in zip(params, grads):
+            n = g.numel()
+            if p.grad is None:
+                p.grad = g
+            p.grad.data.copy_(flat[offset:offset + n].view_as(g))
+            offset += n
+
+    def close(self):
+        self.ctrl[0] = STOP
+        dist.broadcast(self.ctrl, 0)
+        for w in self.workers:
+            w.join()
+        dist.destroy_process_group()
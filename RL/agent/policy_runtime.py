@@ -0,0 +1,150 @@
+'''
+export of a trained agent as one self-contained file and a minimal runtime to act with it.
+
+the file is a TorchScript module (shared + Q, or shared + policy) with the preprocessing and
+frame stack settings in its metadata, the runtime needs only torch, numpy and cv2
+(no gym, tensorflow, numba, matplotlib or the agent config and checkpoint).
+
+export:  python -m agent.policy_runtime --name_exp breakout --res_dir out_dir --out breakout.pt
+use:     policy = Policy('breakout.pt'); action = policy.act(observation, reset=True); ...
+'''
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .agent_utils import Preprocessor, FrameStacker
+
+METADATA = 'policy.json'
+
+
+class PolicyHead(nn.Module):
+    def __init__(self, shared, head):
+        super(PolicyHead, self).__init__()
+        self.shared = shared
+        self.head = head
+
+    def forward(self, x):
+        return self.head(self.shared(x))
+
+
+def export(agent, path):
+    """
+    trace shared + Q (policy for policy gradient agents) of the agent on cpu and save it with the metadata
+    """
+    config = agent.config
+    if agent.encoder is not None:
+        raise NotImplementedError('export of agents with an encoder')
+    kind = 'policy' if config['policy'] else 'Q'
+    head = agent.logitpolicy if config['policy'] else agent.Q
+    module = PolicyHead(agent.shared, head).cpu().eval()
+    if agent.useConv and agent.memory_dtype == np.uint8:
+        input_dtype = 'uint8'
+    else:
+        input_dtype = 'float32'
+    example = torch.zeros((1,) + agent.input_shape, dtype=getattr(torch, input_dtype))
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+    space = agent.observation_space
+    meta = {'kind': kind,
+            'scaling': config['scaling'] if 'scaling' in config else 'none',
+            'scaled_obs': list(agent.scaled_obs),
+            'past': config['past'],
+            'conv': bool(agent.useConv),
+            'baseline_env': bool('baseline_env' in config and config['baseline_env']),
+            'input_shape': list(agent.input_shape),
+            'input_dtype': input_dtype,
+            'num_actions': agent.n_out,
+            'observation_space': {'shape': list(space.shape), 'dtype': str(space.dtype),
+                                  'low': np.asarray(space.low, dtype=np.float64).tolist(),
+                                  'high': np.asarray(space.high, dtype=np.float64).tolist()}}
+    torch.jit.save(traced, path, _extra_files={METADATA: json.dumps(meta)})
+    # the module goes back to the device of the agent
+    module.to(agent.device)
+    return meta
+
+
+class ObservationSpace(object):
+    """
+    what Preprocessor needs of a gym Box
+    """
+    def __init__(self, shape, dtype, low, high):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.low = np.array(low, dtype=np.float64).astype(self.dtype)
+        self.high = np.array(high, dtype=np.float64).astype(self.dtype)
+
+
+class Policy(object):
+    """
+    greedy actions of an exported agent: preprocessing, frame stack and one forward per observation
+    """
+    def __init__(self, path, num_threads=None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        extra = {METADATA: ''}
+        self.module = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+        self.module.eval()
+        self.meta = json.loads(extra[METADATA])
+        if self.meta['baseline_env']:
+            self.preprocessor = None
+        else:
+            space = ObservationSpace(**self.meta['observation_space'])
+            self.preprocessor = Preprocessor(space, self.meta['scaled_obs'], type=self.meta['scaling'])
+        self.float_input = self.meta['input_dtype'] != 'uint8'
+        self.stacker = None
+
+    def frame(self, observation):
+        if self.preprocessor is not None:
+            frame = self.preprocessor(observation)
+        elif observation.ndim == 3:
+            frame = np.moveaxis(observation, -1, 0)
+        else:
+            frame = observation
+        if not self.meta['conv']:
+            frame = frame.reshape(-1)
+        return frame
+
+    def output(self, observation, reset=False):
+        """
+        Q values (or policy logits) for the new observation, reset=True for the first one of an episode
+        """
+        frame = self.frame(observation)
+        if reset or self.stacker is None:
+            self.stacker = FrameStacker(self.meta['past'] + 1, frame.shape, frame.dtype)
+            self.stacker.reset(frame)
+        else:
+            self.stacker.push(frame)
+        x = torch.from_numpy(np.ascontiguousarray(self.stacker.get()[None]))
+        if self.float_input:
+            x = x.float()
+        with torch.no_grad():
+            return self.module(x)[0].numpy()
+
+    def act(self, observation, reset=False):
+        return int(np.argmax(self.output(observation, reset)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='export a trained agent for the policy runtime')
+    parser.add_argument('--name_exp', required=True)
+    parser.add_argument('--res_dir', default='out_dir')
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args(args)
+    from . import run
+    from . import torchagent
+    params = run.getparams(['--name_exp', args.name_exp, '--res_dir', args.res_dir, '--no_cuda', '--no_plot'])
+    if not os.path.isfile(params['path_exp'] + '.pth'):
+        raise IOError('no checkpoint ' + params['path_exp'] + '.pth')
+    env = run.make_env(params)
+    agent = torchagent.deepQconv(env.observation_space, env.action_space, env.reward_range, params)
+    meta = export(agent, args.out)
+    env.close()
+    print('exported', args.out, meta)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
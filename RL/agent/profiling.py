@@ -0,0 +1,166 @@
+import time
+import json
+import logging
+from collections import deque
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# log-spaced histogram edges from 1us to 10s
+HIST_EDGES = np.logspace(-6, 1, 29)
+
+
+class NullTimer(object):
+    """
+    timer with the same interface as PhaseTimer that records nothing (used when profiling is disabled)
+    """
+    enabled = False
+
+    def tic(self):
+        return 0.
+
+    def toc(self, phase, start):
+        return 0.
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def summary(self):
+        return {}
+
+    def maybe_dump(self, force=False):
+        pass
+
+    def dump(self):
+        pass
+
+
+class PhaseTimer(object):
+    """
+    per-phase wall clock timer for the hot path.
+    usage: t0 = timer.tic(); ...; t0 = timer.toc('phase', t0)
+    the last `window` durations of every phase are kept as a rolling histogram
+    and appended as a json line to `path` every `dump_every` seconds.
+    note: with cuda the forward/backward phases measure only the kernel launch unless sync=True
+    """
+    enabled = True
+
+    def __init__(self, path=None, window=2000, dump_every=60., sync=False):
+        self.path = path
+        self.window = window
+        self.dump_every = dump_every
+        self.sync = sync
+        self.durations = {}
+        self.totals = {}
+        self.calls = {}
+        self.counters = {}
+        self.values = {}
+        self.start_time = time.time()
+        self.last_dump = self.start_time
+        if sync:
+            import torch
+            self._synchronize = torch.cuda.synchronize
+        else:
+            self._synchronize = None
+
+    def tic(self):
+        if self._synchronize is not None:
+            self._synchronize()
+        return time.perf_counter()
+
+    def toc(self, phase, start):
+        if self._synchronize is not None:
+            self._synchronize()
+        now = time.perf_counter()
+        dt = now - start
+        if phase not in self.durations:
+            self.durations[phase] = deque(maxlen=self.window)
+            self.totals[phase] = 0.
+            self.calls[phase] = 0
+        self.durations[phase].append(dt)
+        self.totals[phase] += dt
+        self.calls[phase] += 1
+        return now
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        record a value that is not a duration (e.g. a batch size), reported with its percentiles
+        """
+        if name not in self.values:
+            self.values[name] = deque(maxlen=self.window)
+        self.values[name].append(value)
+
+    def value_summary(self):
+        out = {}
+        for name, d in self.values.items():
+            if len(d) == 0:
+                continue
+            vals = np.array(d)
+            out[name] = {'mean': float(vals.mean()),
+                         'p50': float(np.percentile(vals, 50)),
+                         'p90': float(np.percentile(vals, 90)),
+                         'p99': float(np.percentile(vals, 99)),
+                         'max': float(vals.max())}
+        return out
+
+    def summary(self):
+        out = {}
+        for phase, d in self.durations.items():
+            if len(d) == 0:
+                continue
+            vals = np.array(d)
+            hist, _ = np.histogram(vals, HIST_EDGES)
+            out[phase] = {'calls': self.calls[phase],
+                          'total': self.totals[phase],
+                          'mean': float(vals.mean()),
+                          'p50': float(np.percentile(vals, 50)),
+                          'p90': float(np.percentile(vals, 90)),
+                          'p99': float(np.percentile(vals, 99)),
+                          'max': float(vals.max()),
+                          'hist': hist.tolist()}
+        return out
+
+    def maybe_dump(self, force=False):
+        if force or time.time() - self.last_dump >= self.dump_every:
+            self.dump()
+
+    def dump(self):
+        self.last_dump = time.time()
+        summary = self.summary()
+        values = self.value_summary()
+        if len(summary) == 0:
+            return
+        logger.info('timing (mean ms) ' + ' '.join(
+            '{} {:.3f}'.format(p, summary[p]['mean'] * 1000.) for p in sorted(summary)) + ''.join(
+            ' {} {:.2f} (p90 {:.2f})'.format(v, values[v]['mean'], values[v]['p90']) for v in sorted(values)))
+        if self.path:
+            record = {'time': self.last_dump,
+                      'elapsed': self.last_dump - self.start_time,
+                      'hist_edges': HIST_EDGES.tolist(),
+                      'counters': self.counters,
+                      'phases': summary,
+                      'values': values}
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+def make_timer(config):
+    """
+    build the timer for an agent config ('profile', 'profile_every', 'profile_window' keys)
+    """
+    if not ('profile' in config and config['profile']):
+        return NullTimer()
+    if 'path_exp' in config and config['path_exp']:
+        path = config['path_exp'] + '_timing.jsonl'
+    else:
+        path = None
+    dump_every = config['profile_every'] if 'profile_every' in config else 60.
+    window = config['profile_window'] if 'profile_window' in config else 2000
+    sync = 'use_cuda' in config and config['use_cuda']
+    return PhaseTimer(path, window=window, dump_every=dump_every, sync=sync)
@@ -0,0 +1,144 @@
+'''
+asynchronous recording of training episodes: do_rollout puts every step (raw observation, action,
+env reward, done and terminal flags) in a queue, a writer thread collects the recorded episodes
+into compressed npz shards of about shard_bytes of observations in the format read by offline.py
+(and optionally writes an mp4 per episode with opencv). every k-th episode is recorded.
+the steps queued or held by the writer (current episode and shard) are bounded by max_bytes, another
+shard worth is copied while a shard is written (MemoryPlan counts 2 * max_bytes with --record_every).
+if the bound is reached the step is not waited for: the rest of the episode is dropped (and counted).
+'''
+import os
+import glob
+import queue
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STEP, END, DROP, STOP = 0, 1, 2, 3
+MAX_BYTES = 256 * 1024 ** 2
+
+
+class Recorder(object):
+    def __init__(self, out_dir, every=1, max_bytes=MAX_BYTES, shard_bytes=None, video=False, fps=30):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.every = every
+        self.max_bytes = max_bytes
+        self.shard_bytes = max_bytes // 4 if shard_bytes is None else shard_bytes
+        self.video = video
+        self.fps = fps
+        # bounded in bytes by record, so putting never blocks
+        self.queue = queue.Queue()
+        self.held_bytes = 0
+        self.lock = threading.Lock()
+        self.active = False
+        self.dropping = False
+        self.episode = None
+        self.dropped_episodes = 0
+        # a resumed run appends shards
+        self.shards = len(glob.glob(os.path.join(out_dir, 'shard_*.npz')))
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def start(self, episode):
+        """
+        start of a training episode, returns True if it is recorded
+        """
+        self.active = episode % self.every == 0
+        self.dropping = False
+        self.episode = episode
+        return self.active
+
+    def record(self, obs, action, reward, done, terminal):
+        if not self.active or self.dropping:
+            return
+        obs = np.asarray(obs)
+        with self.lock:
+            full = self.held_bytes + obs.nbytes > self.max_bytes
+            if not full:
+                self.held_bytes += obs.nbytes
+        if full:
+            self.dropping = True
+            self.dropped_episodes += 1
+            self.queue.put_nowait((DROP, self.episode))
+            return
+        self.queue.put_nowait((STEP, self.episode, obs, action, reward, done, terminal))
+
+    def release(self, steps):
+        with self.lock:
+            self.held_bytes -= sum(s[0].nbytes for s in steps)
+
+    def end(self):
+        if self.active and not self.dropping:
+            self.queue.put((END, self.episode))
+        self.active = False
+
+    def write_loop(self):
+        episode, episode_steps = None, []
+        shard, shard_bytes = [], 0
+        while True:
+            item = self.queue.get()
+            if item[0] == STEP:
+                episode = item[1]
+                episode_steps.append(item[2:])
+            elif item[0] == DROP:
+                self.release(episode_steps)
+                episode, episode_steps = None, []
+            elif item[0] == END:
+                if len(episode_steps) > 0:
+                    # the recorded episodes are not consecutive: the last step ends the episode even if
+                    # the rollout was cut by num_steps
+                    obs, action, reward, done, terminal = episode_steps[-1]
+                    episode_steps[-1] = (obs, action, reward, True, terminal or done)
+                    if self.video:
+                        try:
+                            self.write_video(episode, [s[0] for s in episode_steps])
+                        except Exception:
+                            logger.exception('recorder: video of episode {} failed'.format(episode))
+                    shard += episode_steps
+                    shard_bytes += sum(s[0].nbytes for s in episode_steps)
+                    episode_steps = []
+                    if shard_bytes >= self.shard_bytes:
+                        try:
+                            self.write_shard(shard)
+                        except Exception:
+                            logger.exception('recorder: writing shard {} failed'.format(self.shards))
+                        self.release(shard)
+                        shard, shard_bytes = [], 0
+                self.release(episode_steps)
+                episode, episode_steps = None, []
+            else:
+                self.release(episode_steps)
+                if len(shard) > 0:
+                    self.write_shard(shard)
+                    self.release(shard)
+                return
+
+    def write_shard(self, steps):
+        path = os.path.join(self.out_dir, 'shard_{:05d}.npz'.format(self.shards))
+        np.savez_compressed(path, obs=np.array([s[0] for s in steps]), action=np.array([s[1] for s in steps]),
+                            reward=np.array([s[2] for s in steps], dtype=np.float32),
+                            done=np.array([s[3] for s in steps], dtype=np.bool_),
+                            terminal=np.array([s[4] for s in steps], dtype=np.bool_), preprocessed=False)
+        self.shards += 1
+        logger.debug('recorder: {} steps in {}'.format(len(steps), path))
+
+    def write_video(self, episode, frames):
+        import cv2
+        if frames[0].ndim != 3:
+            return
+        height, width = frames[0].shape[:2]
+        path = os.path.join(self.out_dir, 'episode_{:06d}.mp4'.format(episode))
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+        for frame in frames:
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        writer.release()
+
+    def close(self):
+        self.queue.put((STOP,))
+        self.thread.join()
+        logger.info('recorder: {} shards in {}, {} episodes dropped'.format(self.shards, self.out_dir,
+                                                                              self.dropped_episodes))
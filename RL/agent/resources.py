@@ -0,0 +1,247 @@
+'''
+cpu budget of a run: number of threads and cpus of every process of the run, by role
+(learner, actor, env_worker, eval_worker), computed from the params so that every process
+gets the same plan, and applied at the start of the process with ResourcePlan(params).apply(role, index).
+
+the actors, env workers and evaluation workers are single threaded and get one cpu each,
+the learner processes share the rest. --cpus 0-3,6 restricts the run to these cpus (several runs
+on one machine should get disjoint sets), --pin_cpus also sets the cpu affinity of every process.
+opencv runs single threaded in all the processes (one small frame per call).
+
+MemoryPlan is the ram budget of the learner: bytes of a replay slot, model and optimizer state,
+the staging of a batch and the recorder; with --ram_budget (GB) it caps memsize (and batch_size) to fit.
+'''
+import os
+import resource
+import logging
+import multiprocessing
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ROLES = ('learner', 'actor', 'env_worker', 'eval_worker')
+CV2_THREADS = 1
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def parse_cpus(spec):
+    """
+    '0-3,6' -> [0, 1, 2, 3, 6], None -> the cpus available to this process
+    """
+    if spec is None or spec == '':
+        return available_cpus()
+    if isinstance(spec, (list, tuple)):
+        return [int(c) for c in spec]
+    cpus = []
+    for part in str(spec).split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpus(cpus):
+    return ','.join(str(c) for c in cpus)
+
+
+def split_cpus(cpus, n):
+    """
+    n contiguous groups of cpus of (almost) the same size, one cpu each in turn if there are less cpus than groups
+    """
+    if n <= len(cpus):
+        size, extra = divmod(len(cpus), n)
+        groups = []
+        start = 0
+        for i in range(n):
+            end = start + size + (1 if i < extra else 0)
+            groups.append(cpus[start:end])
+            start = end
+        return groups
+    return [[cpus[i % len(cpus)]] for i in range(n)]
+
+
+def set_threads(num_threads, cv2_threads=None):
+    """
+    threads used by torch, opencv and the BLAS/OpenMP libraries of this process
+    (the environment variables are effective only for libraries not loaded yet)
+    """
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        import cv2
+        cv2.setNumThreads(num_threads if cv2_threads is None else cv2_threads)
+    except ImportError:
+        pass
+
+
+class ResourcePlan(object):
+    def __init__(self, params):
+        self.cpus = parse_cpus(params['cpus'] if 'cpus' in params else None)
+        self.pin = 'pin_cpus' in params and params['pin_cpus']
+        # set by --learner_threads (e.g. from agent.autotune), 0: one thread per cpu of the learner
+        self.learner_threads = params['learner_threads'] if 'learner_threads' in params else 0
+        num_envs = params['num_envs'] if 'num_envs' in params else 1
+        shm_env = num_envs > 1 and 'vec_env' in params and params['vec_env'] == 'shm'
+        self.counts = {'learner': params['learner_procs'] if 'learner_procs' in params else 1,
+                       'actor': params['actors'] if 'actors' in params else 0,
+                       'env_worker': num_envs if shm_env else 0,
+                       'eval_worker': params['eval_workers'] if 'eval_workers' in params else 0}
+        workers = [(role, i) for role in ROLES[1:] for i in range(self.counts[role])]
+        num_learner = min(len(self.cpus), max(self.counts['learner'], len(self.cpus) - len(workers)))
+        # the single threaded processes share the cpus left by the learner, or all of them if there are none left
+        pool = self.cpus[num_learner:] or self.cpus
+        self.groups = {'learner': split_cpus(self.cpus[:num_learner], max(1, self.counts['learner']))}
+        for role in ROLES[1:]:
+            self.groups[role] = []
+        for j, (role, i) in enumerate(workers):
+            self.groups[role].append([pool[j % len(pool)]])
+
+    def cpus_of(self, role, index=0):
+        return self.groups[role][index % len(self.groups[role])] if self.groups[role] else self.cpus
+
+    def threads(self, role, index=0):
+        if role != 'learner':
+            return 1
+        return self.learner_threads or len(self.cpus_of(role, index))
+
+    def apply(self, role, index=0):
+        """
+        sets the threads (and the affinity with pin_cpus) of this process for its role, returns the number of threads
+        """
+        threads = self.threads(role, index)
+        cpus = self.cpus_of(role, index)
+        set_threads(threads, CV2_THREADS)
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        logger.info('{} {} (pid {}): {} threads, cpus {}{}'.format(role, index, os.getpid(), threads, format_cpus(cpus),
+                                                                   ' pinned' if self.pin else ''))
+        return threads
+
+    def summary(self):
+        return ', '.join('{} x{} on {}'.format(role, self.counts[role], format_cpus(sorted(set(
+            c for g in self.groups[role] for c in g)))) for role in ROLES if self.counts[role] > 0)
+
+
+# arrays of a replay slot besides the observation: reward, notdone, totalr (float32), step, step2end (int64)
+# and the info_mem entry (a pointer)
+SLOT_EXTRA_BYTES = 4 * 3 + 8 * 2 + 8
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024. or unit == 'GB':
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024.
+
+
+def process_rss():
+    """
+    resident memory of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname()[0] == 'Darwin' else rss * 1024
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def optimizer_state_factor(config):
+    # tensors of optimizer state per parameter tensor (created at the first step)
+    optimizer = config['optimizer'] if 'optimizer' in config else 'rmsprop'
+    momentum = 'momentum' in config and bool(config['momentum'])
+    if optimizer == 'adam':
+        return 2
+    if optimizer == 'sgd':
+        return 1 if momentum else 0
+    return 2 if momentum else 1
+
+
+class MemoryPlan(object):
+    """
+    bytes of the learner: replay slots of memory_obs frames (the history is stacked only when a batch is
+    sampled), models, optimizer state, and the staging of a batch (states and next states gathered from
+    the replay, then as float32 input)
+    """
+    def __init__(self, config, memory_obs, memory_dtype, action_space, input_shape, modules):
+        self.config = config
+        self.slot_bytes = int(np.prod(memory_obs)) * np.dtype(memory_dtype).itemsize + \
+            int(np.prod(action_space.shape)) * np.dtype(action_space.dtype).itemsize + SLOT_EXTRA_BYTES
+        params = {}
+        for module in modules:
+            for p in module.parameters():
+                params[id(p)] = p
+        self.model_bytes = sum(p.numel() * p.element_size() for p in params.values())
+        learnable = sum(p.numel() * p.element_size() for p in params.values() if p.requires_grad)
+        # gradients and optimizer state
+        self.optimizer_bytes = learnable * (1 + optimizer_state_factor(config))
+        input_size = int(np.prod(input_shape))
+        self.sample_bytes = 2 * input_size * (np.dtype(memory_dtype).itemsize + 4)
+        self.base_bytes = process_rss()
+        # steps held by the recorder, and the copy of a shard while it is written
+        recording = 'record_every' in config and config['record_every'] > 0
+        self.recorder_bytes = 2 * int(config['record_mb'] * 1024 ** 2) if recording and 'record_mb' in config else 0
+
+    def staging_bytes(self, batch_size):
+        return batch_size * self.sample_bytes
+
+    def total_bytes(self, memsize, batch_size):
+        return self.base_bytes + memsize * self.slot_bytes + self.model_bytes + self.optimizer_bytes + \
+            self.recorder_bytes + self.staging_bytes(batch_size)
+
+    def apply(self, loaded=False):
+        """
+        caps config['memsize'] and config['batch_size'] to the budget config['ram_budget'] (GB, 0: no budget)
+        and logs the plan. loaded: the replay memory (config['memsize'] slots) is already allocated, e.g. loaded
+        from _mem.p, so memsize is not capped and a plan over the budget is a warning
+        """
+        config = self.config
+        budget = config['ram_budget'] * 1024 ** 3 if 'ram_budget' in config and config['ram_budget'] else None
+        if budget is not None:
+            fixed = self.base_bytes + self.model_bytes + self.optimizer_bytes + self.recorder_bytes
+            # the staging of a batch is limited to a tenth of the budget
+            max_batch = int(0.1 * budget // self.sample_bytes)
+            if config['batch_size'] > max_batch:
+                logger.warning('batch_size {} capped to {} by the ram budget'.format(config['batch_size'],
+                                                                                     max_batch))
+                config['batch_size'] = max(1, max_batch)
+            max_memsize = int((budget - fixed - self.staging_bytes(config['batch_size'])) // self.slot_bytes)
+            minimum = max(config['randstart'], config['past'] + 2) + 1
+            if not loaded and max_memsize < minimum:
+                raise MemoryError('ram budget of {} GB leaves {} replay slots, at least {} are needed'.format(
+                    config['ram_budget'], max_memsize, minimum))
+            if not loaded and config['memsize'] > max_memsize:
+                logger.warning('memsize {} capped to {} by the ram budget'.format(config['memsize'], max_memsize))
+                config['memsize'] = max_memsize
+        total = self.total_bytes(config['memsize'], config['batch_size'])
+        logger.info('memory plan: replay {} x {} = {}, models {}, gradients+optimizer {}, staging {} x {} = {}, '
+                    'recorder {}, process {}, total {}{}'.format(
+                        config['memsize'], format_bytes(self.slot_bytes),
+                        format_bytes(config['memsize'] * self.slot_bytes), format_bytes(self.model_bytes),
+                        format_bytes(self.optimizer_bytes), config['batch_size'], format_bytes(self.sample_bytes), format_bytes(self.staging_bytes(config['batch_size'])),
+                        format_bytes(self.recorder_bytes), format_bytes(self.base_bytes), format_bytes(total),
+                        ' (budget {})'.format(format_bytes(budget)) if budget is not None else ''))
+        if loaded and budget is not None and total > budget:
+            logger.warning('the loaded replay memory of {} slots does not fit the ram budget: plan {} > {}'.format(
+                config['memsize'], format_bytes(total), format_bytes(budget)))
+        physical = physical_memory()
+        if budget is None and physical is not None and total > physical:
+            logger.warning('the memory plan ({}) exceeds the physical memory ({}), see --ram_budget'.format(
+                format_bytes(total), format_bytes(physical)))
+        return total
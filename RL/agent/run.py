@@ -8,8 +8,16 @@ from . import default_params
 from . import torchagent
 from . import agent_utils
 from . import env_utils
+from . import evaluation
+from . import apex
+from . import resources
+from . import recorder
+from . import metrics
 
 import time
+import functools
+import importlib
+import subprocess
 import numpy as np
 import gym
 import gym.spaces
@@ -36,12 +44,50 @@ def getparams(params):
     parser.add_argument('--res_dir', default="out_dir")
     parser.add_argument('--target', default="BreakoutDeterministic-v4")  # LunarLander-v2 Breakout-v0
     parser.add_argument('--episodes', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=None)
     parser.add_argument('--plot', action='store_true', default=True, help='plot')
+    parser.add_argument('--no_plot', action='store_false', dest='plot', help='disable plot')
     parser.add_argument('--render', action='store_true', help='render')
     parser.add_argument('--monitor', action='store_true', help='monitor')
     parser.add_argument('--logging', default='INFO')
     parser.add_argument('--no_cuda', action='store_false', dest='use_cuda', default=True, help='disable cuda')
     parser.add_argument('--save_mem', action='store_true', help='save memory')
+    parser.add_argument('--encoder', default=None,
+                        help='frozen pretrained encoder (torch.save/torch.jit.save), replay stores its features')
+    parser.add_argument('--learner_procs', type=int, default=1,
+                        help='data parallel learner processes on cpu (gradients all-reduced with gloo)')
+    parser.add_argument('--channels_last', action='store_true', help='channels_last memory format for the conv net')
+    parser.add_argument('--eval_workers', type=int, default=0,
+                        help='processes for the test episodes (0: inline in the training loop)')
+    parser.add_argument('--eval_episodes', type=int, default=5, help='seeded episodes per test with eval_workers')
+    parser.add_argument('--num_envs', type=int, default=1,
+                        help='environments stepped in lockstep for training (batched actions, one replay stream each)')
+    parser.add_argument('--vec_env', default='shm', choices=['shm', 'serial'],
+                        help='with num_envs > 1: shared memory worker processes or serial envs in this process')
+    parser.add_argument('--actors', type=int, default=0,
+                        help='Ape-X mode: actor processes feeding a learner that only does gradient steps')
+    parser.add_argument('--publish_every', type=int, default=50, help='updates between weight refreshes of the actors')
+    parser.add_argument('--inference_server', action='store_true',
+                        help='with --actors: batched forwards in the learner instead of a model per actor')
+    parser.add_argument('--max_latency', type=float, default=0.002,
+                        help='seconds the inference server waits to fill a batch')
+    parser.add_argument('--record_every', type=int, default=0,
+                        help='record every k-th training episode (num_envs 1) as npz shards for agent.offline (0: off)')
+    parser.add_argument('--record_video', action='store_true', help='also an mp4 of every recorded episode')
+    parser.add_argument('--record_dir', default=None, help='directory of the recordings (default <path_exp>_rec)')
+    parser.add_argument('--record_mb', type=float, default=256.,
+                        help='MB of recorded steps held in memory before they are written (the rest is dropped)')
+    parser.add_argument('--ram_budget', type=float, default=0.,
+                        help='GB for the learner: memsize and batch_size are capped to fit (0: no cap, plan logged)')
+    parser.add_argument('--cpus', default=None,
+                        help='cpus of the run, e.g. 0-3,6 (default: all), shared by the learner and the workers')
+    parser.add_argument('--pin_cpus', action='store_true', help='set the cpu affinity of every process of the run')
+    parser.add_argument('--learner_threads', type=int, default=0,
+                        help='torch threads of a learner process (0: one per cpu of the learner)')
+    parser.add_argument('--overlay', default=None,
+                        help='json of params applied over the config, e.g. written by agent.autotune')
+    parser.add_argument('--profile', action='store_true', help='per-phase timing of the training loop')
+    parser.add_argument('--profile_every', type=float, default=60., help='seconds between timing dumps')
 
     args = parser.parse_args(params)
     options = vars(args)
@@ -62,9 +108,42 @@ def getparams(params):
         params['use_cuda'] = options['use_cuda']
         params['save_mem'] = options['save_mem']
         params['logging'] = options['logging']
+        params['profile'] = options['profile']
+        params['learner_procs'] = options['learner_procs']
+        params['channels_last'] = options['channels_last']
+        params['eval_workers'] = options['eval_workers']
+        params['eval_episodes'] = options['eval_episodes']
+        params['vec_env'] = options['vec_env']
+        params['profile_every'] = options['profile_every']
+        params['actors'] = options['actors']
+        params['publish_every'] = options['publish_every']
+        params['inference_server'] = options['inference_server']
+        params['max_latency'] = options['max_latency']
+        params['cpus'] = options['cpus']
+        params['ram_budget'] = options['ram_budget']
+        params['record_every'] = options['record_every']
+        params['record_video'] = options['record_video']
+        params['record_dir'] = options['record_dir']
+        params['record_mb'] = options['record_mb']
+        params['pin_cpus'] = options['pin_cpus']
+        params['learner_threads'] = options['learner_threads']
+        params['overlay'] = options['overlay']
     else:
         params = default_params.get_default(options['target'])
         params.update(options)
+        if params['encoder'] and 'dimdobs' in params:
+            # the encoder takes color frames
+            params['scaling'] = 'rgb'
+            params['dimdobs'] = tuple(params['dimdobs'][:2]) + (3,)
+
+    if params['overlay']:
+        with open(params['overlay']) as f:
+            overlay = json.load(f)
+        logger.info('overlay {}: {}'.format(params['overlay'], overlay))
+        params.update(overlay)
+    if 'env_module' in params and params['env_module']:
+        # registers the env in gym before its spec is looked up (the module can come from the overlay)
+        importlib.import_module(params['env_module'])
 
     return params
 
@@ -92,39 +171,74 @@ def upload_res(callback, process_upload=None, upload_checkpoint=False, parallel=
     return process_upload
 
 
-def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
+# length of the reward lists kept in memory by main (at least numavg)
+KEEP_EPISODES = 100
+
+
+def trim(values, keep):
+    # amortized: the list is cut to its last keep values when it reaches twice that
+    if len(values) >= 2 * keep:
+        del values[:-keep]
+
+
+def update_test_stats(avg, test_episode, test_rewards, test_rew_epis, test_rew_smooth, scalereward):
+    test_rew = np.mean(test_rewards)
+    test_rew_epis[0].append(test_rew / scalereward)
+    test_rew_epis[1].append(test_episode)
+    inc = max(0.2, 0.05 + 1. / (test_episode) ** 0.5)
+    avg = avg * (1 - inc) + inc * test_rew
+    test_rew_smooth.append(avg / scalereward)
+    return avg
+
+
+def make_env(params, seed=None, logger_dir=None, num_envs=1):
+    nameenv = params['target']
+    if num_envs > 1:
+        if 'baseline_env' in params and params['baseline_env']:
+            return env_utils.build_env(nameenv, env_type=None, num_env=num_envs, batch=True,
+                                       seed=seed, reward_scale=params['scalereward'], gamestate=None)
+        env_fns = [functools.partial(make_env, params, None if seed is None else seed + i) for i in range(num_envs)]
+        if 'vec_env' in params and params['vec_env'] == 'serial':
+            return env_utils.SerialVecEnv(env_fns)
+        # preprocessing and frame skip in the workers
+        scaled_obs = params['dimdobs'] if 'dimdobs' in params else None
+        scaling = params['scaling'] if 'scaling' in params else 'none'
+        frame_skip = params['frame_skip'] if 'frame_skip' in params else 1
+        return env_utils.ShmVecEnv(env_fns, preprocess=(scaled_obs, scaling), frame_skip=frame_skip,
+                                   resources=resources.ResourcePlan(params))
+    if 'baseline_env' in params and params['baseline_env']:
+        env = env_utils.build_env(nameenv, env_type=None, num_env=1, batch=False,
+                                  seed=seed, reward_scale=params['scalereward'], gamestate=None,
+                                  logger_dir=logger_dir)
+    else:
+        if 'env_module' in params and params['env_module']:
+            # registers the env in gym (also in the spawned env workers)
+            importlib.import_module(params['env_module'])
+        env = gym.make(nameenv, **(params['env_kwargs'] if 'env_kwargs' in params and params['env_kwargs'] else {}))
+        if seed is not None:
+            env.seed(seed)
+    return env
+
+
+def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0, episode_callback=None):
+    '''
+    episode_callback(episode, totrewlist, test_rew_epis) is called after every episode,
+    if it returns False the training stops
+    '''
     params = getparams(params)
     logger.info('Params' + str(params))
-    if params['plot'] != True:
-        import matplotlib
-        matplotlib.use('pdf')
-    else:
-        import matplotlib
-        # matplotlib.use('Agg')
-        # matplotlib.use("Qt5agg")
-        import matplotlib.pyplot as plt
-
-        plt.rcParams['image.interpolation'] = 'nearest'
 
     nameenv = params['target']
 
     reward_threshold = gym.envs.registry.spec(nameenv).reward_threshold
-    if 'baseline_env' in params and params['baseline_env']:
-        if params['path_exp']:
-            stats_path = os.path.join(params["res_dir"], 'stats')
-            if not os.path.exists(stats_path):
-                os.makedirs(stats_path)
-        else:
-            stats_path = None
-        env = env_utils.build_env(nameenv, env_type=None, num_env=1, batch=False,
-                                  seed=params["seed"], reward_scale=params['scalereward'], gamestate=None,
-                                  logger_dir=stats_path)
-        reward_range = env.reward_range#env.envs[0].reward_range
+    if 'baseline_env' in params and params['baseline_env'] and params['path_exp']:
+        stats_path = os.path.join(params["res_dir"], 'stats')
+        if not os.path.exists(stats_path):
+            os.makedirs(stats_path)
     else:
-        env = gym.make(nameenv)
-        reward_range = env.reward_range
-        if params['seed'] is not None:
-            env.seed(params["seed"])
+        stats_path = None
+    env = make_env(params, params["seed"], logger_dir=stats_path)
+    reward_range = env.reward_range#env.envs[0].reward_range
 
     if params['monitor'] == True:  # store performance and video
         from gym import wrappers
@@ -138,6 +252,9 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
     common.init_logger(log_file, params['logging'])
     logger.info('start RL agent')
     logger.info('params ' + str(params))
+    plan = resources.ResourcePlan(params)
+    logger.info('resources: ' + plan.summary())
+    plan.apply('learner')
 
     logger.info(str(
         (env.observation_space, env.action_space, 'max_episode_steps', env.spec.max_episode_steps, reward_range)))
@@ -147,20 +264,39 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
     if params["seed"] is not None:
         np.random.seed(params["seed"])
         logger.debug("seed " + str(params["seed"]))
+    if 'actors' in params and params['actors'] > 0:
+        try:
+            return apex.train(params, env.observation_space, env.action_space, reward_range, numavg=numavg,
+                              episode_callback=episode_callback) + (reward_threshold,)
+        finally:
+            env.close()
+    agent = None
+    eval_pool = None
+    vec_rollout = None
+    rec = None
+    sink = metrics.MetricsSink(params['path_exp'] + '_metrics.jsonl' if params['path_exp'] else None)
+    plotter = None
     try:
         agent = torchagent.deepQconv(env.observation_space, env.action_space, reward_range, params)
         num_steps = env.spec.max_episode_steps
         avg = None
         process_upload = None
+        sink.log('start', target=nameenv, reward_threshold=reward_threshold, num_updates=agent.config['num_updates'])
         if params['plot']:
-            plt.ion()
+            if params['path_exp']:
+                # the plots are drawn by another process from the metrics file
+                sink.flush()
+                plotter = metrics.start_plotter(sink.path, out=params['path_exp'] + '_reward.png', show=True)
+            else:
+                logger.info('no plot without --name_exp (it is made from the metrics file)')
 
+        # only the last KEEP_EPISODES values are kept, the full history is in the metrics file
         totrewlist = []
         test_rew_epis = [[], []]
         test_rew_smooth = []
         total_rew_discountlist = []
         testevery = 25
-        useConv = agent.config['conv']
+        useConv = agent.useConv
         max_total_rew_discount = float("-inf")
         max_abs_rew_discount = float("-inf")
 
@@ -171,11 +307,31 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
         else:
             start_episode = 1
 
-        for episode in range(start_episode, params['episodes']):
-            if (episode) % testevery == 0 or episode >= params['episodes'] - numavg:
+        if 'num_envs' in params and params['num_envs'] > 1:
+            # training episodes come from num_envs envs stepped in lockstep, the test episodes use env
+            vec_rollout = agent_utils.VecRollout(agent, make_env(params, params["seed"], num_envs=params['num_envs']),
+                                                 useConv=useConv, discount=agent.config["discount"])
+
+        if 'record_every' in params and params['record_every'] > 0:
+            record_dir = params['record_dir'] or (params['path_exp'] or os.path.join(params['res_dir'], 'run')) + '_rec'
+            rec = recorder.Recorder(record_dir, every=params['record_every'], max_bytes=int(params['record_mb'] * 1024 ** 2),
+                                    video=params['record_video'])
+
+        if params['eval_workers'] > 0:
+            # test episodes run in parallel on weight snapshots, the training loop does not wait for them
+            eval_pool = evaluation.EvalPool(make_env, params, env.observation_space, env.action_space, reward_range,
+                                            params['eval_workers'], base_seed=params['seed'])
+            last_episode = max(start_episode, params['episodes'] - numavg)
+        else:
+            last_episode = params['episodes']
+
+        for episode in range(start_episode, last_episode):
+            if eval_pool is None and ((episode) % testevery == 0 or episode >= params['episodes'] - numavg):
                 is_test = True
             else:
                 is_test = False
+            if eval_pool is not None and episode % testevery == 0:
+                eval_pool.submit(episode, agent.models, params['eval_episodes'])
             if is_test:
                 render = (params['render'])
                 eps = -1
@@ -187,12 +343,15 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
                 learn = True
                 eps = episode
             startt = time.time()
-            total_rew, steps, total_rew_discount, max_qval = agent_utils.do_rollout(agent, env, eps,
-                                                                                    num_steps=num_steps,
-                                                                                    render=render, useConv=useConv,
-                                                                                    discount=agent.config["discount"],
-                                                                                    sleep=sleep, learn=learn)
+            if vec_rollout is not None and not is_test:
+                total_rew, steps, total_rew_discount, max_qval = vec_rollout.next_episode(eps, learn=learn)
+            else:
+                total_rew, steps, total_rew_discount, max_qval = agent_utils.do_rollout(
+                    agent, env, eps, num_steps=num_steps, render=render, useConv=useConv,
+                    discount=agent.config["discount"], sleep=sleep, learn=learn,
+                    store_memory=vec_rollout is None, recorder=None if is_test else rec)
             stopt = time.time()
+            agent.timer.maybe_dump()
             max_total_rew_discount = max(max_total_rew_discount, total_rew_discount)
             max_abs_rew_discount = max(max_abs_rew_discount, abs(total_rew_discount))
             total_steps += steps
@@ -206,40 +365,38 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
             if avg is None:
                 avg = total_rew
             if is_test:
-                test_rew_epis[0].append(total_rew / agent.config['scalereward'])
-                test_rew_epis[1].append(episode)
-                inc = max(0.2, 0.05 + 1. / (episode) ** 0.5)
-                avg = avg * (1 - inc) + inc * total_rew
-                test_rew_smooth.append(avg / agent.config['scalereward'])
+                test_results = [(episode, [total_rew])]
+            elif eval_pool is not None:
+                test_results = eval_pool.poll()
+            else:
+                test_results = []
+            for test_episode, test_rewards in test_results:
+                if len(test_rewards) > 0:
+                    avg = update_test_stats(avg, test_episode, test_rewards, test_rew_epis, test_rew_smooth,
+                                            agent.config['scalereward'])
+                    sink.log('test', episode=test_episode, reward=float(test_rew_epis[0][-1]),
+                             smooth=float(test_rew_smooth[-1]), episodes=len(test_rewards))
 
             if episode % 10 == 0:
                 print(agent.config)
             totrewlist.append(total_rew / agent.config['scalereward'])
             total_rew_discountlist.append(total_rew_discount / agent.config['scalereward'])
+            sink.log('episode', episode=episode, reward=float(totrewlist[-1]),
+                     disc_reward=float(total_rew_discountlist[-1]), steps=steps, test=is_test,
+                     seconds=round(stopt - startt, 4), updates=agent.config['num_updates'], total_steps=total_steps,
+                     eps=float(agent.epsilon(eps)), lr=float(agent.getlearnrate()))
+            for values in (totrewlist, total_rew_discountlist, test_rew_epis[0], test_rew_epis[1], test_rew_smooth):
+                trim(values, max(KEEP_EPISODES, numavg))
             if (episode + 1 - start_episode) % 250 == 0:
                 if agent.config["path_exp"] is not None:
                     print("saving...")
                     agent.config['final_episode'] = episode
                     if 'results' not in agent.config:
                         agent.config['results'] = {}
-                    if 'all_reward' not in agent.config['results']:
-                        agent.config['results']['all_reward'] = []
-                    if 'all_reward_train' not in agent.config['results']:
-                        agent.config['results']['all_reward_train'] = {}
-
-                    if 'ep2updates' not in agent.config['results']:
-                        agent.config['results']['ep2updates'] = {}
-                    agent.config['results']['ep2updates'][str(episode)] = agent.config['num_updates']
-
-                    if 'ep2steps' not in agent.config['results']:
-                        agent.config['results']['ep2steps'] = {}
-                    agent.config['results']['ep2steps'][str(episode)] = total_steps
-
-                    agent.config['results']['all_reward_train'][str(episode)] = np.mean(totrewlist[-100:])
-                    if 'all_reward_test' not in agent.config['results']:
-                        agent.config['results']['all_reward_test'] = {}
-                    agent.config['results']['all_reward_test'][str(episode)] = np.mean(test_rew_epis[0][-10:])
-
+                    # the per-checkpoint history goes to the metrics file, the config keeps the last values
+                    sink.log('checkpoint', episode=episode, updates=agent.config['num_updates'],
+                             total_steps=total_steps, train_reward=float(np.mean(totrewlist[-100:])),
+                             test_reward=float(np.mean(test_rew_epis[0][-10:])) if test_rew_epis[0] else None)
                     agent.config['results']['num_updates'] = agent.config['num_updates']
                     agent.config['results']['episode'] = episode
                     agent.config['results']['test_reward'] = np.mean(test_rew_epis[0][-10:])
@@ -270,11 +427,28 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
                                                                             total_steps,
                                                                             agent.config['num_updates'] / 50000,
                                                                             agent.getlearnrate()))
-            if is_test and params['plot']:
-                agent.plot([], (totrewlist, test_rew_smooth, test_rew_epis), reward_threshold, plt, plot=params['plot'],
-                           numplot=1, start_episode=start_episode)
+            if episode_callback is not None and episode_callback(episode, totrewlist, test_rew_epis) is False:
+                logger.info('training stopped by episode_callback at episode {}'.format(episode))
+                break
+
+        if eval_pool is not None:
+            # final greedy episodes: the training is over, so here we wait for all the results
+            eval_pool.submit(last_episode, agent.models, numavg)
+            for test_episode, test_rewards in eval_pool.wait():
+                if len(test_rewards) == 0:
+                    continue
+                if avg is None:
+                    avg = test_rewards[0]
+                avg = update_test_stats(avg, test_episode, test_rewards, test_rew_epis, test_rew_smooth,
+                                        agent.config['scalereward'])
+                sink.log('test', episode=test_episode, reward=float(test_rew_epis[0][-1]),
+                         smooth=float(test_rew_smooth[-1]), episodes=len(test_rewards))
+                if test_episode == last_episode:
+                    totrewlist += [r / agent.config['scalereward'] for r in test_rewards]
+            logger.info("final test reward {:.2f} over {} episodes".format(np.mean(totrewlist[-numavg:]), numavg))
 
         print(agent.config)
+        agent.timer.dump()
     except Exception as e:
         print('Exception', e)
         env.close()
@@ -283,4 +457,20 @@ def main(params=[], callback=None, upload_ckp=False, numavg=100, sleep=0.0):
         pass
     finally:
         env.close()
+        if agent is not None:
+            agent.close()
+        if eval_pool is not None:
+            eval_pool.close()
+        if rec is not None:
+            rec.close()
+        # also stops the plot process
+        sink.log('end', updates=agent.config['num_updates'] if agent is not None else 0)
+        sink.close()
+        if plotter is not None:
+            try:
+                plotter.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                plotter.terminate()
+        if vec_rollout is not None:
+            vec_rollout.venv.close()
     return np.mean(totrewlist[-numavg:]), agent.config, totrewlist, test_rew_smooth, test_rew_epis, reward_threshold
@@ -0,0 +1,224 @@
+'''
+random hyperparameter search over common.rangeparameters.
+
+trials run run.main in a process pool (one fresh process per trial, with its share of the cpus),
+every finished trial is appended to <out>/trials.jsonl, so an interrupted search resumes
+from the trials not recorded yet. A trial whose average reward at a checkpoint episode is
+below the median of the other trials at the same checkpoint is stopped (median stopping rule).
+
+example:
+python -m agent.search --target LunarLander-v2 --trials 40 --procs 4 --threads 2 --episodes 1500
+'''
+import os
+import sys
+import json
+import math
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+
+from . import common
+from . import default_params
+from . import resources
+
+logger = logging.getLogger(__name__)
+
+# sampled on a log scale
+LOG_SCALE = {'initial_learnrate', 'batch_size'}
+
+
+def sample_params(rng, target):
+    """
+    sample a valid configuration from common.rangeparameters
+    """
+    defaults = default_params.get_default(target)
+    while True:
+        assigned = {}
+        while True:
+            r = common.rangeparameters(assigned)
+            if r is None or r[0] in assigned:
+                break
+            name, typ, values = r
+            if typ == bool:
+                assigned[name] = bool(values[rng.randint(len(values))])
+            elif name in LOG_SCALE and values[0] > 0:
+                v = math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+                assigned[name] = int(round(v)) if typ == int else v
+            elif typ == int:
+                assigned[name] = int(rng.randint(values[0], values[1] + 1))
+            else:
+                assigned[name] = float(rng.uniform(values[0], values[1]))
+        # copyQ is a period in the agent config
+        if 'copyQ' in assigned:
+            if assigned['copyQ']:
+                assigned['copyQ'] = defaults['copyQ'] if defaults['copyQ'] > 0 else 1000
+            else:
+                assigned['copyQ'] = -1
+        else:
+            assigned['copyQ'] = -1
+        assigned.setdefault('doubleQ', False)
+        ok, msg = common.checkparams(assigned)
+        if ok:
+            return assigned
+        logger.debug('invalid sample {}: {}'.format(assigned, msg))
+
+
+def load_store(path):
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    rec = json.loads(line)
+                    records[rec['trial']] = rec
+    return records
+
+
+def append_store(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class MedianStopping(object):
+    """
+    callback for run.main: at the checkpoint episodes compares the mean reward of the last `window`
+    episodes with the other trials and returns False when the trial is below their median
+    """
+    def __init__(self, checkpoints, shared, lock, min_trials=3, window=100):
+        self.checkpoints = set(checkpoints)
+        self.shared = shared
+        self.lock = lock
+        self.min_trials = min_trials
+        self.window = window
+        self.history = {}
+        self.stopped_at = None
+        self.episodes = 0
+
+    def __call__(self, episode, totrewlist, test_rew_epis):
+        # run.main keeps only the last rewards in totrewlist
+        self.episodes += 1
+        if episode not in self.checkpoints:
+            return True
+        value = float(np.mean(totrewlist[-self.window:]))
+        self.history[episode] = value
+        with self.lock:
+            others = list(self.shared.get(episode, []))
+            self.shared[episode] = others + [value]
+        if len(others) >= self.min_trials and value < np.median(others):
+            logger.info('pruned at episode {}: {:.2f} < median {:.2f}'.format(episode, value, np.median(others)))
+            self.stopped_at = episode
+            return False
+        return True
+
+
+def _init_worker(threads):
+    # before the libraries are loaded, run.main applies the resource plan of the trial
+    resources.set_threads(threads, resources.CV2_THREADS)
+
+
+def _run_trial(trial, config, res_dir, episodes, numavg, checkpoints, shared, lock, free_cpus):
+    from . import run
+    name = 'trial_{}'.format(trial)
+    path_exp = os.path.join(res_dir, name)
+    if not os.path.exists(path_exp + '.json'):
+        config = dict(config, name_exp=name, res_dir=res_dir, path_exp=path_exp)
+        with open(path_exp + '.json', 'w') as f:
+            json.dump(config, f, indent=3)
+    stopper = MedianStopping(checkpoints, shared, lock)
+    record = {'trial': trial, 'params': config['search_params']}
+    # a free share of the cpus, given back when the trial ends (at most procs trials run at a time)
+    cpus = free_cpus.get()
+    try:
+        reward = run.main(
+            ['--name_exp', name, '--res_dir', res_dir, '--no_cuda', '--no_plot', '--cpus', cpus],
+            numavg=numavg, episode_callback=stopper)[0]
+        record['status'] = 'done' if stopper.stopped_at is None else 'pruned'
+        record['reward'] = float(reward)
+        record['episodes'] = stopper.episodes
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = repr(e)
+    finally:
+        free_cpus.put(cpus)
+    record['checkpoints'] = {str(k): v for k, v in stopper.history.items()}
+    return record
+
+
+def search(target, trials, procs, threads, episodes, res_dir, seed=0, numavg=100, checkpoints=None):
+    if not os.path.exists(res_dir):
+        os.makedirs(res_dir)
+    store = os.path.join(res_dir, 'trials.jsonl')
+    done = load_store(store)
+    if checkpoints is None:
+        checkpoints = [c for c in [episodes // 8, episodes // 4, episodes // 2] if c > 0]
+
+    ctx = multiprocessing.get_context('spawn')
+    manager = ctx.Manager()
+    shared = manager.dict()
+    lock = manager.Lock()
+    # the checkpoint rewards of the recorded trials are used for pruning after a resume
+    for rec in done.values():
+        for k, v in rec.get('checkpoints', {}).items():
+            shared[int(k)] = list(shared.get(int(k), [])) + [v]
+
+    def record(rec):
+        # called in the main process as soon as a trial finishes
+        append_store(store, rec)
+        done[rec['trial']] = rec
+        logger.info('trial {trial} {status} reward {r}'.format(r=rec.get('reward'), **rec))
+
+    from . import run
+    base = run.getparams(['--target', target, '--episodes', str(episodes), '--no_cuda', '--no_plot'])
+    # free list of the cpu shares: the trials running at the same time get different cpus
+    free_cpus = manager.Queue()
+    for share in resources.split_cpus(resources.parse_cpus(None), procs):
+        free_cpus.put(resources.format_cpus(share[:threads]))
+    pending = []
+    pool = ctx.Pool(procs, initializer=_init_worker, initargs=(threads,), maxtasksperchild=1)
+    for trial in range(trials):
+        if trial in done:
+            continue
+        sampled = sample_params(np.random.RandomState(seed * 100003 + trial), target)
+        config = dict(base)
+        config.update(sampled)
+        config['search_params'] = sampled
+        config['seed'] = seed * 100003 + trial
+        pending.append(pool.apply_async(_run_trial, (trial, config, res_dir, episodes, numavg, checkpoints,
+                                                     shared, lock, free_cpus), callback=record))
+    logger.info('{} trials recorded, {} to run'.format(len(done), len(pending)))
+    try:
+        for p in pending:
+            p.wait()
+    finally:
+        pool.terminate()
+        manager.shutdown()
+    best = [r for r in done.values() if r['status'] == 'done']
+    best.sort(key=lambda r: -r['reward'])
+    return best
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', default='LunarLander-v2')
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--procs', type=int, default=max(1, multiprocessing.cpu_count() // 2))
+    parser.add_argument('--threads', type=int, default=1, help='threads per trial')
+    parser.add_argument('--episodes', type=int, default=1000)
+    parser.add_argument('--numavg', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--res_dir', default='out_dir/search')
+    parser.add_argument('--logging', default='INFO')
+    args = parser.parse_args(args)
+    common.init_logger(None, args.logging)
+    best = search(args.target, args.trials, args.procs, args.threads, args.episodes, args.res_dir,
+                  seed=args.seed, numavg=args.numavg)
+    for r in best[:5]:
+        print('trial', r['trial'], 'reward', r['reward'], r['params'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+'''
+deterministic synthetic environments for benchmarks: no ROMs, and the cost of a step is fixed
+(step_cost seconds of busy wait, to emulate the emulator) so that the agent overhead can be measured.
+importing the module registers SyntheticAtari-v0 and SyntheticCartPole-v0 in gym.
+'''
+import time
+import numpy as np
+import gym
+import gym.spaces
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SyntheticAtari(gym.Env):
+    """
+    210x160x3 uint8 frames from a fixed bank of random frames, reward 1 when the action matches
+    a fixed sequence, a life is lost every life_steps steps ('ale.lives' in info as ALE)
+    """
+    metadata = {'render.modes': []}
+
+    def __init__(self, num_actions=4, step_cost=0., lives=5, life_steps=200, num_frames=64, seed=0):
+        self.observation_space = gym.spaces.Box(0, 255, (210, 160, 3), dtype=np.uint8)
+        self.action_space = gym.spaces.Discrete(num_actions)
+        self.reward_range = (0, 1)
+        self.step_cost = step_cost
+        self.lives = lives
+        self.life_steps = life_steps
+        self.num_frames = num_frames
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        self.frames = self.rng.randint(0, 256, (self.num_frames,) + self.observation_space.shape).astype(np.uint8)
+        self.targets = self.rng.randint(0, self.action_space.n, 1000)
+        return [seed]
+
+    def reset(self):
+        self.t = 0
+        self.lives_left = self.lives
+        return self.frames[0].copy()
+
+    def step(self, action):
+        if self.step_cost > 0:
+            busy_wait(self.step_cost)
+        reward = float(action == self.targets[self.t % len(self.targets)])
+        self.t += 1
+        if self.t % self.life_steps == 0:
+            self.lives_left -= 1
+        done = self.lives_left == 0
+        return self.frames[self.t % self.num_frames].copy(), reward, done, {'ale.lives': self.lives_left}
+
+
+class SyntheticCartPole(gym.Env):
+    """
+    4 dimensional observations like CartPole with deterministic linear dynamics:
+    the action pushes the cart, the episode ends when the position or the angle leave the bounds
+    """
+    metadata = {'render.modes': []}
+
+    def __init__(self, step_cost=0., seed=0):
+        high = np.array([4.8, np.finfo(np.float32).max, 0.42, np.finfo(np.float32).max], dtype=np.float32)
+        self.observation_space = gym.spaces.Box(-high, high, dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(2)
+        self.reward_range = (0, 1)
+        self.step_cost = step_cost
+        self.dynamics = np.array([[1., 0.02, 0., 0.],
+                                  [0., 1., -0.01, 0.],
+                                  [0., 0., 1., 0.02],
+                                  [0., 0., 0.3, 1.]], dtype=np.float32)
+        self.push = np.array([0., 0.2, 0., -0.3], dtype=np.float32)
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        return [seed]
+
+    def reset(self):
+        self.state = self.rng.uniform(-0.05, 0.05, 4).astype(np.float32)
+        return self.state.copy()
+
+    def step(self, action):
+        if self.step_cost > 0:
+            busy_wait(self.step_cost)
+        self.state = self.dynamics.dot(self.state) + self.push * (2. * action - 1.)
+        done = bool(abs(self.state[0]) > 2.4 or abs(self.state[2]) > 0.21)
+        return self.state.copy(), 1., done, {}
+
+
+def register():
+    for env_id, entry_point, max_steps in [('SyntheticAtari-v0', 'SyntheticAtari', 10000),
+                                           ('SyntheticCartPole-v0', 'SyntheticCartPole', 500)]:
+        try:
+            gym.envs.registry.spec(env_id)
+        except gym.error.Error:
+            gym.envs.registration.register(id=env_id, entry_point=__name__ + ':' + entry_point,
+                                           max_episode_steps=max_steps)
+
+
+register()
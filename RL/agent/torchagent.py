@@ -1,10 +1,7 @@
-from numba import jit, jitclass
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import tensorflow as tf
 import os, sys, shutil
-import gym
 import time
 import numpy as np
 from torch.autograd import Variable
@@ -12,19 +9,15 @@ import logging
 from . import common
 from . import models
 from . import buffers
+from . import profiling
+from . import resources
 
-from .agent_utils import onehot, vis
+from .agent_utils import onehot, vis, Preprocessor
 import json
 import pickle
 
 import copy
 
-import matplotlib.pyplot as plt0
-
-try:
-    import IPython.display  # for ipython/notebook compatibility
-except:
-    plt0.ion()
 logger = logging.getLogger(__name__)
 
 
@@ -47,6 +40,8 @@ class deepQconv(object):
         self.observation_space = observation_space
         self.action_space = action_space
         self.reward_range = reward_range
+        # imported here: the spaces are gym objects, so gym is already loaded by the caller
+        import gym.spaces
 
         self.isdiscrete = isinstance(self.action_space, gym.spaces.Discrete)
         print(self.action_space)
@@ -55,7 +50,17 @@ class deepQconv(object):
             raise Exception('Observation space {} incompatible with {}. (Only supports Discrete action spaces.)'.format(
                 observation_space, self))
         self.learnrate = self.config['initial_learnrate']
+        self.timer = profiling.make_timer(self.config)
+        self.data_parallel = None
         self.initQnetwork()
+        if 'learner_procs' in self.config and self.config['learner_procs'] > 1:
+            from .parallel_learner import DataParallelLearner
+            self.data_parallel = DataParallelLearner(self, self.config['learner_procs'])
+
+    def close(self):
+        if self.data_parallel is not None:
+            self.data_parallel.close()
+            self.data_parallel = None
 
     def plot(self, w, lists, reward_threshold, plt, plot=True, numplot=0, start_episode=0):
         width = 15000
@@ -158,6 +163,51 @@ class deepQconv(object):
             self.scaled_obs = self.config['dimdobs']
         else:
             self.scaled_obs = self.observation_space.shape
+        scaling = self.config['scaling'] if 'scaling' in self.config else 'none'
+        if 'baseline_env' in self.config and self.config['baseline_env']:
+            self.preprocessor = None
+        else:
+            self.preprocessor = Preprocessor(self.observation_space, self.scaled_obs, type=scaling)
+        # shape and dtype of what is stored in memory and fed to the shared net
+        self.memory_obs = self.scaled_obs
+        self.memory_dtype = self.observation_space.dtype
+
+        if 'encoder' in self.config and self.config['encoder']:
+            # frozen pretrained encoder: memory stores only its features and the shared net is a MLP
+            if self.config['scaling'] != 'rgb' or len(self.scaled_obs) != 3:
+                raise Exception("encoder requires scaling 'rgb' and dimdobs (height, width, channels)")
+            norm = self.config['encoder_norm'] if 'encoder_norm' in self.config else [0.5, 0.5]
+            self.encoder = models.FrozenEncoder(models.load_encoder(self.config['encoder'], self.device),
+                                                scale=1. / 255., mean=norm[0], std=norm[1]).to(self.device)
+            enc_input = [self.scaled_obs[-1]] + list(self.scaled_obs[:-1])
+            num_features = self.encoder(torch.zeros([1] + enc_input, device=self.device)).shape[-1]
+            logger.info('frozen encoder {} features {}'.format(self.config['encoder'], num_features))
+            self.useConv = False
+            self.memory_obs = (num_features,)
+            self.memory_dtype = np.float32
+        else:
+            self.encoder = None
+
+    def to_input(self, observation):
+        """
+        observation batch as tensor on the device. uint8 frames for the conv net are copied as they are
+        (4x less data), the cast and scaling are done inside ConvNet
+        """
+        var_obs = torch.from_numpy(observation).to(self.device, non_blocking=True)
+        if not self.useConv or var_obs.dtype != torch.uint8:
+            var_obs = var_obs.float()
+        return var_obs
+
+    def encode(self, obs):
+        """
+        features of a single preprocessed frame (channel first) from the frozen encoder
+        """
+        return self.encode_batch(obs[None, ...])[0]
+
+    def encode_batch(self, obs):
+        var_obs = torch.from_numpy(np.ascontiguousarray(obs)).to(self.device, non_blocking=True)
+        with torch.no_grad():
+            return self.encoder(var_obs).cpu().numpy()
 
     def sharednet(self, input, state_dict=None):
         if self.useConv:
@@ -165,7 +215,8 @@ class deepQconv(object):
                                         activation=self.config['activation'],
                                         # numchannels=1 + 1 * self.config['past'],
                                         scale=self.config['scaleobs'],
-                                        init_weight=self.config["init_weight"])
+                                        init_weight=self.config["init_weight"],
+                                        channels_last='channels_last' in self.config and self.config['channels_last'])
             dense_conv_shape = dense_conv(torch.zeros([1] + input)).shape
             if len(self.config['sharedlayers']) > 0:
                 dense = models.DenseNet(self.config['sharedlayers'], input_shape=dense_conv_shape[-1],
@@ -179,14 +230,16 @@ class deepQconv(object):
                 dense = dense_conv
                 num_features = dense_conv_shape[-1]
         else:
+            # encoder features are used as they are
+            scale = 1. if self.encoder is not None else self.config['scaleobs']
             if len(self.config['sharedlayers']) > 0:
                 dense = models.DenseNet(self.config['sharedlayers'], input_shape=input[-1],
-                                        scale=self.config['scaleobs'], final_act=True,
+                                        scale=scale, final_act=True,
                                         activation=self.config['activation'], batch_norm=self.config["batch_norm"],
                                         init_weight=self.config["init_weight"])
                 num_features = self.config['sharedlayers'][-1]
             else:
-                dense = models.ScaledIdentity(self.config['scaleobs'])
+                dense = models.ScaledIdentity(scale)
                 num_features = input[-1]
         if state_dict:
             dense.load_state_dict(state_dict)
@@ -244,15 +297,15 @@ class deepQconv(object):
             logger.info('no checkpoint loaded')
             checkpoint = {'shared': None, 'V': None, 'policy': None, "T": None, "Q": None, "optimizer": None}
         self.learnable_parameters = []
-        self.commoninit()
         use_cuda = self.config['use_cuda']
         self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.commoninit()
         if self.isdiscrete:
             print('scaled', self.scaled_obs)
-            n_input = list(self.scaled_obs[:-1]) + [self.scaled_obs[-1] * (self.config[
+            n_input = list(self.memory_obs[:-1]) + [self.memory_obs[-1] * (self.config[
                                                                                'past'] + 1)]  # + self.observation_space.shape[0]*onehot(0,len(self.observation_space.shape))*(self.config['past'])
             if self.useConv == False:
-                n_input = [int(np.prod(self.scaled_obs + (1 * (self.config['past'] + 1),)))]
+                n_input = [int(np.prod(tuple(self.memory_obs) + (1 * (self.config['past'] + 1),)))]
             else:
                 n_input = [n_input[-1]] + list(n_input[:-1])
             self.n_out = self.action_space.n
@@ -260,6 +313,7 @@ class deepQconv(object):
         else:
             raise NotImplemented
         print(self.observation_space, 'obs', n_input, 'action', self.n_out)
+        self.input_shape = tuple(n_input)
 
         self.shared, self.len_shared_features = self.sharednet(n_input, checkpoint["shared"])
         self.shared = self.shared.to(self.device, non_blocking=True)
@@ -311,54 +365,9 @@ class deepQconv(object):
         else:
             raise NotImplemented
 
-        if self.config['policy'] == False:
-            if self.config['doubleQ']:
-                raise NotImplementedError
-                # fixme to remove (old tf implementation)
-                self.singleQ2 = tf.reduce_sum(self.curraction * self.Q2,
-                                              reduction_indices=1)  # tf.reduce_sum(input_tensor, reduction_indices, keep_dims, name)#tf.slice(self.Q, [0,self.curraction],[-1,1])  #self.Q[:,self.out]
-                with tf.variable_scope('copyQ', reuse=True):
-                    self.Q2next = self.fullQNet(self.nextstate, reuse=True)
-                argmaxQnext = tf.cast(tf.argmax(self.Qnext, 1), dtype=tf.int32)
-                argmaxQ2next = tf.cast(tf.argmax(self.Q2next, 1), dtype=tf.int32)
-                cat_idx2 = tf.stack([tf.range(0, tf.shape(self.Qnext)[0]), argmaxQ2next], axis=1)
-                cat_idx1 = tf.stack([tf.range(0, tf.shape(self.Qnext)[0]), argmaxQnext], axis=1)
-                maxQnext1 = tf.gather_nd(self.Qnext, cat_idx2)
-                maxQnext2 = tf.gather_nd(self.Q2next, cat_idx1)
-                if self.config['episodic']:
-                    delta2 = self.singleQ2 - (
-                            self.reward + self.config["discount"] * tf.stop_gradient(maxQnext1) * self.notdone)
-                    delta = self.singleQ - (
-                            self.reward + self.config["discount"] * tf.stop_gradient(maxQnext2) * self.notdone)
-                else:
-                    delta2 = self.singleQ2 - (
-                            self.reward + self.config["discount"] * tf.stop_gradient(maxQnext1))
-                    delta = self.singleQ - (
-                            self.reward + self.config["discount"] * tf.stop_gradient(maxQnext2))
-
-                tf.summary.histogram('Q2', self.Q2)
-                # assert self.singleQ2.get_shape() == self.y.get_shape()
-
-            if self.config['doubleQ']:
-                # fixme to remove (old tf implementation)
-                if self.config['clip'] > 0 and "cliptype" in self.config and self.config['cliptype'] == 'deltaclip':
-                    self.errorlist2 = clipdelta(delta2, self.config['clip'])
-                else:
-                    self.errorlist2 = 0.5 * delta2 ** 2
-
-            if self.config['doubleQ']:
-                # fixme to remove (old tf implementation)
-                if regul != []:
-                    logger.warning("doubleQ with regularization not properly implemented")
-                self.cost2 = tf.reduce_mean(self.errorlist2)
-                self.optimizer2 = tf.train.RMSPropOptimizer(self.learnrate, decay=self.config['decayoptimizer'],
-                                                            momentum=self.config['momentum'],
-                                                            epsilon=self.config['epsoptimizer'])
-                if self.config["clip"] > 0 and self.config['cliptype'] != 'deltaclip':
-                    self.optimizer2 = self.clip(self.optimizer2, self.cost2, global_step=self.global_step,
-                                                lim=self.config['clip'])
-                else:
-                    self.optimizer2 = self.optimizer2.minimize(self.cost2, global_step=self.global_step)
+        if self.config['policy'] == False and self.config['doubleQ']:
+            # the old tensorflow implementation of doubleQ was never ported
+            raise NotImplementedError
 
         if 'optimizer' in self.config:
             if self.config['optimizer'] == "adam":
@@ -387,166 +396,215 @@ class deepQconv(object):
         if 'num_updates' not in self.config:
             self.config['num_updates'] = 0
 
+        # before a replay memory is loaded, so that the rss of the process does not count it
+        plan = resources.MemoryPlan(self.config, self.memory_obs, self.memory_dtype, self.action_space,
+                                    self.input_shape,
+                                    [getattr(self, name) for name in ['copy_shared', 'copy_Q'] if hasattr(self, name)] +
+                                    list(self.models.values()))
         if self.config["path_exp"] is not None and (os.path.exists(self.config["path_exp"] + "_mem.p")
                                                     or os.path.exists(self.config["path_exp"] + "_mem.p.zip")):
             self.memory = buffers.load_zipped_pickle(self.config["path_exp"] + "_mem.p")
             logger.info('memory loaded')
+            # batch_size capped to the ram budget, the plan is logged (a warning if the memory does not fit)
+            plan.apply(loaded=True)
         else:
+            # memsize and batch_size capped to the ram budget, the plan is logged
+            plan.apply()
             # self.memory = ReplayMemory(self.config['memsize'],use_priority=self.config['priority_memory'])
-            self.memory = buffers.ReplayMemory(self.config['memsize'], self.scaled_obs, self.observation_space.dtype,
-                                               self.action_space, self.config['past'], self.config['discount'])
+            self.memory = self.make_memory()
         print((self.config['memsize'],) + tuple(n_input))
 
+    def make_memory(self):
+        """
+        replay memory of config['memsize'] transitions in total, as the rollout writes it
+        """
+        if 'actors' in self.config and self.config['actors'] > 0:
+            # apex learner: one stream per actor process
+            return buffers.StreamReplayMemory(self.config['actors'], self.config['memsize'] // self.config['actors'],
+                                              self.memory_obs, self.memory_dtype, self.action_space,
+                                              self.config['past'], self.config['discount'])
+        elif 'num_envs' in self.config and self.config['num_envs'] > 1:
+            # one stream per env of the vectorized rollout, memsize is the total
+            return buffers.VecReplayMemory(self.config['num_envs'], self.config['memsize'] // self.config['num_envs'],
+                                           self.memory_obs, self.memory_dtype, self.action_space,
+                                           self.config['past'], self.config['discount'])
+        return buffers.ReplayMemory(self.config['memsize'], self.memory_obs, self.memory_dtype,
+                                    self.action_space, self.config['past'], self.config['discount'])
+
     def learn(self, force=False):
         self.update_learning_rate()
         for m in self.models:
             self.models[m].train()
+        self.copy_target()
+
+        update = (np.random.random() < self.config['probupdate'])
+        if update or force:
+            if self.memory.sizemem() > self.config['randstart']:
+                if self.data_parallel is not None:
+                    self.data_parallel.start_update()
+                self.gradient_step()
+        return self.config['num_updates']
+
+    def copy_target(self):
         if self.config['copyQ'] > 0 and self.config['num_updates'] % self.config['copyQ'] == 0:
             logger.debug('copying Q')
             self.copy_shared.load_state_dict(self.shared.state_dict())
             self.copy_Q.load_state_dict(self.Q.state_dict())
 
-        update = (np.random.random() < self.config['probupdate'])
-        if update or force:
-            if self.memory.sizemem() > self.config['randstart']:
-                self.config['num_updates'] += 1
-                ind = self.memory.sample(self.config['batch_size'])
-                allstate, actions, currew, notdonevec, step_vec, total_reward, step2end = self.memory[ind]
-                nextstates, _, _, _, _, _, _ = self.memory[ind + 1]
-                allactionsparse = np.eye(self.n_out, dtype=np.float32)[actions]
-                if self.config['lambda'] > 0:
-                    raise NotImplementedError
-                # i = 0
-                # #  [0 state, 1 action, 2 reward, 3 notdone, 4 step, 5 total_reward]
-                # if self.config['lambda'] > 0:
-                #     raise NotImplementedError
-                #     #fixme old code won't work anymore
-                #     for j in ind:
-                #         if (np.random.random() < 0.01 or total_reward[j,0].isnan()):
-                #             limitd = 500
-                #             gamma = 1.
-                #             offset = 0
-                #             nextstate = 1  # next state relative index
-                #
-                #             n = j
-                #             while nextstate != None and offset < limitd:
-                #                 total_reward[i, 0] += gamma * self.memory[n][2]
-                #                 gamma = gamma * self.config['discount']
-                #                 if n + nextstate * 2 >= self.memory.sizemem() or not (offset + nextstate < limitd) or \
-                #                         self.memory[n][3] == 0:
-                #                     total_reward[i, 0] += gamma * self.maxq(self.memory[n + nextstate][0][None,...]) * \
-                #                                              self.memory[n][3]
-                #                     nextstate = None
-                #                 else:
-                #                     offset += nextstate
-                #                     n = j + offset
-                #             self.memory[j][5] = total_reward[i, 0]
-                #         else:
-                #             total_reward[i, 0] = self.memory[j][5]
-                #         i += 1
-
-                flag = np.random.random() < 0.5 and self.fulldouble
-                self.optimizer.zero_grad()
-                if self.config['doubleQ'] and flag:
-                    raise NotImplemented
-                    if self.newQ:
-                        self.sess.run(self.optimizer2, feed_dict={
-                            self.x: allstate,
-                            self.reward: currew.reshape((-1,)),
-                            self.notdone: notdonevec.reshape((-1,)),
-                            self.nextstate: nextstates,
-                            self.curraction: allactionsparse})
-                    else:
-                        self.sess.run(self.optimizer2, feed_dict={
-                            self.x: allstate,
-                            self.y: alltarget.reshape((-1, 1)),
-                            self.curraction: allactionsparse})
-                else:
-                    allactionsparse = torch.from_numpy(allactionsparse).to(self.device, non_blocking=True)
-                    allstate = torch.from_numpy(allstate).to(self.device, non_blocking=True).float()
-                    nextstates = torch.from_numpy(nextstates).to(self.device, non_blocking=True).float()
-                    currew = torch.from_numpy(currew.reshape((-1,))).to(self.device, non_blocking=True)
-                    notdonevec = torch.from_numpy(notdonevec.reshape((-1,))).to(self.device, non_blocking=True)
-                    if self.config['lambda'] > 0:
-                        total_reward = torch.from_numpy(total_reward.reshape((-1,))).to(self.device, non_blocking=True)
-                        step2end = torch.from_numpy(step2end.reshape((-1,))).to(self.device, non_blocking=True)
-                    shared_features = self.shared(allstate)
-                    if self.config['copyQ'] > 0:
-                        next_shared_features = self.copy_shared(nextstates)
-                        maxQnext = torch.max(self.copy_Q(next_shared_features), dim=1)[0]
-                    else:
-                        next_shared_features = self.shared(nextstates)
-                        maxQnext = torch.max(self.Q(next_shared_features), dim=1)[0]
-                    maxQnext = maxQnext.detach()
-                    if self.config['lambda'] > 0:
-                        # todo finish
-                        total_reward += self.memory.discount ** (step2end + 1) * maxQlast
-                    if 'transition_net' in self.config and self.config['transition_net']:
-                        pred_next_features_reward = shared_features + self.T(
-                            torch.cat((shared_features, allactionsparse), 1))
-
-                    currQ = self.Q(shared_features)
-                    singleQ = torch.sum(allactionsparse * currQ, dim=1)
-
-                    if self.config['episodic']:
-                        target = (currew + self.config["discount"] * maxQnext * notdonevec) * (
-                                1. - self.config['lambda'])
-                    else:
-                        target = (currew + self.config["discount"] * maxQnext) * (1. - self.config['lambda'])
-                    if self.config['lambda'] > 0:
-                        target += total_reward * self.config['lambda']
-
-                    if self.config['normalize']:
-                        scale_target = 1. * torch.abs(target).mean().detach() + 0.001
-                        if self.avg_target is None:
-                            self.avg_target = scale_target
-                        else:
-                            self.avg_target = 0.99 * self.avg_target + 0.01 * scale_target
-                        loss = self.criterion(singleQ / self.avg_target,
-                                              target / self.avg_target)
-                        if np.random.random() < 0.001:
-                            print("avg target", self.avg_target.data.item(), "loss", loss.mean().data.item())
-                    else:
-                        loss = self.criterion(singleQ, target)
-                    # if np.random.random() < 0.1:
-                    #    print("max loss",loss.max().data.item(),"abs diff",torch.max(torch.abs(singleQ-target)).data.item())
-                    if self.config['priority_memory']:
-                        alpha = 0.7 * 0.5  # 0.5 because the loss is squared td error
-                        self.memory.set_priority(ind, np.minimum((loss ** alpha).cpu().detach().numpy(), 10.))
-                        beta = 0.7
-                        w = 1.0 / Variable(torch.from_numpy(prob_mem[ind]).float()).to(self.device, non_blocking=True)
-                        w = w ** beta
-                        w /= w.max()
-                        # print(w.min(),w.max(),w.max()/w.min())
-                        loss = (loss * w).sum()
-                    else:
-                        loss = loss.mean()
-                    # print("avg",self.avg_target)
-                    if 'transition_net' in self.config and self.config['transition_net'] and self.config[
-                        'transition_weight'] > 0:
-                        target_tr = next_shared_features.detach()  # fixme  #torch.cat((next_shared_features,currew.view(-1,1)/scale_target),1).detach()
-                        target_mean = 1. * torch.abs(target_tr).mean() + 0.01
-                        # target_mean = target_mean.detach()
-                        loss_trans = torch.mean(
-                            (pred_next_features_reward / (target_mean) - target_tr / (target_mean)) ** 2)
-
-                        if self.avg_loss_trans is None:
-                            self.avg_loss_trans = loss_trans.data.item()
-                        self.avg_loss_trans = self.avg_loss_trans * 0.99 + loss_trans.data.item() * 0.01
-
-                        if np.random.random() < 0.01:
-                            print("loss_trans", self.avg_loss_trans)
-                            print("dist", torch.mean((pred_next_features_reward - target_tr) ** 2).sqrt().data.item())
-                        loss += self.config['transition_weight'] * loss_trans
-
-                loss.backward()
-                if 'norm_clip' in self.config and self.config['norm_clip']:
-                    torch.nn.utils.clip_grad_norm_(self.learnable_parameters, 0.5)
-                if 'val_clip' in self.config and self.config['val_clip']:
-                    torch.nn.utils.clip_grad_value_(self.learnable_parameters, 1)
-                self.optimizer.step()
+    def gradient_step(self):
+        timer = self.timer
+        t0 = timer.tic()
+        self.config['num_updates'] += 1
+        if self.data_parallel is not None:
+            batch_size = self.data_parallel.shard_size()
+        else:
+            batch_size = self.config['batch_size']
+        ind = self.memory.sample(batch_size)
+        allstate, actions, currew, notdonevec, step_vec, total_reward, step2end = self.memory[ind]
+        nextstates, _, _, _, _, _, _ = self.memory[ind + 1]
+        allactionsparse = np.eye(self.n_out, dtype=np.float32)[actions]
+        if self.config['lambda'] > 0:
+            raise NotImplementedError
+        # i = 0
+        # #  [0 state, 1 action, 2 reward, 3 notdone, 4 step, 5 total_reward]
+        # if self.config['lambda'] > 0:
+        #     raise NotImplementedError
+        #     #fixme old code won't work anymore
+        #     for j in ind:
+        #         if (np.random.random() < 0.01 or total_reward[j,0].isnan()):
+        #             limitd = 500
+        #             gamma = 1.
+        #             offset = 0
+        #             nextstate = 1  # next state relative index
+        #
+        #             n = j
+        #             while nextstate != None and offset < limitd:
+        #                 total_reward[i, 0] += gamma * self.memory[n][2]
+        #                 gamma = gamma * self.config['discount']
+        #                 if n + nextstate * 2 >= self.memory.sizemem() or not (offset + nextstate < limitd) or \
+        #                         self.memory[n][3] == 0:
+        #                     total_reward[i, 0] += gamma * self.maxq(self.memory[n + nextstate][0][None,...]) * \
+        #                                              self.memory[n][3]
+        #                     nextstate = None
+        #                 else:
+        #                     offset += nextstate
+        #                     n = j + offset
+        #             self.memory[j][5] = total_reward[i, 0]
+        #         else:
+        #             total_reward[i, 0] = self.memory[j][5]
+        #         i += 1
+
+        flag = np.random.random() < 0.5 and self.fulldouble
+        self.optimizer.zero_grad()
+        if self.config['doubleQ'] and flag:
+            raise NotImplemented
+            if self.newQ:
+                self.sess.run(self.optimizer2, feed_dict={
+                    self.x: allstate,
+                    self.reward: currew.reshape((-1,)),
+                    self.notdone: notdonevec.reshape((-1,)),
+                    self.nextstate: nextstates,
+                    self.curraction: allactionsparse})
+            else:
+                self.sess.run(self.optimizer2, feed_dict={
+                    self.x: allstate,
+                    self.y: alltarget.reshape((-1, 1)),
+                    self.curraction: allactionsparse})
+        else:
+            allactionsparse = torch.from_numpy(allactionsparse).to(self.device, non_blocking=True)
+            allstate = self.to_input(allstate)
+            nextstates = self.to_input(nextstates)
+            currew = torch.from_numpy(currew.reshape((-1,))).to(self.device, non_blocking=True)
+            notdonevec = torch.from_numpy(notdonevec.reshape((-1,))).to(self.device, non_blocking=True)
+            if self.config['lambda'] > 0:
+                total_reward = torch.from_numpy(total_reward.reshape((-1,))).to(self.device, non_blocking=True)
+                step2end = torch.from_numpy(step2end.reshape((-1,))).to(self.device, non_blocking=True)
+            t0 = timer.toc('learn_sample', t0)
+            shared_features = self.shared(allstate)
+            if self.config['copyQ'] > 0:
+                next_shared_features = self.copy_shared(nextstates)
+                maxQnext = torch.max(self.copy_Q(next_shared_features), dim=1)[0]
+            else:
+                next_shared_features = self.shared(nextstates)
+                maxQnext = torch.max(self.Q(next_shared_features), dim=1)[0]
+            maxQnext = maxQnext.detach()
+            if self.config['lambda'] > 0:
+                # todo finish
+                total_reward += self.memory.discount ** (step2end + 1) * maxQlast
+            if 'transition_net' in self.config and self.config['transition_net']:
+                pred_next_features_reward = shared_features + self.T(
+                    torch.cat((shared_features, allactionsparse), 1))
 
-        return self.config['num_updates']
+            currQ = self.Q(shared_features)
+            singleQ = torch.sum(allactionsparse * currQ, dim=1)
+
+            if self.config['episodic']:
+                target = (currew + self.config["discount"] * maxQnext * notdonevec) * (
+                        1. - self.config['lambda'])
+            else:
+                target = (currew + self.config["discount"] * maxQnext) * (1. - self.config['lambda'])
+            if self.config['lambda'] > 0:
+                target += total_reward * self.config['lambda']
+
+            if self.config['normalize']:
+                scale_target = torch.abs(target).mean().detach()
+                if self.data_parallel is not None:
+                    # every rank scales its shard by the same running average, the one of the full batch
+                    scale_target = self.data_parallel.batch_mean(scale_target)
+                scale_target = 1. * scale_target + 0.001
+                if self.avg_target is None:
+                    self.avg_target = scale_target
+                else:
+                    self.avg_target = 0.99 * self.avg_target + 0.01 * scale_target
+                loss = self.criterion(singleQ / self.avg_target,
+                                      target / self.avg_target)
+                if np.random.random() < 0.001:
+                    print("avg target", self.avg_target.data.item(), "loss", loss.mean().data.item())
+            else:
+                loss = self.criterion(singleQ, target)
+            # if np.random.random() < 0.1:
+            #    print("max loss",loss.max().data.item(),"abs diff",torch.max(torch.abs(singleQ-target)).data.item())
+            if self.config['priority_memory']:
+                alpha = 0.7 * 0.5  # 0.5 because the loss is squared td error
+                self.memory.set_priority(ind, np.minimum((loss ** alpha).cpu().detach().numpy(), 10.))
+                beta = 0.7
+                w = 1.0 / Variable(torch.from_numpy(prob_mem[ind]).float()).to(self.device, non_blocking=True)
+                w = w ** beta
+                w /= w.max()
+                # print(w.min(),w.max(),w.max()/w.min())
+                loss = (loss * w).sum()
+            else:
+                loss = loss.mean()
+            # print("avg",self.avg_target)
+            if 'transition_net' in self.config and self.config['transition_net'] and self.config[
+                'transition_weight'] > 0:
+                target_tr = next_shared_features.detach()  # fixme  #torch.cat((next_shared_features,currew.view(-1,1)/scale_target),1).detach()
+                target_mean = 1. * torch.abs(target_tr).mean() + 0.01
+                # target_mean = target_mean.detach()
+                loss_trans = torch.mean(
+                    (pred_next_features_reward / (target_mean) - target_tr / (target_mean)) ** 2)
+
+                if self.avg_loss_trans is None:
+                    self.avg_loss_trans = loss_trans.data.item()
+                self.avg_loss_trans = self.avg_loss_trans * 0.99 + loss_trans.data.item() * 0.01
+
+                if np.random.random() < 0.01:
+                    print("loss_trans", self.avg_loss_trans)
+                    print("dist", torch.mean((pred_next_features_reward - target_tr) ** 2).sqrt().data.item())
+                loss += self.config['transition_weight'] * loss_trans
+            t0 = timer.toc('learn_forward', t0)
+
+        loss.backward()
+        t0 = timer.toc('learn_backward', t0)
+        if self.data_parallel is not None:
+            self.data_parallel.allreduce_gradients()
+            t0 = timer.toc('learn_allreduce', t0)
+        if 'norm_clip' in self.config and self.config['norm_clip']:
+            torch.nn.utils.clip_grad_norm_(self.learnable_parameters, 0.5)
+        if 'val_clip' in self.config and self.config['val_clip']:
+            torch.nn.utils.clip_grad_value_(self.learnable_parameters, 1)
+        self.optimizer.step()
+        timer.toc('learn_step', t0)
 
     def plot_state(self, plt, state_list):
         fig = plt.figure(2)
@@ -699,11 +757,11 @@ class deepQconv(object):
         assert self.isdiscrete
 
         if self.copyQalone:
-            var_obs = torch.from_numpy(observation).float().to(self.device, non_blocking=True)
+            var_obs = self.to_input(observation)
             currQ = self.copy_Q(self.copy_shared(var_obs)).cpu().data.numpy()
             return np.max(currQ).reshape(1, )
         else:
-            var_obs = torch.from_numpy(observation).float().to(self.device, non_blocking=True)
+            var_obs = self.to_input(observation)
             currQ = self.Q(self.shared(var_obs)).cpu().data.numpy()
             return np.max(currQ).reshape(1, )
 
@@ -740,7 +798,7 @@ class deepQconv(object):
             if self.config['doubleQ'] and (self.fulldouble and np.random.random() < 0.5):
                 return np.argmax(self.sess.run(self.Q2, feed_dict={self.x: observation}))
             else:
-                var_obs = torch.from_numpy(observation).to(self.device, non_blocking=True).float()
+                var_obs = self.to_input(observation)
                 shared_features = self.shared(var_obs)
                 if np.random.random() < 0.001:
                     logger.debug("shared_features {}".format(shared_features.cpu().data.numpy().reshape(-1, )[:100]))
@@ -755,7 +813,7 @@ class deepQconv(object):
         for m in self.models:
             self.models[m].eval()
         assert observation.ndim > 1
-        var_obs = Variable(torch.from_numpy(observation).float()).to(self.device, non_blocking=True)
+        var_obs = self.to_input(observation)
         currQ = self.Q(self.shared(var_obs)).cpu().data.numpy()  # fixme is this necessary?
         return currQ
 
@@ -765,8 +823,7 @@ class deepQconv(object):
         if self.isdiscrete:
             if observation.ndim == 1:
                 observation = observation.reshape(1, -1)
-        input = torch.from_numpy(observation).float()
-        input = input.to(self.device, non_blocking=True)
+        input = self.to_input(observation)
         if logit:
             prob = self.logitpolicy(self.shared(input))
         else:
@@ -784,8 +841,7 @@ class deepQconv(object):
         for m in self.models:
             self.models[m].eval()
         assert observation.ndim > 1
-        input = torch.from_numpy(observation).float()
-        input = input.to(self.device, non_blocking=True)
+        input = self.to_input(observation)
         v = self.V(self.shared(input))
         if numpy:
             return v.cpu().data.numpy()
@@ -825,7 +881,7 @@ class deepQconv(object):
                 observation = observation.reshape(1, -1)
             else:
                 observation = observation.reshape(tuple([1] + list(observation.shape)))
-            var_obs = Variable(torch.from_numpy(observation).float()).to(self.device, non_blocking=True)
+            var_obs = self.to_input(observation)
             shared_features = self.shared(var_obs)
             best_action_onehot = onehot(action, self.n_out).reshape(1, -1)
             best_action_onehot = Variable(torch.from_numpy(best_action_onehot).float()).to(self.device,
@@ -837,6 +893,27 @@ class deepQconv(object):
 
         return action
 
+    def qvalues(self, observations):
+        """
+        Q values of a batch of observations as numpy array, without building the graph
+        """
+        for m in self.models:
+            self.models[m].eval()
+        with torch.no_grad():
+            return self.Q(self.shared(self.to_input(observations))).cpu().numpy()
+
+    def act_batch(self, observations, episode=None):
+        """
+        epsilon greedy actions for a batch of observations (one per env) with a single forward pass
+        """
+        for m in self.models:
+            self.models[m].eval()
+        eps = self.epsilon(episode)
+        actions = self.qvalues(observations).argmax(1)
+        explore = np.random.random(len(actions)) < eps
+        actions[explore] = np.random.randint(self.n_out, size=explore.sum())
+        return actions
+
     def actpolicy(self, observation, episode=None):
         for m in self.models:
             self.models[m].eval()
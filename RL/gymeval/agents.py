@@ -56,6 +56,61 @@ def onehot(i, n):
     return out
 
 
+class RingMemory(object):
+    """
+    transitions (state, action, reward, next state, notdone) in preallocated arrays used as a ring buffer,
+    the oldest transition is overwritten when the memory is full. indices are from the oldest (0) to the newest.
+    link[row]: the next transition continues the episode, ret[row]: cached lambda return (nan: not computed)
+    """
+    def __init__(self, size, state_dim):
+        self.size = size
+        self.state = np.zeros((size, state_dim))
+        self.nextstate = np.zeros((size, state_dim))
+        self.action = np.zeros(size, dtype=np.int64)
+        self.reward = np.zeros(size)
+        self.notdone = np.zeros(size)
+        self.ret = np.full(size, np.nan)
+        self.link = np.zeros(size, dtype=bool)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def rows(self, ind):
+        return (self.start + ind) % self.size
+
+    def add(self, state, action, reward, nextstate, notdone):
+        if self.count > 0:
+            last = self.rows(self.count - 1)
+            if np.array_equal(self.nextstate[last], state):
+                self.link[last] = True
+        if self.count < self.size:
+            row = self.rows(self.count)
+            self.count += 1
+        else:
+            row = self.start
+            self.start = (self.start + 1) % self.size
+        self.state[row] = state
+        self.nextstate[row] = nextstate
+        self.action[row] = action
+        self.reward[row] = reward
+        self.notdone[row] = notdone
+        self.ret[row] = np.nan
+        self.link[row] = False
+
+    def chain(self, j, discount, limitd):
+        """
+        discounted rewards from j to the end of its episode in memory (at most limitd transitions later),
+        the row of the last transition and the discount of its bootstrap
+        """
+        links = self.link[self.rows(np.arange(j, min(j + limitd, self.count)))]
+        length = limitd if links.all() else int(np.argmin(links))
+        rows = self.rows(np.arange(j, j + length + 1))
+        ret = np.dot(discount ** np.arange(length + 1), self.reward[rows])
+        return ret, rows[-1], discount ** (length + 1)
+
+
 class deepQAgent(object):
     def __del__(self):
         print ('deepQAgent died')
@@ -177,7 +232,7 @@ class deepQAgent(object):
 
         self.saver = tf.train.Saver()
         self.sess = tf.Session()
-        self.memory = []
+        self.memory = RingMemory(self.config['memsize'], n_input)
         self.errmemory = []
         if self.config["path_exp"] is None or (not os.path.isfile(self.config["path_exp"] + ".tf")):
             self.sess.run(tf.initialize_all_variables())
@@ -200,82 +255,57 @@ class deepQAgent(object):
 
     def learn(self, state, action, obnew, reward, notdone, nextaction):
         if self.isdiscrete:
-            target = reward + self.config['discount'] * self.maxq(obnew) * notdone
-
-            target = target.reshape(1, )
-            allstate = state.reshape(1, -1)
-            allaction = np.array([action])
-            alltarget = target
-            indexes = [-1]
             update = (np.random.random() < self.config['probupdate'])
 
-            if update:
-                if len(self.memory) > self.config['batch_size']:
-
-                    ind = np.random.choice(len(self.memory), self.config[
-                        'batch_size'])
-
-                    for j in ind:
-                        s, a, r, onew, d, Q, nextstate = self.memory[j]
-
-                        if Q != None:
-                            alternativetarget = Q
-                        else:
-                            if self.config['lambda'] > 0.:
-                                limitd = 1000
-                                alternativetarget = r
-                                gamma = self.config['discount']
-                                offset = 0
-                                if nextstate == None:
-                                    alternativetarget += gamma * self.maxq(onew) * d
-
-                                while nextstate != None and offset < limitd:
-                                    offset += nextstate
-                                    n = j + offset
-                                    # print j,n
-                                    alternativetarget += gamma * self.memory[n][2]
-                                    gamma = gamma * self.config['discount']
-                                    if self.memory[n][6] == None or not (offset < limitd):
-                                        alternativetarget += gamma * self.maxq(self.memory[n][3]) * self.memory[n][4]
-
-                                    nextstate = self.memory[n][6]
-                            else:
-                                alternativetarget = 0.
-                            self.memory[j][5] = alternativetarget
-
-                        alternativetarget = alternativetarget * self.config['lambda'] + (r + self.config[
-                            'discount'] * self.maxq(onew) * d) * (1. - self.config['lambda'])
+            if update and len(self.memory) > self.config['batch_size']:
+                ind = np.random.choice(len(self.memory), self.config['batch_size'])
+                rows = self.memory.rows(ind)
+                # the current transition first, then the samples
+                allstate = np.concatenate((state.reshape(1, -1), self.memory.state[rows]), 0)
+                allaction = np.concatenate(([action], self.memory.action[rows]))
+                allnext = np.concatenate((obnew.reshape(1, -1), self.memory.nextstate[rows]), 0)
+                allreward = np.concatenate(([reward], self.memory.reward[rows]))
+                allnotdone = np.concatenate(([notdone], self.memory.notdone[rows]))
+
+                if self.config['lambda'] > 0.:
+                    missing, chains = self.lambda_chains(ind)
+                else:
+                    missing, chains = [], []
+                # bootstrap values of the next states and of the ends of the lambda chains in one run
+                maxqnext = self.maxqbatch(np.concatenate(
+                    [allnext] + [self.memory.nextstate[[last for _, last, _ in chains]]], 0))
+                alltarget = allreward + self.config['discount'] * maxqnext[:len(allnext)] * allnotdone
+                if self.config['lambda'] > 0.:
+                    for j, (ret, last, gamma), q in zip(missing, chains, maxqnext[len(allnext):]):
+                        self.memory.ret[self.memory.rows(j)] = ret + gamma * q * self.memory.notdone[last]
+                    alltarget[1:] = self.memory.ret[rows] * self.config['lambda'] + alltarget[1:] * (
+                        1. - self.config['lambda'])
+                allactionsparse = np.eye(self.n_out)[allaction]
+
+                self.sess.run(self.optimizer, feed_dict={self.x: allstate, self.y: alltarget.reshape((-1, 1)),
+                                                         self.curraction: allactionsparse})
+
+            self.memory.add(state, action, reward, obnew, notdone)
 
-                        alltarget = np.concatenate((alltarget, alternativetarget),
-                                                   0)  # r+self.config['discount']*self.maxq(onew)*d   np.concatenate((alltarget,r+self.config['discount']*self.maxq(onew)*d ),0)
-
-                        allstate = np.concatenate((allstate, s.reshape(1, -1)), 0)
-                        allaction = np.concatenate((allaction, np.array([a])), 0)
-                        indexes.append(j)
-                    allactionsparse = np.zeros((allstate.shape[0], self.n_out))
-                    allactionsparse[np.arange(allaction.shape[0]), allaction] = 1.
-
-                    self.sess.run(self.optimizer, feed_dict={self.x: allstate, self.y: alltarget.reshape((-1, 1)),
-                                                             self.curraction: allactionsparse})
-
-
-            allactionsparse = np.zeros((allstate.shape[0], self.n_out))
-            allactionsparse[np.arange(allaction.shape[0]), allaction] = 1.
-
-
-            if len(self.memory) > 0 and np.array_equal(self.memory[-1][3], state):
-                self.memory[-1][6] = 1
-            self.memory.append([state, action, reward, obnew, notdone, None, None])
+            return 0
 
-            self.memory = self.memory[-self.config['memsize']:]
+    def lambda_chains(self, ind, limitd=1000):
+        """
+        samples of ind without a cached lambda return, and their episode in memory (discounted rewards up to
+        limitd steps, row of the bootstrap and its discount, see RingMemory.chain)
+        """
+        missing = np.unique(ind[np.isnan(self.memory.ret[self.memory.rows(ind)])])
+        return missing, [self.memory.chain(j, self.config['discount'], limitd) for j in missing]
 
-            return 0
     def maxq(self, observation):
         if self.isdiscrete:
             if observation.ndim == 1:
                 observation = observation.reshape(1, -1)
             return np.max(self.sess.run(self.Q, feed_dict={self.x: observation})).reshape(1, )
 
+    def maxqbatch(self, observations):
+        return np.max(self.sess.run(self.Q, feed_dict={self.x: observations}), 1)
+
     def argmaxq(self, observation):
         # print observation
         if self.isdiscrete:
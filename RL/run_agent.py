@@ -1,23 +1,20 @@
 import logging
 from agent import run
+from agent import multiseed
 logger = logging.getLogger(__name__)
 
 def example_experiment():
     repeat = 5
-    avg_rew = 0.0
     episodes = 100000
     sleep = 0.00
-    params = run.getparams(episodes)
-    reward_list = []
-
-    for i in range(repeat):
-        reward, allparams, totrewlist, totrewavglist, greedyrewlist, reward_threshold = run.main(params.copy(),numavg=100,sleep=sleep)
-        reward_list.append(reward)
-        avg_rew+=reward
-    avg_rew/=repeat
-    print(allparams)
-    print("avg_rew",avg_rew)
-    print("rew list",reward_list)
+    params = ['--episodes', str(episodes), '--no_plot']
+    # the seeds run in parallel, one thread each
+    res = multiseed.run_seeds(params, seeds=range(repeat), threads=1, numavg=100, sleep=sleep,
+                              table_path='out_dir/example_experiment.csv')
+    print("avg_rew", res['mean'], "+-", res['ci95'])
+    print("rew list", [res['rewards'][s] for s in sorted(res['rewards'])])
+    if res['failed']:
+        print("failed seeds", res['failed'])
 
 if __name__ == '__main__':
-    run.main(None)
\ No newline at end of file
+    run.main(None)